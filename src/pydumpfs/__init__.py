@@ -1,84 +1,297 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime, timedelta
-from glob import glob
 from os import listdir, makedirs, stat_float_times
-from os.path import abspath, dirname, exists, isdir, islink, join, lexists
+from os.path import abspath, basename, dirname, exists, isdir, islink, join, \
+    lexists
+from pydumpfs.blocks import BLOCKS, DEFAULT_BLOCK_SIZE, \
+    DEFAULT_CHUNKED_MIN_SIZE, BlockStore, Chunker, collect_garbage
+from pydumpfs.catalog import Catalog, get_catalog_path, is_snapshot_name
+from pydumpfs.compress import DEFAULT_MIN_SIZE, Policy, compress
+from pydumpfs.checkpoint import find_interrupted, is_incomplete, \
+    mark_complete, mark_incomplete, open_checkpoint
+from pydumpfs.dedup import DigestIndex, compute_digest, get_digests_path, \
+    make_key
+from pydumpfs.fastcopy import FileCopier
+from pydumpfs.filters import Matcher, read_key, write_key
+from pydumpfs.journal import read_journal
+from pydumpfs.manifest import METADATA_DIR, ManifestWriter, \
+    get_manifest_path, get_metadata_dir, is_same_stat, make_record, \
+    open_manifest
+from pydumpfs.pool import Prefetcher, WorkerPool
+from pydumpfs.prune import empty_trash, move_to_trash
+from pydumpfs.stats import RunStats
 from re import match
-from shutil import copy, copystat, rmtree
+from shutil import copystat, rmtree
+from threading import local
+from time import time
+import errno
 import os
 import stat
 import sys
 
+# Directories listed ahead of copying.
+SCAN_AHEAD = 64
+
 def make_backup_name(timestamp):
     milli = timestamp.microsecond // 1000
     fmt = "%Y-%m-%d_%H:%M:%S.{milli:03d}".format(**locals())
     return timestamp.strftime(fmt)
 
 def glob_backups(dir_):
-    digit = "[0-9]"
-    digit2 = digit * 2
-    digit3 = digit * 3
-    digit4 = digit * 4
-    date_pattern = "{digit4}-{digit2}-{digit2}".format(**locals())
-    time_pattern = "{digit2}:{digit2}:{digit2}.{digit3}".format(**locals())
-    pattern = "{date_pattern}_{time_pattern}".format(**locals())
-    return glob(join(dir_, pattern))
+    """Returns paths of snapshots in the catalog in the order of time. Those
+    of a destination made before the catalog are found by their names."""
+    if not exists(get_catalog_path(dir_)):
+        return [join(dir_, name) for name in sorted(listdir(dir_))
+            if is_snapshot_name(name)
+                and (not is_incomplete(join(dir_, name)))]
+    catalog = Catalog(dir_)
+    try:
+        return [join(dir_, name) for name in catalog.snapshots()]
+    finally:
+        catalog.close()
+
+def merge_join(left, right):
+    """Joins two lists of (name, value) sorted by names.
+
+    Yields (name, left value, right value). A value is None when its list
+    doesn't have the name.
+    """
+    i = j = 0
+    while (i < len(left)) and (j < len(right)):
+        left_name, left_value = left[i]
+        right_name, right_value = right[j]
+        if left_name < right_name:
+            yield left_name, left_value, None
+            i += 1
+        elif right_name < left_name:
+            yield right_name, None, right_value
+            j += 1
+        else:
+            yield left_name, left_value, right_value
+            i += 1
+            j += 1
+    for name, value in left[i:]:
+        yield name, value, None
+    for name, value in right[j:]:
+        yield name, None, value
 
 class PydumpfsError(Exception):
     pass
 
+class _Unrecorded(object):
+    """Stands for a file in a previous snapshot which has no manifest."""
+    digest = None
+    codec = None
+
+_UNRECORDED = _Unrecorded()
+
+class _RecordStat(object):
+    """Status of a file taken from its record in the previous manifest."""
+
+    def __init__(self, record):
+        self.st_mode = record.mode
+        self.st_uid = record.uid
+        self.st_gid = record.gid
+        self.st_size = record.size
+        # Manifests don't keep access time.
+        self.st_atime = record.mtime
+        self.st_mtime = record.mtime
+        self.st_ctime = record.ctime
+        self.st_ino = record.ino
+        self.st_dev = record.dev
+        self.st_nlink = record.nlink
+
+_SAME = "same"
+_CHANGED = "changed"
+_UNSURE = "unsure"
+# A file which was not backed up. Its record is not written.
+_FAILED = "failed"
+
 class Pydumpfs(object):
 
-    def __init__(self, verbose=False):
+    def __init__(self, verbose=False, checksum=False, dedup=False, jobs=1,
+                 rules=(), one_file_system=False, parallel_sources=False,
+                 compress=None, compress_min_size=DEFAULT_MIN_SIZE,
+                 compress_extensions=(), delta_min_size=None,
+                 block_size=DEFAULT_BLOCK_SIZE, chunk_size=None,
+                 throttle=None):
         self.verbose = verbose
+        self.checksum = checksum
+        self.dedup = dedup
+        self.jobs = jobs
+        self.one_file_system = one_file_system
+        self.parallel_sources = parallel_sources
+        self._matcher = Matcher(rules, one_file_system)
+        self.block_size = block_size
+        self.chunk_size = chunk_size
+        if (chunk_size is not None) and (delta_min_size is None):
+            # Cutting small files costs more than it saves.
+            delta_min_size = DEFAULT_CHUNKED_MIN_SIZE
+        if (compress is None) and (delta_min_size is None):
+            self._policy = None
+        else:
+            self._policy = Policy(
+                compress, compress_min_size, compress_extensions,
+                delta_min_size)
+        self.throttle = throttle
+        self._local = local()
+        self._copier = FileCopier(throttle)
+        self._manifest = None
+        self._prev_manifest = None
+        self._digests = None
+        self._journal = None
+        self._catalog = None
+        self._blocks = None
+        self._resuming = False
+        self._checkpoint = None
+        self.stats = RunStats()
 
     def decide_backup_dir(self, dest):
-        return join(dest, make_backup_name(datetime.now()))
+        while True:
+            backup_dir = join(dest, make_backup_name(datetime.now()))
+            # Backups made in the same millisecond would share the name.
+            if not lexists(backup_dir):
+                return backup_dir
 
     def do(self, dest, *src):
         if not exists(dest):
             raise PydumpfsError("%(dest)s doesn't exist." % { "dest": dest })
 
         stat_float_times(False)
-        prev_dir = self._get_prev_dir(dest)
-        backup_dir = self.decide_backup_dir(dest)
-        makedirs(backup_dir)
-
-        for d in src:
-            self._do(prev_dir, backup_dir, d)
+        self.stats = RunStats()
+        if self.throttle is not None:
+            self.throttle.stats = self.stats
+            for path in src:
+                if exists(path):
+                    self.throttle.watch(path)
+        self._catalog = Catalog(dest)
+        try:
+            backup_dir = self._make_snapshot(dest, src)
+        finally:
+            # What a failed backup added to the catalog is not committed.
+            self._catalog.close()
+            self._catalog = None
 
         self._print_debug(
-            "done. The backup directory is %(path)r." % dict(path=backup_dir))
+            "done. The backup directory is %(path)r.", path=backup_dir)
         return backup_dir
 
-    def _print_debug(self, s):
+    def _make_snapshot(self, dest, src):
+        self._catalog.sync()
+        prev_dir = self._get_prev_dir(dest)
+        key = self._matcher.get_key()
+        sources = [abspath(path) for path in src]
+        # A backup storing files in another way doesn't resume.
+        mark_key = key
+        if self._policy is not None:
+            mark_key = "\n".join([key, self._policy.get_key()])
+        name = find_interrupted(
+            dest, self._catalog.latest(), sources, mark_key)
+        if name is None:
+            backup_dir = self.decide_backup_dir(dest)
+            makedirs(get_metadata_dir(backup_dir))
+            mark_incomplete(backup_dir, sources, mark_key)
+        else:
+            backup_dir = join(dest, name)
+            self._print_debug("resume: %(path)s", path=backup_dir)
+            self._resuming = True
+            self._checkpoint = open_checkpoint(backup_dir)
+        self._catalog.begin(basename(backup_dir))
+        if key:
+            write_key(backup_dir, key)
+
+        if prev_dir is not None:
+            self._prev_manifest = open_manifest(prev_dir)
+        if (self._prev_manifest is not None) and (not self.checksum):
+            # Clean directories are listed from the previous manifest, which
+            # has only what the rules selected then.
+            if read_key(prev_dir) == key:
+                self._journal = read_journal(dest, self._prev_manifest.start)
+            if self._journal is None:
+                self._print_debug("no journal. scanning all directories.")
+        self._manifest = ManifestWriter(get_manifest_path(backup_dir))
+        if self.dedup:
+            self._digests = DigestIndex(dest)
+        if (self._policy is not None) \
+                and (self._policy.delta_min_size is not None):
+            if self.chunk_size is None:
+                chunker = None
+            else:
+                chunker = Chunker(self.chunk_size)
+            self._blocks = BlockStore(
+                dest, self.block_size, chunker, self.throttle)
+        try:
+            if self.parallel_sources:
+                self._do_in_parallel(prev_dir, backup_dir, src)
+            else:
+                for d in src:
+                    self._do(prev_dir, backup_dir, d)
+        finally:
+            self._manifest.close()
+            self._manifest = None
+            if self._digests is not None:
+                self._digests.close()
+                self._digests = None
+            if self._blocks is not None:
+                self._blocks.close()
+                self._blocks = None
+            self._journal = None
+            if self._prev_manifest is not None:
+                self._prev_manifest.close()
+                self._prev_manifest = None
+            if self._checkpoint is not None:
+                self._checkpoint.close()
+                self._checkpoint = None
+            self._resuming = False
+            self.stats.finish()
+        self._catalog.commit()
+        mark_complete(backup_dir)
+        return backup_dir
+
+    def _print(self, out, s):
+        messages = getattr(self._local, "messages", None)
+        if messages is None:
+            print >> out, s
+            return
+        messages.append((out, s))
+
+    def _print_debug(self, fmt, **kwargs):
+        # Messages are formatted only when they are printed.
         if not self.verbose:
             return
 
-        print s
+        self._print(sys.stdout, fmt % kwargs)
 
-    def _get_prev_dir(self, dest):
-        digit = "[0-9][0-9]*"
-        date_pattern = "{digit}-{digit}-{digit}".format(**locals())
-        time_pattern = "{digit}:{digit}:{digit}".format(**locals())
-        pattern = "{date_pattern}_{time_pattern}".format(**locals())
+    def _print_error(self, s):
+        self.stats.add("errors")
+        self._print(sys.stderr, s)
+
+    def _capture(self, func, *args):
+        # Messages of a task are kept until the task's turn comes, so output
+        # of parallel tasks is in the same order as that of sequential ones.
+        self._local.messages = []
         try:
-            return sorted(glob_backups(dest))[-1]
-        except IndexError:
-            return None
+            return func(*args), self._local.messages
+        finally:
+            self._local.messages = None
 
-    def _is_same_file(self, path1, path2):
-        if isdir(path1) and (not islink(path1)):
-            raise "%(path)r must be a file." % dict(path=path1)
-        if isdir(path2) and (not islink(path2)):
-            return False
+    def _flush(self, messages):
+        for out, s in messages:
+            print >> out, s
 
-        if (not lexists(path1)) or (not lexists(path2)):
+    def _get_prev_dir(self, dest):
+        name = self._catalog.latest()
+        if name is None:
+            return None
+        return join(dest, name)
+
+    def _is_same_file_stat(self, stat1, path2):
+        try:
+            stat2 = os.lstat(path2)
+        except OSError:
             return False
 
-        stat1 = os.lstat(path1)
-        stat2 = os.lstat(path2)
         if stat1.st_mode != stat2.st_mode:
             return False
         if stat1.st_uid != stat2.st_uid:
@@ -87,143 +300,781 @@ class Pydumpfs(object):
             return False
         if stat1.st_size != stat2.st_size:
             return False
+        if stat1.st_mtime != stat2.st_mtime:
+            return False
+        return True
+
+    def _compare_file(self, prev, src, st, record):
+        """Returns _SAME, _CHANGED, or _UNSURE when contents must be compared.
+        """
+        if record is None:
+            return _CHANGED
+        if record is _UNRECORDED:
+            if not self._is_same_file_stat(st, prev):
+                return _CHANGED
+            racy = False
+        else:
+            if not is_same_stat(record, st):
+                return _CHANGED
+            racy = self._prev_manifest.is_racy(record)
 
-        import filecmp
-        return filecmp.cmp(path1, path2)
+        if self.checksum or racy:
+            return _UNSURE
+        return _SAME
 
     def _copy_owner(self, dest, src):
         st = os.lstat(src)
         self._print_debug(
-            "lchown: path=%(path)s, uid=%(uid)d, gid=%(gid)d" 
-                % dict(path=dest, uid=st.st_uid, gid=st.st_gid))
+            "lchown: path=%(path)s, uid=%(uid)d, gid=%(gid)d",
+                path=dest, uid=st.st_uid, gid=st.st_gid)
         os.lchown(dest, st.st_uid, st.st_gid)
 
-    def _change_owner_stat(self, dest, src_dir, src_name):
-        src_path = join(src_dir, src_name)
-        dest_path = dest + src_path
-        if not lexists(dest_path):
-            return
-
-        self._copy_owner(dest_path, src_path)
-        if not islink(src_path):
-            self._copystat(dest_path, src_path)
-
     def _copystat(self, dest, src):
         self._print_debug(
-            "copystat: src=%(src)s, dest=%(dest)s" % dict(src=src, dest=dest))
+            "copystat: src=%(src)s, dest=%(dest)s", src=src, dest=dest)
         copystat(src, dest)
 
-    def _copy(self, dest, src):
+    def _remove_partial(self, dest):
+        # A partial file would be linked to following snapshots as if it
+        # were complete.
+        try:
+            os.unlink(dest)
+        except OSError:
+            pass
+
+    def _take_op(self):
+        if self.throttle is not None:
+            self.throttle.op()
+
+    def _copy(self, dest, src, st):
         self._print_debug(
-            "copy: src=%(src)s, dest=%(dest)s" % dict(src=src, dest=dest))
+            "copy: src=%(src)s, dest=%(dest)s", src=src, dest=dest)
+        self._take_op()
+        start = time()
         try:
-            copy(src, dest)
-        except IOError, e:
-            print >> sys.stderr, \
-                    "error: Can't copy %(src)s to %(dest)s (%(error)s)." \
-                    % { "src": src, "dest": dest, "error": e.strerror }
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                dest_fd = os.open(
+                    dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+                try:
+                    self._copier.copy(src_fd, dest_fd)
+                finally:
+                    os.close(dest_fd)
+            finally:
+                os.close(src_fd)
+        except (IOError, OSError), e:
+            self._print_error(
+                    "error: Can't copy %(src)s to %(dest)s (%(error)s)."
+                    % { "src": src, "dest": dest, "error": e.strerror })
+            self._remove_partial(dest)
+            return False
+        finally:
+            self.stats.add_time("copy", start)
+        self.stats.add("copied")
+        self.stats.add("bytes_read", st.st_size)
+        self.stats.add("bytes_written", st.st_size)
+        return True
+
+    def _compress(self, dest, src, st, codec):
+        """Returns the digest of src after writing it to dest compressed, or
+        None."""
+        self._print_debug(
+            "compress: src=%(src)s, dest=%(dest)s, codec=%(codec)s",
+                src=src, dest=dest, codec=codec)
+        self._take_op()
+        start = time()
+        try:
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                dest_fd = os.open(
+                    dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+                try:
+                    digest, written = compress(
+                        src_fd, dest_fd, codec, self.throttle)
+                finally:
+                    os.close(dest_fd)
+            finally:
+                os.close(src_fd)
+        except (IOError, OSError), e:
+            self._print_error(
+                    "error: Can't copy %(src)s to %(dest)s (%(error)s)."
+                    % { "src": src, "dest": dest, "error": e.strerror })
+            self._remove_partial(dest)
+            return None
+        finally:
+            self.stats.add_time("copy", start)
+        self.stats.add("copied")
+        self.stats.add("compressed")
+        self.stats.add("bytes_read", st.st_size)
+        self.stats.add("bytes_written", written)
+        return digest
+
+    def _store_blocks(self, dest, src, st):
+        """Returns the digest of src after writing its blocks which the
+        store doesn't have, and the list of them to dest, or None."""
+        self._print_debug(
+            "store blocks: src=%(src)s, dest=%(dest)s", src=src, dest=dest)
+        self._take_op()
+        start = time()
+        try:
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                digest, blocks, written = self._blocks.store(src_fd, dest)
+            finally:
+                os.close(src_fd)
+        except (IOError, OSError), e:
+            self._print_error(
+                    "error: Can't copy %(src)s to %(dest)s (%(error)s)."
+                    % { "src": src, "dest": dest, "error": e.strerror })
+            self._remove_partial(dest)
+            return None
+        finally:
+            self.stats.add_time("copy", start)
+        self.stats.add("copied")
+        self.stats.add("stored_blocks", blocks)
+        self.stats.add("bytes_read", st.st_size)
+        self.stats.add("bytes_written", written)
+        return digest
+
+    def _compare_digest(self, prev, src, st, prev_record):
+        """Compares src with prev stored in another way by their digests.
+        Returns _SAME or _CHANGED."""
+        start = time()
+        try:
+            digest = prev_record.digest
+            if (digest is None) and (prev_record.codec is None):
+                digest = compute_digest(prev, self.throttle)
+                self.stats.add("bytes_read", st.st_size)
+            if digest is None:
+                return _CHANGED
+            same = compute_digest(src, self.throttle) == digest
+            self.stats.add("bytes_read", st.st_size)
+        except (IOError, OSError), e:
+            self._print_debug(
+                "can't compare %(path)s (%(desc)s).",
+                    path=src, desc=e.strerror)
+            return _CHANGED
+        finally:
+            self.stats.add_time("compare", start)
+        if same:
+            return _SAME
+        return _CHANGED
+
+    def _compare_and_copy(self, dest, src, prev, st):
+        """Returns _SAME if src is same as prev. Otherwise copies src to dest
+        and returns _CHANGED, or _FAILED."""
+        self._print_debug(
+            "compare and copy: src=%(src)s, prev=%(prev)s, dest=%(dest)s",
+                src=src, prev=prev, dest=dest)
+        start = time()
+        try:
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                prev_fd = os.open(prev, os.O_RDONLY)
+                try:
+                    same = self._copier.compare_and_copy(src_fd, prev_fd, dest)
+                finally:
+                    os.close(prev_fd)
+            finally:
+                os.close(src_fd)
+        except (IOError, OSError), e:
+            self._print_error(
+                    "error: Can't copy %(src)s to %(dest)s (%(error)s)."
+                    % { "src": src, "dest": dest, "error": e.strerror })
+            self._remove_partial(dest)
+            return _FAILED
+        finally:
+            self.stats.add_time("compare", start)
+        self.stats.add("bytes_read", 2 * st.st_size)
+        if same:
+            return _SAME
+        self.stats.add("copied")
+        self.stats.add("bytes_written", st.st_size)
+        self._restore_meta_data(dest, src, st)
+        return _CHANGED
+
+    def _restore_meta_data(self, dest, src, st):
+        self._take_op()
+        start = time()
+        try:
+            self._set_meta_data(dest, src, st)
+        finally:
+            self.stats.add_time("metadata", start)
+
+    def _set_meta_data(self, dest, src, st):
+        self._print_debug(
+            "lchown: path=%(path)s, uid=%(uid)d, gid=%(gid)d",
+                path=dest, uid=st.st_uid, gid=st.st_gid)
+        os.lchown(dest, st.st_uid, st.st_gid)
+        if stat.S_ISLNK(st.st_mode):
+            return
+
+        self._print_debug(
+            "copystat: src=%(src)s, dest=%(dest)s", src=src, dest=dest)
+        os.utime(dest, (st.st_atime, st.st_mtime))
+        os.chmod(dest, stat.S_IMODE(st.st_mode))
+        if hasattr(os, "chflags") and hasattr(st, "st_flags"):
+            os.chflags(dest, st.st_flags)
+
+    def _copy_file(self, dest, src, st, codec):
+        """Returns the digest of dest, which is None if it was not computed,
+        or _FAILED."""
+        if codec == BLOCKS:
+            # Blocks are shared by the store, not by links.
+            digest = self._store_blocks(dest, src, st)
+            if digest is None:
+                return _FAILED
+            self._restore_meta_data(dest, src, st)
+            return digest
+        if self._digests is None:
+            if codec is not None:
+                digest = self._compress(dest, src, st, codec)
+                if digest is None:
+                    return _FAILED
+                self._restore_meta_data(dest, src, st)
+                return digest
+            if not self._copy(dest, src, st):
+                return _FAILED
+            self._restore_meta_data(dest, src, st)
+            return None
+
+        start = time()
+        try:
+            digest = compute_digest(src, self.throttle)
+        except (IOError, OSError), e:
+            # The source may be removed after it was listed.
+            self._print_error("error: Can't read %(path)r (%(desc)s)." \
+                % dict(path=src, desc=e.strerror))
+            return _FAILED
+        finally:
+            self.stats.add_time("compare", start)
+        self.stats.add("bytes_read", st.st_size)
+        # Files are linked only to those stored in the same way.
+        key = make_key(digest, st, codec)
+        path = self._digests.lookup(key, st, codec is not None)
+        if path is not None:
+            try:
+                self._link(dest, path)
+                # The entry follows the latest snapshot, which is removed
+                # last.
+                self._digests.add(key, dest)
+                return digest
+            except OSError, e:
+                self._print_debug(
+                    "can't link %(path)s (%(desc)s).",
+                        path=path, desc=e.strerror)
+            return self._copy_new_file(dest, src, st, digest, key, codec)
+
+        try:
+            return self._copy_new_file(dest, src, st, digest, key, codec)
+        finally:
+            self._digests.release(key)
+
+    def _copy_new_file(self, dest, src, st, digest, key, codec):
+        if codec is None:
+            if not self._copy(dest, src, st):
+                return _FAILED
+        elif self._compress(dest, src, st, codec) is None:
+            return _FAILED
+        # Following files with the same content can be linked to this one
+        # only after it gets the metadata.
+        self._restore_meta_data(dest, src, st)
+        self._digests.add(key, dest)
+        return digest
 
     def _link(self, dest, src):
         self._print_debug(
-            "hard link: src=%(src)s, dest=%(dest)s" % dict(src=src, dest=dest))
-        os.link(src, dest)
+            "hard link: src=%(src)s, dest=%(dest)s", src=src, dest=dest)
+        self._take_op()
+        start = time()
+        try:
+            os.link(src, dest)
+        finally:
+            self.stats.add_time("copy", start)
+        self.stats.add("linked")
 
     def _mkdir(self, path):
-        self._print_debug("mkdir: path=%(path)s" % dict(path=path))
+        self._print_debug("mkdir: path=%(path)s", path=path)
+        self._take_op()
         os.mkdir(path)
 
     def _symlink(self, dest, src):
         self._print_debug(
-            "symlink: src=%(src)s, dest=%(dest)s" % dict(src=src, dest=dest))
-        os.symlink(src, dest)
+            "symlink: src=%(src)s, dest=%(dest)s", src=src, dest=dest)
+        self._take_op()
+        start = time()
+        try:
+            os.symlink(src, dest)
+        finally:
+            self.stats.add_time("copy", start)
+        self.stats.add("symlinked")
 
-    def _change_meta_data(self, dest, src):
-        for dirpath, dirnames, filenames in os.walk(src, topdown=False):
-            for dirname in dirnames:
-                try:
-                    self._change_owner_stat(dest, dirpath, dirname)
-                except OSError, e:
-                    path = dest + join(dirpath, dirname)
-                    print >> sys.stderr, "error: Can't change status of the di"\
-                        "rectory %(path)r (%(desc)s)." \
-                            % dict(path=path, desc=e.strerror)
-
-            for filename in filenames:
-                try:
-                    path = join(dirpath, filename)
-                    st = os.lstat(path)
-                    if stat.S_ISREG(st.st_mode) or islink(path):
-                        self._change_owner_stat(dest, dirpath, filename)
-                except OSError, e:
-                    print >> sys.stderr, "error: Can't change status of the fi"\
-                        "le %(path)r (%(desc)s)." \
-                            % dict(path=dest+path, desc=e.strerror)
+    def _set_root(self, src):
+        # Sources may be walked at once in their own threads.
+        self._local.root_len = len(src.rstrip("/")) + 1
+
+    def _is_excluded(self, path, is_dir):
+        # Rules match paths relative to the source.
+        return self._matcher.is_excluded(
+            path[self._local.root_len:], is_dir)
+
+    def _can_descend(self, st, root_dev):
+        return (not self.one_file_system) or (st.st_dev == root_dev)
 
     def _make_link(self, dest, src):
         to = os.readlink(src)
         self._symlink(dest, to)
+        return to
 
-    def _walk_to_copy(self, prev, dest, src, file_func):
-        for dirpath, dirnames, filenames in os.walk(src):
-            for dirname in dirnames:
-                src_dir = join(dirpath, dirname)
-                dest_dir = dest + src_dir
-                try:
-                    if islink(src_dir):
-                        self._make_link(dest_dir, src_dir)
-                    else:
-                        self._mkdir(dest_dir)
-                except OSError, e:
-                    print >> sys.stderr, "error: Can't make the directory %(pa"\
-                        "th)r (%(desc)s)." \
-                            % dict(path=dest_dir, desc=e.strerror)
-
-            for filename in filenames:
-                src_file = join(dirpath, filename)
-                if prev is not None:
-                    prev_file = prev + src_file
-                else:
-                    prev_file = None
-                dest_file = dest + src_file
-                try:
-                    file_func(prev_file, dest_file, src_file)
-                except OSError, e:
-                    print >> sys.stderr, "error: Can't copy the file %(path)r "\
-                        "(%(desc)s)." % dict(path=src_file, desc=e.strerror)
+    def _add_records(self, dirpath, records):
+        if self._manifest is None:
+            return
+        self._manifest.add(dirpath, records)
+
+    def _list_prev_dir(self, prev, dirpath):
+        if prev is None:
+            return []
+        if self._prev_manifest is not None:
+            records = self._prev_manifest.list_dir(dirpath)
+            return [(record.name, record) for record in records]
+
+        self._take_op()
+        try:
+            names = listdir(prev + dirpath)
+        except OSError:
+            return []
+        return [(name, _UNRECORDED) for name in sorted(names)]
+
+    def _scan_dir(self, path):
+        dirs = []
+        files = []
+        self._take_op()
+        for name in sorted(listdir(path)):
+            child = join(path, name)
+            try:
+                st = os.lstat(child)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    self._print_error("error: Can't get status of %(path)r "\
+                        "(%(desc)s)." % dict(path=child, desc=e.strerror))
+                continue
+            is_dir = stat.S_ISDIR(st.st_mode)
+            if self._is_excluded(child, is_dir):
+                self._print_debug("exclude: path=%(path)s", path=child)
+                continue
+            if is_dir:
+                dirs.append((name, st))
+            else:
+                files.append((name, st))
+        self.stats.add("scanned_dirs")
+        self.stats.add("scanned_files", len(files))
+        return dirs, files
+
+    def _list_clean_dir(self, dirpath):
+        # Entries are same as those in the previous snapshot.
+        dirs = []
+        files = []
+        for record in self._prev_manifest.list_dir(dirpath):
+            if stat.S_ISDIR(record.mode):
+                dirs.append((record.name, _RecordStat(record)))
+            else:
+                files.append((record.name, _RecordStat(record)))
+        self.stats.add("clean_dirs")
+        return dirs, files
+
+    def _is_clean_dir(self, path, st=None, record=None):
+        """Tells if the journal says that nothing in the directory changed
+        since the previous backup."""
+        if (self._journal is None) or self._journal.is_dirty(path):
+            return False
+        if not self._prev_manifest.has_dir(path):
+            return False
+        # A directory replaced by another one has another i-node. The status
+        # of a source directory itself is not in the manifest.
+        if st is None:
+            return True
+        return (record is not None) and is_same_stat(record, st)
+
+    def _list_dir(self, prev, dirpath, clean):
+        prev_records = self._list_prev_dir(prev, dirpath)
+        try:
+            if clean:
+                dirs, files = self._list_clean_dir(dirpath)
+            else:
+                dirs, files = self._scan_dir(dirpath)
+        except OSError, e:
+            self._print_error("error: Can't read the directory %(path)r "\
+                "(%(desc)s)." % dict(path=dirpath, desc=e.strerror))
+            return [], [], prev_records
+        return dirs, files, prev_records
+
+    def _scan_tree(self, prev, src, root_dev):
+        """Yields listings of directories under src in depth-first order.
+        This is the first stage of the pipeline, and runs in its own thread.
+        """
+        self._set_root(src)
+        stack = [(src, self._is_clean_dir(src))]
+        while stack:
+            dirpath, clean = stack.pop()
+            start = time()
+            result, messages = self._capture(
+                self._list_dir, prev, dirpath, clean)
+            dirs, files, prev_records = result
+            prev_dirs = dict(prev_records)
+            subdirs = []
+            for name, st in dirs:
+                path = join(dirpath, name)
+                clean = self._is_clean_dir(path, st, prev_dirs.get(name))
+                subdirs.append((path, st, clean))
+            self.stats.add_time("walk", start)
+            yield dirpath, clean, subdirs, files, prev_records, messages
+
+            # A mount point is kept as an empty directory.
+            stack.extend([
+                (path, clean) for path, st, clean in reversed(subdirs)
+                if self._can_descend(st, root_dev)])
+
+    def _make_dirs(self, dest, subdirs):
+        made_dirs = []
+        records = []
+        for path, st, _ in subdirs:
+            dest_dir = dest + path
+            try:
+                self._mkdir(dest_dir)
+            except OSError, e:
+                if self._resuming and (e.errno == errno.EEXIST):
+                    # The interrupted backup made it.
+                    made_dirs.append((path, st))
+                    records.append(make_record(basename(path), st))
+                    continue
+                self._print_error("error: Can't make the directory %(pa"\
+                    "th)r (%(desc)s)." \
+                        % dict(path=dest_dir, desc=e.strerror))
+                continue
+            made_dirs.append((path, st))
+            records.append(make_record(basename(path), st))
+        return made_dirs, records
+
+    def _copy_file_node(self, func, src, args):
+        try:
+            record = func(*args)
+        except (IOError, OSError), e:
+            self._print_error("error: Can't copy the file %(path)r "\
+                "(%(desc)s)." % dict(path=src, desc=e.strerror))
+            return []
+        if record is None:
+            return []
+        return [record]
+
+    def _link_clean_file(self, prev, dest, src, st, record):
+        # The source is not looked at unless linking fails.
+        try:
+            if stat.S_ISLNK(record.mode):
+                self._symlink(dest, record.target)
+            else:
+                self._link(dest, prev)
+        except OSError, e:
+            self._print_debug(
+                "can't link %(path)s (%(desc)s).", path=prev, desc=e.strerror)
+            action = self._decide(prev, dest, src, os.lstat(src), record, False)
+            if action is None:
+                return None
+            func, args = action
+            return func(*args)
 
-        self._change_meta_data(dest, src)
+        if stat.S_ISLNK(record.mode):
+            self._restore_meta_data(dest, src, st)
+        return record
+
+    def _copy_regular_file(self, state, prev, dest, src, st, prev_record):
+        result = self._link_or_copy(state, prev, dest, src, st, prev_record)
+        if result is _FAILED:
+            return None
+        digest, codec = result
+        return make_record(basename(src), st, digest=digest, codec=codec)
+
+    def _decide(self, prev, dest, src, st, prev_record, clean):
+        """Returns a function and its arguments which make dest, or None if
+        the file is not backed up. This is the second stage of the pipeline.
+        It looks only at statuses, and leaves reading data to workers.
+        """
+        if clean:
+            return self._link_clean_file, (prev, dest, src, st, prev_record)
+        if stat.S_ISLNK(st.st_mode):
+            return self._link_file, (dest, src, st)
+        if not stat.S_ISREG(st.st_mode):
+            return None
+        if prev is None:
+            state = _CHANGED
+        else:
+            start = time()
+            state = self._compare_file(prev, src, st, prev_record)
+            self.stats.add_time("compare", start)
+        return self._copy_regular_file, (
+            state, prev, dest, src, st, prev_record)
+
+    def _submit_dir(self, pool, prev, dest, listing):
+        dirpath, clean, subdirs, files, prev_records, messages = listing
+        records = []
+        def add(result):
+            new_records, messages = result
+            self._flush(messages)
+            records.extend(new_records)
+
+        if self._resuming:
+            _, stale_messages = self._capture(
+                self._remove_stale, dest + dirpath, dirpath, subdirs, files)
+            messages = messages + stale_messages
+        # Subdirectories must exist before any worker copies into them.
+        result, mkdir_messages = self._capture(self._make_dirs, dest, subdirs)
+        made_dirs, dir_records = result
+        messages = messages + mkdir_messages
+        pool.submit(lambda: (dir_records, messages), callback=add)
+        if not clean:
+            self._end_versions(dirpath, subdirs, files, prev_records)
+
+        # Files not in the previous snapshot are copied without looking at it.
+        for filename, st, prev_record in merge_join(files, prev_records):
+            if st is None:
+                continue
+            src_file = join(dirpath, filename)
+            if prev is not None:
+                prev_file = prev + src_file
+            else:
+                prev_file = None
+            dest_file = dest + src_file
+            action = self._decide(
+                prev_file, dest_file, src_file, st, prev_record, clean)
+            if action is None:
+                continue
+            func, args = action
+            if self._resuming:
+                func, args = self._resume_file, (
+                    action, prev_file, dest_file, src_file, st, prev_record)
+            pool.submit(
+                self._capture, (self._copy_file_node, func, src_file, args),
+                add)
+
+        pool.submit(
+            lambda: None, callback=lambda _: self._add_records(dirpath, records))
+        return made_dirs
+
+    def _remove_stale(self, dest_dir, dirpath, subdirs, files):
+        """Removes what the interrupted backup made in dest_dir which is not
+        in the listing of the source any more, or is of another type."""
+        dirs = set([basename(path) for path, _, _ in subdirs])
+        names = set([name for name, _ in files])
+        try:
+            dest_names = listdir(dest_dir)
+        except OSError:
+            return
+        for name in dest_names:
+            if (dirpath == "/") and (name == METADATA_DIR):
+                continue
+            path = join(dest_dir, name)
+            try:
+                if isdir(path) and (not islink(path)):
+                    if name not in dirs:
+                        self._print_debug("remove: path=%(path)s", path=path)
+                        rmtree(path)
+                elif name not in names:
+                    self._print_debug("remove: path=%(path)s", path=path)
+                    os.unlink(path)
+            except OSError, e:
+                self._print_error("error: Can't remove %(path)r (%(desc)s)." \
+                    % dict(path=path, desc=e.strerror))
+
+    def _is_linked(self, prev, dest_st):
+        if prev is None:
+            return False
+        try:
+            prev_st = os.lstat(prev)
+        except OSError:
+            return False
+        return (prev_st.st_ino == dest_st.st_ino) \
+            and (prev_st.st_dev == dest_st.st_dev)
+
+    def _find_done(self, prev, dest, src, st, prev_record):
+        """Returns a record of dest if the interrupted backup finished it, or
+        None. Its data is complete when it has the mtime of the source, which
+        is set after copying, unless the source was written in the second
+        when the interrupted backup started or later."""
+        if (not stat.S_ISREG(st.st_mode)) or (self._checkpoint is None):
+            return None
+        if self._checkpoint.start <= st.st_mtime:
+            return None
+        try:
+            dest_st = os.lstat(dest)
+        except OSError:
+            return None
+        # The codec is told by the checkpoint, by the previous snapshot which
+        # dest is linked to, or by the policy, which resuming backups share.
+        record = self._checkpoint.lookup(src)
+        if (record is not None) and is_same_stat(record, st):
+            digest, codec = record.digest, record.codec
+        elif (prev_record is not None) and self._is_linked(prev, dest_st):
+            digest, codec = prev_record.digest, prev_record.codec
+        else:
+            digest, codec = None, self._choose_codec(src, st)
+            if codec == BLOCKS:
+                # Blocks which only it lists may be collected.
+                return None
+        if (dest_st.st_mode != st.st_mode) or (dest_st.st_uid != st.st_uid) \
+                or (dest_st.st_gid != st.st_gid) \
+                or (dest_st.st_mtime != st.st_mtime):
+            return None
+        if (codec is None) and (dest_st.st_size != st.st_size):
+            return None
+        return make_record(basename(src), st, digest=digest, codec=codec)
+
+    def _resume_file(self, action, prev, dest, src, st, prev_record):
+        record = self._find_done(prev, dest, src, st, prev_record)
+        if record is None:
+            if lexists(dest):
+                os.unlink(dest)
+            func, args = action
+            return func(*args)
+
+        self.stats.add("resumed")
+        if not self._is_linked(prev, os.lstat(dest)):
+            self._add_version(dest, src, st, record.digest)
+        return record
+
+    def _walk_to_copy(self, prev, dest, src):
+        # Each entry is stat'ed once when its directory is listed. The status
+        # is used for comparing, copying and restoring metadata.
+        #
+        # A scanner thread lists directories ahead, this thread decides what
+        # to do with each file, and workers copy or link. Queues between the
+        # stages are bounded, so are memory and output buffered.
+        st = os.stat(src)
+        dirs = [(src, st)]
+        failed = set()
+        pool = WorkerPool(self.jobs)
+        scanner = Prefetcher(self._scan_tree(prev, src, st.st_dev), SCAN_AHEAD)
+        try:
+            for listing in scanner:
+                dirpath, _, subdirs, _, _, _ = listing
+                if dirpath in failed:
+                    failed.update([path for path, _, _ in subdirs])
+                    continue
+                made_dirs = self._submit_dir(pool, prev, dest, listing)
+                dirs.extend(made_dirs)
+                if len(made_dirs) < len(subdirs):
+                    made = set([path for path, _ in made_dirs])
+                    failed.update([
+                        path for path, _, _ in subdirs if path not in made])
+            pool.join()
+        finally:
+            scanner.close()
+            pool.close()
+
+        # Children changed mtime of their parents. Only directories which the
+        # walk made are restored, so excluded ones and those under mount
+        # points are not looked at again.
+        for path, st in reversed(dirs):
+            try:
+                self._restore_meta_data(dest + path, path, st)
+            except OSError, e:
+                self._print_error("error: Can't change status of the di"\
+                    "rectory %(path)r (%(desc)s)." \
+                        % dict(path=dest + path, desc=e.strerror))
+
+    def _link_file(self, dest, src, st):
+        to = self._make_link(dest, src)
+        self._restore_meta_data(dest, src, st)
+        return make_record(basename(src), st, target=to)
 
     def _copy_recursively(self, dest, src):
-        def _file_func(prev, dest, src):
-            st = os.lstat(src)
-            if stat.S_ISREG(st.st_mode):
-                self._copy(dest, src)
-            elif islink(src):
-                self._make_link(dest, src)
+        self._walk_to_copy(None, dest, src)
 
-        self._walk_to_copy(None, dest, src, _file_func)
+    def _add_version(self, dest, src, st, digest):
+        # A file which is not linked from the previous snapshot starts a
+        # version.
+        if self._catalog is None:
+            return
+        try:
+            ino = os.lstat(dest).st_ino
+        except OSError:
+            self._catalog.end(src)
+            return
+        self._catalog.add(src, ino, st.st_size, st.st_mtime, digest)
 
-    def _copy_incrementally(self, prev, dest, src):
-        def _file_func(prev, dest, src):
-            st = os.lstat(src)
-            if stat.S_ISREG(st.st_mode):
-                if self._is_same_file(src, prev):
-                    self._link(dest, prev)
-                else:
-                    self._copy(dest, src)
-            elif islink(src):
-                self._make_link(dest, src)
-
-        self._walk_to_copy(prev, dest, src, _file_func)
+    def _end_versions(self, dirpath, subdirs, files, prev_records):
+        # Versions of files which are not in the snapshot any more end.
+        if self._catalog is None:
+            return
+        dirs = set([basename(path) for path, _, _ in subdirs])
+        regular_files = set([
+            name for name, st in files if stat.S_ISREG(st.st_mode)])
+        for name, record in prev_records:
+            if record is _UNRECORDED:
+                return
+            if stat.S_ISDIR(record.mode):
+                if name not in dirs:
+                    self._catalog.end_tree(join(dirpath, name))
+            elif stat.S_ISREG(record.mode):
+                if name not in regular_files:
+                    self._catalog.end(join(dirpath, name))
 
-    def _do(self, prev_dir, backup_dir, src):
-        self._print_debug(
-            "backup from %(src)s to %(dest)s." % dict(src=src, dest=backup_dir))
-        src = abspath(src)
+    def _choose_codec(self, src, st):
+        if self._policy is None:
+            return None
+        return self._policy.choose(src, st)
+
+    def _link_or_copy(self, state, prev, dest, src, st, prev_record):
+        """Returns the digest of dest and its codec, or _FAILED. A failed file
+        is not in the snapshot, so its version ends."""
+        codec = self._choose_codec(src, st)
+        if (state == _UNSURE) and (codec == BLOCKS):
+            # Storing reads src once, and writes only changed blocks.
+            digest = self._copy_file(dest, src, st, codec)
+            if digest is _FAILED:
+                self._add_version(dest, src, st, None)
+                return _FAILED
+            if digest != prev_record.digest:
+                self._add_version(dest, src, st, digest)
+                return digest, codec
+            # Unchanged files share the list too.
+            os.unlink(dest)
+            state = _SAME
+        elif state == _UNSURE:
+            if (codec is None) and (prev_record.codec is None):
+                # Reads src once for both comparing and copying.
+                state = self._compare_and_copy(dest, src, prev, st)
+                if state == _FAILED:
+                    self._add_version(dest, src, st, None)
+                    return _FAILED
+                if state == _CHANGED:
+                    self._add_version(dest, src, st, None)
+                    return None, None
+            else:
+                state = self._compare_digest(prev, src, st, prev_record)
+        if state == _SAME:
+            try:
+                self._link(dest, prev)
+                if prev_record is None:
+                    return None, None
+                return prev_record.digest, prev_record.codec
+            except OSError, e:
+                self._print_debug(
+                    "can't link %(path)s (%(desc)s).",
+                        path=prev, desc=e.strerror)
+        digest = self._copy_file(dest, src, st, codec)
+        if digest is _FAILED:
+            self._add_version(dest, src, st, None)
+            return _FAILED
+        self._add_version(dest, src, st, digest)
+        return digest, codec
 
+    def _copy_incrementally(self, prev, dest, src):
+        self._walk_to_copy(prev, dest, src)
+
+    def _make_ancestors(self, backup_dir, src):
         dest_dir = backup_dir + src
-        self._print_debug("makedirs: %(dir)s" % dict(dir=dest_dir))
-        makedirs(dest_dir)
+        if not isdir(dest_dir):
+            self._print_debug("makedirs: %(dir)s", dir=dest_dir)
+            makedirs(dest_dir)
 
         dir = src
         while dir != "/":
@@ -232,14 +1083,99 @@ class Pydumpfs(object):
             self._copystat(path, dir)
             dir = dirname(dir)
 
+    def _copy_tree(self, prev_dir, backup_dir, src):
         if prev_dir is None:
             self._copy_recursively(backup_dir, src)
             return
         self._copy_incrementally(prev_dir, backup_dir, src)
 
-def remove_backups(dir_, days):
+    def _do(self, prev_dir, backup_dir, src):
+        self._print_debug(
+            "backup from %(src)s to %(dest)s.", src=src, dest=backup_dir)
+        src = abspath(src)
+        self._make_ancestors(backup_dir, src)
+        self._copy_tree(prev_dir, backup_dir, src)
+
+    def _group_by_device(self, src):
+        groups = {}
+        devs = []
+        for path in src:
+            dev = os.stat(path).st_dev
+            if dev not in groups:
+                groups[dev] = []
+                devs.append(dev)
+            groups[dev].append(path)
+        return [groups[dev] for dev in devs]
+
+    def _copy_trees(self, prev_dir, backup_dir, src):
+        for path in src:
+            self._copy_tree(prev_dir, backup_dir, path)
+
+    def _do_in_parallel(self, prev_dir, backup_dir, src):
+        # Sources on one device are copied in turn, so each device is read by
+        # one walk at a time. Parents in the snapshot are made beforehand,
+        # because sources may share them.
+        src = [abspath(path) for path in src]
+        for path in src:
+            self._print_debug(
+                "backup from %(src)s to %(dest)s.", src=path, dest=backup_dir)
+            self._make_ancestors(backup_dir, path)
+
+        groups = self._group_by_device(src)
+        pool = WorkerPool(len(groups))
+        try:
+            for group in groups:
+                pool.submit(self._copy_trees, (prev_dir, backup_dir, group))
+            pool.join()
+        finally:
+            pool.close()
+
+def remove_backups(dir_, days, jobs=1, empty=True, stats=None,
+                   throttle=None):
+    """Moves backups older than days to the trash, and empties the trash if
+    empty is true. Returns bytes freed, or None if the trash is being emptied
+    by another process. Counts and time are added to stats if it is given.
+    Removals are taken from throttle if it is given.
+    """
+    if stats is None:
+        stats = RunStats()
+    if throttle is not None:
+        throttle.stats = stats
+        throttle.watch(dir_)
+    start = time()
+    try:
+        freed = _remove_backups(dir_, days, jobs, empty, stats, throttle)
+    finally:
+        stats.add_time("prune", start)
+    stats.add("freed_bytes", freed or 0)
+    return freed
+
+def _remove_backups(dir_, days, jobs, empty, stats, throttle):
+    catalog = Catalog(dir_)
+    try:
+        catalog.sync()
+        moved = _move_backups(dir_, days, catalog, stats)
+    finally:
+        catalog.close()
+
+    collected = 0
+    if moved:
+        # Blocks listed only by removed snapshots are not needed.
+        collected = collect_garbage(dir_, throttle)
+    if not empty:
+        return collected
+    freed = empty_trash(dir_, jobs, throttle)
+    if freed is None:
+        return None
+    return freed + collected
+
+def get_old_backups(dir_, days):
+    """Returns names of backups older than days, which remove_backups()
+    removes. Snapshots of failed backups are not in the catalog, but are
+    removed too."""
     oldest = datetime.now() - timedelta(days)
-    for name in listdir(dir_):
+    names = []
+    for name in sorted(listdir(dir_)):
         m = match(r"(?P<year>\d{4})-(?P<month>\d{2})-(?P<day>\d{2})_(?P<hour>\d{2}):(?P<minute>\d{2}):(?P<second>\d{2})\.(?P<millisecond>\d{3})", name)
         if not m:
             continue
@@ -253,6 +1189,23 @@ def remove_backups(dir_, days):
             1000 * int(m.group("millisecond")))
         if oldest < timestamp:
             continue
-        rmtree(join(dir_, name))
+        names.append(name)
+    return names
+
+def _move_backups(dir_, days, catalog, stats):
+    names = get_old_backups(dir_, days)
+    if names and exists(get_digests_path(dir_)):
+        kept = [name for name in listdir(dir_)
+            if is_snapshot_name(name) and (name not in names)]
+        digests = DigestIndex(dir_)
+        try:
+            digests.remove_snapshots(names, kept)
+        finally:
+            digests.close()
+    for name in names:
+        move_to_trash(dir_, name)
+        catalog.remove(name)
+        stats.add("pruned")
+    return len(names)
 
 # vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
@@ -0,0 +1,480 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of backup and prune paths on synthetic trees, and of cutting
+files into chunks.
+
+Run this module as a script to get a JSON report::
+
+  $ PYTHONPATH=src python src/pydumpfs/benchmarks/__init__.py --preset=tiny
+  $ PYTHONPATH=src python src/pydumpfs/benchmarks/__init__.py --chunker
+"""
+
+from getopt import getopt
+from os import makedirs
+from os.path import join
+from random import Random
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import sleep, time
+import json
+import os
+import resource
+import sys
+
+PRESETS = {
+    "tiny": dict(files=100000, depth=3, width=10, max_size=4096),
+    "huge": dict(files=4, huge_files=4, huge_size=1024 * 1024 * 1024),
+    "deep": dict(files=10000, depth=32, width=1),
+    "wide": dict(files=100000, depth=1, width=1),
+    "mixed": dict(
+        files=50000, depth=4, width=6, huge_files=2,
+        huge_size=256 * 1024 * 1024, symlinks=1000, sparse_files=4),
+    "smoke": dict(
+        files=50, depth=2, width=2, huge_files=1, huge_size=1024 * 1024,
+        symlinks=5, sparse_files=1, sparse_size=16 * 1024 * 1024),
+    }
+
+# Functions of os counted as system calls, also where modules of pydumpfs
+# imported them by name. The builtin open() is counted as "open".
+COUNTED_FUNCS = [
+    "chmod", "close", "fstat", "lchown", "link", "listdir", "lseek", "lstat",
+    "mkdir", "open", "read", "readlink", "rename", "rmdir", "stat", "symlink",
+    "unlink", "utime", "write"]
+# Functions of modules of pydumpfs calling system calls through ctypes, and
+# names which they are counted as.
+COUNTED_WRAPPERS = [
+    ("pydumpfs.prune", "_openat", "openat"),
+    ("pydumpfs.prune", "_unlinkat", "unlinkat")]
+# Calls which are not seen by SyscallCounter.
+UNCOUNTED_CALLS = [
+    "reads and writes of file objects", "calls of sqlite3",
+    "copies in the kernel through ctypes"]
+
+BUFFER_SIZE = 1024 * 1024
+CHUNKER_SIZE = 256 * 1024 * 1024
+
+class TreeSpec(object):
+
+    def __init__(self, files=1000, depth=2, width=4, max_size=16384,
+                 huge_files=0, huge_size=64 * 1024 * 1024, symlinks=0,
+                 sparse_files=0, sparse_size=256 * 1024 * 1024, churn=0.01,
+                 seed=0):
+        self.files = files
+        self.depth = depth
+        self.width = width
+        self.max_size = max_size
+        self.huge_files = huge_files
+        self.huge_size = huge_size
+        self.symlinks = symlinks
+        self.sparse_files = sparse_files
+        self.sparse_size = sparse_size
+        self.churn = churn
+        self.seed = seed
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+class TreeGenerator(object):
+    """Makes same trees for same specs."""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.rng = Random(spec.seed)
+        self.buffer = "".join(
+            [chr(self.rng.randint(0, 255)) for _ in range(BUFFER_SIZE)])
+        self.serial = 0
+
+    def _make_dirs(self, root):
+        dirs = [root]
+        level = [root]
+        for depth in range(self.spec.depth):
+            next_level = []
+            for dir_ in level:
+                for i in range(self.spec.width):
+                    path = join(dir_, "d%(depth)d_%(i)d" % locals())
+                    makedirs(path)
+                    next_level.append(path)
+            dirs.extend(next_level)
+            level = next_level
+        return dirs
+
+    def _get_data(self, size):
+        offset = self.rng.randint(0, BUFFER_SIZE - 1)
+        data = self.buffer[offset:offset + size]
+        return data + self.buffer[:size - len(data)]
+
+    def _write_file(self, path, size):
+        file = open(path, "wb")
+        try:
+            while 0 < size:
+                data = self._get_data(min(size, BUFFER_SIZE))
+                file.write(data)
+                size -= len(data)
+        finally:
+            file.close()
+
+    def _write_sparse_file(self, path):
+        file = open(path, "wb")
+        try:
+            step = max(self.spec.sparse_size // 16, 1)
+            for offset in range(0, self.spec.sparse_size, step):
+                file.seek(offset)
+                file.write(self._get_data(4096))
+            file.truncate(self.spec.sparse_size)
+        finally:
+            file.close()
+
+    def _next_name(self, prefix):
+        self.serial += 1
+        return "%(prefix)s%(serial)d" % dict(prefix=prefix, serial=self.serial)
+
+    def _add_file(self, dirs):
+        path = join(self.rng.choice(dirs), self._next_name("f"))
+        self._write_file(path, self.rng.randint(0, self.spec.max_size))
+        return path
+
+    def generate(self, root):
+        """Makes a tree under root. Returns paths of regular files."""
+        dirs = self._make_dirs(root)
+        files = [self._add_file(dirs) for _ in range(self.spec.files)]
+        for _ in range(self.spec.huge_files):
+            path = join(self.rng.choice(dirs), self._next_name("h"))
+            self._write_file(path, self.spec.huge_size)
+            files.append(path)
+        for _ in range(self.spec.sparse_files):
+            path = join(self.rng.choice(dirs), self._next_name("s"))
+            self._write_sparse_file(path)
+            files.append(path)
+        for _ in range(self.spec.symlinks):
+            path = join(self.rng.choice(dirs), self._next_name("l"))
+            os.symlink(self.rng.choice(files), path)
+        self.dirs = dirs
+        return files
+
+    def churn(self, files):
+        """Modifies, removes and adds files at the churn rate of the spec.
+        Returns new paths of regular files."""
+        count = int(len(files) * self.spec.churn)
+        changed = self.rng.sample(files, count)
+        removed = set(changed[:count // 4])
+        for path in changed[count // 4:]:
+            file = open(path, "ab")
+            try:
+                file.write(self._get_data(self.rng.randint(1, 4096)))
+            finally:
+                file.close()
+        for path in removed:
+            os.remove(path)
+        files = [path for path in files if path not in removed]
+        files.extend([self._add_file(self.dirs) for _ in range(count // 4)])
+        return files
+
+def _get_pydumpfs_modules():
+    return [module for name, module in sys.modules.items()
+        if (module is not None)
+            and ((name == "pydumpfs") or name.startswith("pydumpfs."))]
+
+class SyscallCounter(object):
+    """Counts calls of COUNTED_FUNCS and COUNTED_WRAPPERS. A module of
+    pydumpfs which did "from os import listdir" has its own binding, which is
+    replaced too.
+
+    Processes forked by multiprocessing, like workers of pruning, count their
+    own calls, and save them to a temporary directory when they exit.
+    uninstall() adds them up.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self.origs = []
+        self.dir = None
+
+    def _wrap(self, name, func):
+        def counter(*args, **kwargs):
+            self.counts[name] = self.counts.get(name, 0) + 1
+            return func(*args, **kwargs)
+        return counter
+
+    def _patch(self, obj, name, func):
+        self.origs.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, func)
+
+    def _start_worker(self):
+        from multiprocessing.util import Finalize
+        if self.dir is None:
+            return
+        self.counts = {}
+        Finalize(None, self._save, exitpriority=0)
+
+    def _save(self):
+        # Calls made here are not counted.
+        data = json.dumps(self.counts)
+        file = open(join(self.dir, str(os.getpid())), "w")
+        try:
+            file.write(data)
+        finally:
+            file.close()
+
+    def _add_workers(self):
+        for name in os.listdir(self.dir):
+            file = open(join(self.dir, name))
+            try:
+                counts = json.load(file)
+            finally:
+                file.close()
+            for syscall, n in counts.items():
+                syscall = str(syscall)
+                self.counts[syscall] = self.counts.get(syscall, 0) + n
+
+    def install(self):
+        import __builtin__
+        from multiprocessing.util import register_after_fork
+        self.dir = mkdtemp(prefix="pydumpfs_syscalls")
+        register_after_fork(self, SyscallCounter._start_worker)
+        modules = _get_pydumpfs_modules()
+        for name in COUNTED_FUNCS:
+            func = getattr(os, name, None)
+            if func is None:
+                continue
+            counter = self._wrap(name, func)
+            self._patch(os, name, counter)
+            for module in modules:
+                if getattr(module, name, None) is func:
+                    self._patch(module, name, counter)
+        self._patch(__builtin__, "open", self._wrap("open", __builtin__.open))
+        for module_name, name, syscall in COUNTED_WRAPPERS:
+            module = __import__(module_name, fromlist=[name])
+            self._patch(
+                module, name, self._wrap(syscall, getattr(module, name)))
+
+    def uninstall(self):
+        for obj, name, func in reversed(self.origs):
+            setattr(obj, name, func)
+        self.origs = []
+        try:
+            self._add_workers()
+        finally:
+            rmtree(self.dir)
+            self.dir = None
+
+def read_io_counters():
+    """Returns I/O counters of this process from /proc/self/io, or rusage
+    block counts where it isn't available."""
+    try:
+        file = open("/proc/self/io")
+    except IOError:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return dict(read_blocks=usage.ru_inblock, write_blocks=usage.ru_oublock)
+    try:
+        counters = {}
+        for line in file:
+            name, value = line.split(":")
+            counters[name.strip()] = int(value)
+        return counters
+    finally:
+        file.close()
+
+def measure(func, *args):
+    """Runs func in a child process, so that peak RSS and counters of each
+    phase are its own. Returns a dict of the results."""
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        status = 1
+        try:
+            counter = SyscallCounter()
+            io = read_io_counters()
+            start = time()
+            counter.install()
+            try:
+                func(*args)
+            finally:
+                counter.uninstall()
+            wall = time() - start
+            io_end = read_io_counters()
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            children = resource.getrusage(resource.RUSAGE_CHILDREN)
+            result = dict(
+                wall=wall,
+                io=dict([
+                    (name, io_end[name] - io[name]) for name in io_end]),
+                syscalls=counter.counts,
+                syscalls_total=sum(counter.counts.values()),
+                syscalls_counted=COUNTED_FUNCS,
+                syscalls_not_counted=UNCOUNTED_CALLS,
+                max_rss_kb=max(usage.ru_maxrss, children.ru_maxrss),
+                user=usage.ru_utime + children.ru_utime,
+                system=usage.ru_stime + children.ru_stime)
+            os.write(write_fd, json.dumps(result))
+            status = 0
+        finally:
+            os._exit(status)
+
+    os.close(write_fd)
+    chunks = []
+    while True:
+        data = os.read(read_fd, 65536)
+        if not data:
+            break
+        chunks.append(data)
+    os.close(read_fd)
+    _, status = os.waitpid(pid, 0)
+    if status != 0:
+        raise RuntimeError("The benchmark process failed.")
+    return json.loads("".join(chunks))
+
+def _backup(dest, src, options):
+    from pydumpfs import Pydumpfs
+    Pydumpfs(**options).do(dest, src)
+
+def _prune(dest, jobs):
+    from pydumpfs import remove_backups
+    remove_backups(dest, -1, jobs)
+
+def run(spec, work_dir=None, options=None, settle=1):
+    """Times a full backup, an incremental backup after churn, and pruning of
+    all backups. Returns a report as a dict.
+
+    Files changed in the second when a backup starts are compared by their
+    contents in the next backup. The benchmark waits settle seconds after
+    changing the tree so that it measures the usual case.
+    """
+    options = options or {}
+    root = mkdtemp(prefix="pydumpfs_bench", dir=work_dir)
+    try:
+        src = join(root, "src")
+        dest = join(root, "dest")
+        makedirs(src)
+        makedirs(dest)
+
+        generator = TreeGenerator(spec)
+        files = generator.generate(src)
+        sleep(settle)
+        phases = {}
+        phases["full"] = measure(_backup, dest, src, options)
+        generator.churn(files)
+        sleep(settle)
+        phases["incremental"] = measure(_backup, dest, src, options)
+        from pydumpfs import glob_backups
+        snapshots = len(glob_backups(dest))
+        phases["prune"] = measure(_prune, dest, options.get("jobs", 1))
+        return dict(
+            spec=spec.to_dict(), options=options, snapshots=snapshots,
+            phases=phases)
+    finally:
+        rmtree(root)
+
+def run_chunker(size=CHUNKER_SIZE, chunk_size=None, work_dir=None, seed=0):
+    """Times cutting a file of size random bytes into chunks. Returns a
+    report as a dict."""
+    from pydumpfs.blocks import DEFAULT_CHUNK_SIZE, Chunker
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    generator = TreeGenerator(TreeSpec(seed=seed))
+    root = mkdtemp(prefix="pydumpfs_bench", dir=work_dir)
+    try:
+        path = join(root, "chunked")
+        generator._write_file(path, size)
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            chunks = 0
+            start = time()
+            for _ in Chunker(chunk_size).split(fd):
+                chunks += 1
+            wall = time() - start
+        finally:
+            os.close(fd)
+    finally:
+        rmtree(root)
+    return dict(
+        size=size, chunk_size=chunk_size, chunks=chunks, wall=wall,
+        average_chunk=size // max(chunks, 1),
+        bytes_per_second=size / max(wall, 1e-9))
+
+def help():
+    from os.path import basename
+    name = basename(sys.argv[0])
+    print """Usage: %(name)s [options]
+options:
+    --preset=NAME:     start from a preset (%(presets)s).
+    --files=N:         number of small files.
+    --depth=N:         depth of directories.
+    --width=N:         subdirectories per directory.
+    --max-size=N:      maximum size of small files.
+    --huge-files=N:    number of huge files.
+    --huge-size=N:     size of huge files.
+    --symlinks=N:      number of symbolic links.
+    --sparse-files=N:  number of sparse files.
+    --sparse-size=N:   apparent size of sparse files.
+    --churn=RATE:      rate of files changed before the incremental backup.
+    --seed=N:          seed of the random generator.
+    --jobs=N:          jobs option of pydumpfs.
+    --dedup:           enable deduplication.
+    --chunker:         time cutting a file into chunks instead.
+    --chunk-size=N:    chunker: average size of chunks.
+    --chunker-size=N:  chunker: size of the file.
+    --work-dir=DIR:    directory to make trees in.
+    --output=PATH:     write the report to PATH instead of stdout.
+    -h, --help:        print this message.""" % dict(
+        name=name, presets=", ".join(sorted(PRESETS.keys())))
+    sys.exit(0)
+
+def main(argv):
+    int_options = [
+        "files", "depth", "width", "max-size", "huge-files", "huge-size",
+        "symlinks", "sparse-files", "sparse-size", "seed", "chunk-size",
+        "chunker-size"]
+    long_options = ["%(name)s=" % dict(name=name) for name in int_options]
+    long_options.extend([
+        "preset=", "churn=", "jobs=", "dedup", "chunker", "work-dir=",
+        "output=", "help"])
+    options, args = getopt(argv, "h", long_options)
+
+    params = {}
+    pydumpfs_options = {}
+    work_dir = None
+    output = None
+    chunker = False
+    for option, value in options:
+        if option == "--preset":
+            params.update(PRESETS[value])
+    for option, value in options:
+        name = option.lstrip("-")
+        if name in ("h", "help"):
+            help()
+        elif name in int_options:
+            params[name.replace("-", "_")] = int(value)
+        elif name == "churn":
+            params["churn"] = float(value)
+        elif name == "jobs":
+            pydumpfs_options["jobs"] = int(value)
+        elif name == "dedup":
+            pydumpfs_options["dedup"] = True
+        elif name == "chunker":
+            chunker = True
+        elif name == "work-dir":
+            work_dir = value
+        elif name == "output":
+            output = value
+
+    if chunker:
+        report = run_chunker(
+            params.get("chunker_size", CHUNKER_SIZE),
+            params.get("chunk_size"), work_dir, params.get("seed", 0))
+    else:
+        params.pop("chunk_size", None)
+        params.pop("chunker_size", None)
+        report = run(TreeSpec(**params), work_dir, pydumpfs_options)
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if output is None:
+        print data
+        return
+    file = open(output, "w")
+    try:
+        print >> file, data
+    finally:
+        file.close()
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
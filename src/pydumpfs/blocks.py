@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""Large files stored as lists of blocks.
+
+A file stored with the codec "blocks" is a list of digests and lengths of
+its blocks in the snapshot. Blocks are kept once in a store under dest, named
+by their digests. A new version of a file writes only blocks which the store
+doesn't have, which are those changed since the previous version when the
+file is changed in place, so the store grows with changes, not with sizes.
+
+Blocks which no snapshot lists any more are removed by collect_garbage().
+Backups storing blocks hold a shared lock of the store, and garbage is
+collected only when no backup holds it. Lists are found from manifests, so
+a block listed only in a directory which an interrupted backup didn't finish
+may be removed. Resuming backups store such files again.
+
+Blocks are of a fixed size, or are cut by their contents with a Chunker.
+Cut points of content-defined chunks depend only on bytes near them, so
+data inserted into a file or appended to it changes only the chunks around
+it, and files with common parts share chunks. Cutting costs more CPU than
+copying, so only files of DEFAULT_CHUNKED_MIN_SIZE or more are cut unless
+told otherwise.
+"""
+
+from binascii import hexlify
+from hashlib import sha256
+from os import listdir, makedirs
+from os.path import dirname, exists, isdir, join
+from pydumpfs.catalog import find_snapshot, is_snapshot_name
+from pydumpfs.checkpoint import get_checkpoint_path
+from pydumpfs.manifest import ManifestReader, get_manifest_path, \
+    get_metadata_dir
+from tempfile import mkstemp
+import errno
+import marshal
+import os
+import stat
+
+BLOCKS = "blocks"
+STORE_NAME = "blocks"
+LOCK_NAME = "lock"
+LIST_VERSION = 1
+DEFAULT_BLOCK_SIZE = 256 * 1024
+DEFAULT_CHUNK_SIZE = 64 * 1024
+DEFAULT_CHUNKED_MIN_SIZE = 8 * 1024 * 1024
+READ_SIZE = 4 * 1024 * 1024
+BLOCK_BYTES = 512
+
+def _make_bit_table():
+    # Half of the bytes, chosen at random but same in every run, are "1".
+    order = sorted(range(256), key=lambda i: sha256(chr(i)).digest())
+    bits = ["0"] * 256
+    for i in order[128:]:
+        bits[i] = "1"
+    return "".join(bits)
+
+BIT_TABLE = _make_bit_table()
+
+def get_store_dir(dest):
+    return join(get_metadata_dir(dest), STORE_NAME)
+
+def _write(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def _read_full(fd, size):
+    chunks = []
+    while 0 < size:
+        data = os.read(fd, size)
+        if not data:
+            break
+        chunks.append(data)
+        size -= len(data)
+    return "".join(chunks)
+
+def _split_blocks(fd, block_size):
+    while True:
+        data = _read_full(fd, block_size)
+        if not data:
+            return
+        yield data
+
+class Chunker(object):
+    """Cuts content into chunks of about size bytes.
+
+    Each byte is mapped to a bit by a random table, and a chunk ends where
+    the bits of the last n bytes are n / 2 zeros followed by n / 2 ones,
+    which happens once in about 2 ** n bytes of random data. The pattern
+    can't overlap itself, and a run of one byte never matches it. A chunk
+    also ends at four times size, and the first quarter of size is not
+    searched, which bounds small chunks.
+
+    Mapping and searching are done by str.translate() and str.find() in C,
+    so the Python loop runs once for each chunk, not for each byte.
+    """
+
+    def __init__(self, size=DEFAULT_CHUNK_SIZE):
+        self.min_size = size // 4
+        self.max_size = size * 4
+        n = max(2, size.bit_length() - 1)
+        self.pattern = "0" * (n // 2) + "1" * (n - n // 2)
+
+    def _find_end(self, bits, start, end):
+        limit = min(end, start + self.max_size)
+        first = start + self.min_size - len(self.pattern)
+        if limit <= first + len(self.pattern):
+            return limit
+        i = bits.find(self.pattern, max(start, first), limit)
+        if i < 0:
+            return limit
+        return i + len(self.pattern)
+
+    def split(self, fd):
+        """Yields chunks of the content of fd."""
+        buf = bytearray()
+        bits = bytearray()
+        pos = 0
+        eof = False
+        while True:
+            if (not eof) and (len(buf) - pos < self.max_size):
+                del buf[:pos]
+                del bits[:pos]
+                pos = 0
+                data = _read_full(fd, READ_SIZE)
+                eof = len(data) < READ_SIZE
+                buf.extend(data)
+                bits.extend(data.translate(BIT_TABLE))
+            if len(buf) <= pos:
+                return
+            end = self._find_end(bits, pos, len(buf))
+            yield str(buf[pos:end])
+            pos = end
+
+def _open_lock(dir_):
+    return os.open(join(dir_, LOCK_NAME), os.O_WRONLY | os.O_CREAT, 0600)
+
+class BlockStore(object):
+    """Blocks under dest. A backup opens the store, which is locked until
+    it is closed. Workers may store files at once. Files are cut by the
+    chunker if it is given, or into blocks of block_size. Bytes read and
+    blocks written are taken from throttle if it is given."""
+
+    def __init__(self, dest, block_size=DEFAULT_BLOCK_SIZE, chunker=None,
+                 throttle=None):
+        import fcntl
+        self.dir = get_store_dir(dest)
+        self.block_size = block_size
+        self.chunker = chunker
+        self.throttle = throttle
+        if not exists(self.dir):
+            makedirs(self.dir)
+        self.lock = _open_lock(self.dir)
+        fcntl.flock(self.lock, fcntl.LOCK_SH)
+
+    def get_path(self, digest):
+        name = hexlify(digest)
+        return join(self.dir, name[:2], name)
+
+    def _put(self, digest, data):
+        """Writes a block unless the store has it. Returns True if written.
+        """
+        path = self.get_path(digest)
+        if exists(path):
+            return False
+        dir_ = dirname(path)
+        try:
+            os.mkdir(dir_)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        if self.throttle is not None:
+            self.throttle.op()
+            self.throttle.write(len(data))
+        # A block is complete when it has its name.
+        fd, tmp_path = mkstemp(dir=dir_)
+        try:
+            _write(fd, data)
+        finally:
+            os.close(fd)
+        os.rename(tmp_path, path)
+        return True
+
+    def store(self, src_fd, dest):
+        """Writes the list of blocks of src_fd to dest. Returns the digest
+        of the content, blocks written and bytes written."""
+        h = sha256()
+        entries = []
+        size = 0
+        blocks = 0
+        written = 0
+        if self.chunker is None:
+            blocks_of_src = _split_blocks(src_fd, self.block_size)
+        else:
+            blocks_of_src = self.chunker.split(src_fd)
+        for data in blocks_of_src:
+            if self.throttle is not None:
+                self.throttle.read(len(data))
+            h.update(data)
+            digest = sha256(data).digest()
+            if self._put(digest, data):
+                blocks += 1
+                written += len(data)
+            entries.append((digest, len(data)))
+            size += len(data)
+        written += write_list(dest, size, entries)
+        return h.hexdigest(), blocks, written
+
+    def close(self):
+        os.close(self.lock)
+
+def write_list(path, size, entries):
+    """Writes a list of (digest, length) of blocks. Returns bytes written."""
+    data = marshal.dumps((LIST_VERSION, size, entries))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+    try:
+        _write(fd, data)
+    finally:
+        os.close(fd)
+    return len(data)
+
+def read_list(path):
+    """Returns the size and the list of (digest, length) of blocks."""
+    file = open(path, "rb")
+    try:
+        try:
+            version, size, entries = marshal.load(file)
+        except (EOFError, ValueError, TypeError):
+            version = None
+    finally:
+        file.close()
+    if version != LIST_VERSION:
+        raise IOError(errno.EIO, "%(path)r is not a list of blocks." % dict(
+            path=path))
+    return size, entries
+
+class BlockReader(object):
+    """Reads blocks of a file in a snapshot. The store is that of the
+    destination which the snapshot is in."""
+
+    def __init__(self, path):
+        root = find_snapshot(path)
+        if root is None:
+            raise IOError(errno.ENOENT, "%(path)r is not in a snapshot." \
+                % dict(path=path))
+        self.dir = get_store_dir(dirname(root))
+        _, self.entries = read_list(path)
+        self.index = 0
+
+    def read_block(self):
+        """Returns the next block, or None at the end."""
+        if len(self.entries) <= self.index:
+            return None
+        digest, _ = self.entries[self.index]
+        self.index += 1
+        name = hexlify(digest)
+        file = open(join(self.dir, name[:2], name), "rb")
+        try:
+            return file.read()
+        finally:
+            file.close()
+
+def _list_blocks(snapshot_dir, manifest, listed, inodes):
+    for dirpath in manifest.offsets:
+        for record in manifest.list_dir(dirpath):
+            if (record.codec != BLOCKS) or (not stat.S_ISREG(record.mode)):
+                continue
+            path = snapshot_dir + join(dirpath, record.name)
+            try:
+                st = os.lstat(path)
+                # Snapshots share lists of unchanged files by hard links.
+                if st.st_ino in inodes:
+                    continue
+                inodes.add(st.st_ino)
+                _, entries = read_list(path)
+            except (IOError, OSError):
+                continue
+            listed.update([hexlify(digest) for digest, _ in entries])
+
+def _find_listed(dest):
+    listed = set()
+    inodes = set()
+    for name in listdir(dest):
+        if not is_snapshot_name(name):
+            continue
+        snapshot_dir = join(dest, name)
+        for path in [
+                get_manifest_path(snapshot_dir),
+                get_checkpoint_path(snapshot_dir)]:
+            try:
+                manifest = ManifestReader(path)
+            except IOError:
+                continue
+            try:
+                _list_blocks(snapshot_dir, manifest, listed, inodes)
+            finally:
+                manifest.close()
+    return listed
+
+def _lock_store(dir_):
+    import fcntl
+    fd = _open_lock(dir_)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        os.close(fd)
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return None
+    return fd
+
+def collect_garbage(dest, throttle=None):
+    """Removes blocks which no snapshot in dest lists. Returns bytes freed.
+    Nothing is removed while a backup is storing blocks. Removals are taken
+    from throttle if it is given."""
+    dir_ = get_store_dir(dest)
+    if not exists(dir_):
+        return 0
+    lock = _lock_store(dir_)
+    if lock is None:
+        return 0
+    try:
+        listed = _find_listed(dest)
+        freed = 0
+        for subdir in listdir(dir_):
+            subdir = join(dir_, subdir)
+            if not isdir(subdir):
+                continue
+            for name in listdir(subdir):
+                if name in listed:
+                    continue
+                # Temporary files of interrupted backups go too.
+                path = join(subdir, name)
+                if throttle is not None:
+                    throttle.op()
+                freed += os.lstat(path).st_blocks * BLOCK_BYTES
+                os.unlink(path)
+        return freed
+    finally:
+        os.close(lock)
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
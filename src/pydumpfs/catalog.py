@@ -0,0 +1,324 @@
+# -*- coding: utf-8 -*-
+"""Catalog of snapshots in a destination and of versions of files in them.
+
+A version is a regular file which snapshots share by hard links. It is made
+by the snapshot named created, and is in every snapshot before ended, or in
+all following ones while ended is NULL. A backup adds versions only for
+files which it copies, and ends versions of files which are gone, so the
+catalog grows with changes, not with snapshots.
+
+Names of snapshots sort in the order of time, so they are compared as
+strings.
+
+Changes of a backup are kept in the table pending, which is written in
+batches, each in a short transaction, and are applied to versions when the
+backup commits. Other processes, like one removing old backups, wait only
+for a batch.
+
+Digests are recorded for files which were copied with dedup, compressed or
+stored as blocks. Other versions get theirs from their files in snapshots
+when they are first looked up by a digest.
+"""
+
+from collections import namedtuple
+from os import listdir, makedirs
+from os.path import basename, dirname, exists, join
+from pydumpfs.dedup import compute_digest
+from pydumpfs.manifest import get_metadata_dir, open_manifest
+from re import match
+from threading import Lock
+import os
+import sqlite3
+import stat
+
+CATALOG_NAME = "catalog"
+# Seconds to wait for another process writing the catalog.
+BUSY_TIMEOUT = 60
+BATCH_SIZE = 1000
+ADD = "add"
+END = "end"
+END_TREE = "end_tree"
+NAME_PATTERN = r"\d{4}-\d{2}-\d{2}_\d{2}:\d{2}:\d{2}\.\d{3}$"
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS snapshots (
+    name TEXT PRIMARY KEY);
+CREATE TABLE IF NOT EXISTS versions (
+    path TEXT NOT NULL,
+    created TEXT NOT NULL,
+    ended TEXT,
+    ino INTEGER,
+    size INTEGER,
+    mtime INTEGER,
+    digest TEXT);
+CREATE INDEX IF NOT EXISTS versions_path ON versions (path, ended);
+CREATE INDEX IF NOT EXISTS versions_ino ON versions (ino);
+CREATE INDEX IF NOT EXISTS versions_digest ON versions (digest);
+CREATE TABLE IF NOT EXISTS pending (
+    snapshot TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    ino INTEGER,
+    size INTEGER,
+    mtime INTEGER,
+    digest TEXT);
+"""
+
+# Snapshots holding a version v.
+_HOLDING = """FROM versions v JOIN snapshots s
+    ON (v.created <= s.name) AND ((v.ended IS NULL) OR (s.name < v.ended))"""
+
+Version = namedtuple("Version", [
+    "first", "last", "ino", "size", "mtime", "digest"])
+
+def get_catalog_path(dest):
+    return join(get_metadata_dir(dest), CATALOG_NAME)
+
+def is_snapshot_name(name):
+    return match(NAME_PATTERN, name) is not None
+
+def find_snapshot(path):
+    """Returns the snapshot directory which path is in, or None."""
+    while path != "/":
+        if is_snapshot_name(basename(path)):
+            return path
+        path = dirname(path)
+    return None
+
+def _get_upper_bound(dirpath):
+    # Paths under dirpath are between "dirpath/" and "dirpath0".
+    return dirpath.rstrip("/") + "0"
+
+class Catalog(object):
+    """Snapshots and versions of files under dest.
+
+    A backup calls begin(), add() and end() for what it changed, and
+    commit() when the snapshot is complete. Nothing of a backup which
+    doesn't commit is applied, so an incomplete snapshot is never the latest
+    one. Workers may call add() and end() at once.
+    """
+
+    def __init__(self, dest):
+        self.dest = dest
+        dir_ = get_metadata_dir(dest)
+        if not exists(dir_):
+            makedirs(dir_)
+        self.lock = Lock()
+        self.name = None
+        self.pending = []
+        self.conn = sqlite3.connect(
+            get_catalog_path(dest), timeout=BUSY_TIMEOUT,
+            check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.executescript(SCHEMA)
+
+    def snapshots(self):
+        """Returns names of snapshots in the order of time."""
+        return [row[0] for row in self.conn.execute(
+            "SELECT name FROM snapshots ORDER BY name")]
+
+    def latest(self):
+        """Returns the name of the latest snapshot, or None."""
+        while True:
+            row = self.conn.execute(
+                "SELECT MAX(name) FROM snapshots").fetchone()
+            name = row[0]
+            if (name is None) or exists(join(self.dest, name)):
+                return name
+            # The snapshot was removed by hand.
+            self.remove(name)
+
+    def history(self, path):
+        """Returns Versions of a source path in the order of time."""
+        rows = self.conn.execute("""SELECT
+    MIN(s.name), MAX(s.name), v.ino, v.size, v.mtime, v.digest
+%(holding)s
+WHERE v.path = ?
+GROUP BY v.rowid
+ORDER BY MIN(s.name)""" % dict(holding=_HOLDING), (path,))
+        return [Version._make(row) for row in rows]
+
+    def _find_first(self, column, value):
+        row = self.conn.execute("""SELECT MIN(s.name)
+%(holding)s
+WHERE v.%(column)s = ?""" % dict(holding=_HOLDING, column=column),
+            (value,)).fetchone()
+        return row[0]
+
+    def first_with_digest(self, digest):
+        """Returns the name of the first snapshot which has a file of the
+        digest, or None. Versions without a digest before the first one
+        found get theirs from their files, and keep them."""
+        first = self._find_first("digest", digest)
+        rows = self.conn.execute("""SELECT v.rowid, v.path, v.ino, MIN(s.name)
+%(holding)s
+WHERE v.digest IS NULL
+GROUP BY v.rowid
+ORDER BY MIN(s.name)""" % dict(holding=_HOLDING)).fetchall()
+        try:
+            for rowid, path, ino, name in rows:
+                if (first is not None) and (first <= name):
+                    break
+                value = self._compute_digest(join(self.dest, name) + path, ino)
+                if value is None:
+                    continue
+                self.conn.execute(
+                    "UPDATE versions SET digest = ? WHERE rowid = ?",
+                    (value, rowid))
+                if value == digest:
+                    first = name
+                    break
+        finally:
+            self.conn.commit()
+        return first
+
+    def _compute_digest(self, path, ino):
+        # Files without digests are stored as they are.
+        try:
+            st = os.lstat(path)
+            if (not stat.S_ISREG(st.st_mode)) or (st.st_ino != ino):
+                return None
+            return compute_digest(path)
+        except (IOError, OSError):
+            return None
+
+    def first_with_inode(self, ino):
+        """Returns the name of the first snapshot which has the i-node, or
+        None. Snapshots share an i-node while a file doesn't change."""
+        return self._find_first("ino", ino)
+
+    def is_empty(self):
+        row = self.conn.execute("SELECT COUNT(*) FROM snapshots").fetchone()
+        return row[0] == 0
+
+    def sync(self):
+        """Adds snapshots made before the catalog. Files of the latest one
+        start versions, so that following backups can go on with them. Older
+        snapshots have no versions. Incomplete snapshots are left out."""
+        from pydumpfs.checkpoint import is_incomplete
+        if not self.is_empty():
+            return
+        names = sorted([name for name in listdir(self.dest)
+            if is_snapshot_name(name)
+                and (not is_incomplete(join(self.dest, name)))])
+        if not names:
+            return
+        self.conn.executemany(
+            "INSERT INTO snapshots VALUES (?)", [(name,) for name in names])
+        self._import(names[-1])
+        self.conn.commit()
+
+    def _import(self, name):
+        snapshot_dir = join(self.dest, name)
+        manifest = open_manifest(snapshot_dir)
+        if manifest is None:
+            return
+        try:
+            for dirpath in manifest.offsets:
+                for record in manifest.list_dir(dirpath):
+                    if not stat.S_ISREG(record.mode):
+                        continue
+                    path = join(dirpath, record.name)
+                    try:
+                        ino = os.lstat(snapshot_dir + path).st_ino
+                    except OSError:
+                        continue
+                    self.conn.execute(
+                        "INSERT INTO versions VALUES (?, ?, NULL, ?, ?, ?, ?)",
+                        (path, name, ino, record.size, record.mtime,
+                            record.digest))
+        finally:
+            manifest.close()
+
+    def begin(self, name):
+        """Starts a snapshot. Changes left by failed backups before it, or
+        by the interrupted backup which it resumes, are dropped."""
+        self.name = name
+        self.conn.execute("DELETE FROM pending WHERE snapshot <= ?", (name,))
+        self.conn.commit()
+
+    def _add_pending(self, kind, path, ino=None, size=None, mtime=None,
+                     digest=None):
+        self.lock.acquire()
+        try:
+            self.pending.append(
+                (self.name, kind, path, ino, size, mtime, digest))
+            if BATCH_SIZE <= len(self.pending):
+                self._flush()
+        finally:
+            self.lock.release()
+
+    def _flush(self):
+        self.conn.executemany(
+            "INSERT INTO pending VALUES (?, ?, ?, ?, ?, ?, ?)", self.pending)
+        self.conn.commit()
+        self.pending = []
+
+    def add(self, path, ino, size, mtime, digest):
+        """Starts a version of path in the snapshot being made. The version
+        which path had before ends."""
+        self._add_pending(ADD, path, ino, size, mtime, digest)
+
+    def end(self, path):
+        """Tells that path is not a regular file in the snapshot being made.
+        """
+        self._add_pending(END, path)
+
+    def end_tree(self, dirpath):
+        """Tells that files under dirpath are not in the snapshot being made.
+        """
+        self._add_pending(END_TREE, dirpath)
+
+    def _apply(self):
+        # Versions which the snapshot changed end. New ones are created in
+        # it, so they are left.
+        self.conn.execute("""UPDATE versions SET ended = ?
+WHERE (ended IS NULL) AND (created < ?) AND path IN (
+    SELECT path FROM pending
+    WHERE (snapshot = ?) AND (kind IN (?, ?)))""",
+            (self.name, self.name, self.name, ADD, END))
+        dirpaths = [row[0] for row in self.conn.execute(
+            "SELECT path FROM pending WHERE (snapshot = ?) AND (kind = ?)",
+            (self.name, END_TREE))]
+        for dirpath in dirpaths:
+            self.conn.execute("""UPDATE versions SET ended = ?
+WHERE (? < path) AND (path < ?) AND (ended IS NULL) AND (created < ?)""",
+                (self.name, dirpath.rstrip("/") + "/",
+                    _get_upper_bound(dirpath), self.name))
+        self.conn.execute("""INSERT INTO versions
+SELECT path, snapshot, NULL, ino, size, mtime, digest FROM pending
+WHERE (snapshot = ?) AND (kind = ?)""", (self.name, ADD))
+        self.conn.execute(
+            "DELETE FROM pending WHERE snapshot = ?", (self.name,))
+
+    def commit(self):
+        self.lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self.lock.release()
+        try:
+            self._apply()
+            self.conn.execute(
+                "INSERT INTO snapshots VALUES (?)", (self.name,))
+        except:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        self.name = None
+
+    def remove(self, name):
+        """Removes a snapshot, and versions which no snapshot has any more.
+        """
+        self.conn.execute("DELETE FROM snapshots WHERE name = ?", (name,))
+        row = self.conn.execute("SELECT MIN(name) FROM snapshots").fetchone()
+        if row[0] is None:
+            self.conn.execute("DELETE FROM versions")
+        else:
+            self.conn.execute(
+                "DELETE FROM versions WHERE ended <= ?", (row[0],))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
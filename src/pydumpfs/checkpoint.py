@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""Marks of snapshots being made, and checkpoints to resume them.
+
+A snapshot has a mark until its backup commits it to the catalog. A backup
+which finds a marked snapshot of the same sources and rules newer than the
+latest complete one resumes it instead of starting over.
+
+The manifest of an interrupted backup is its checkpoint. It has a block for
+each directory which the backup finished, and tells when the backup started.
+The resuming backup keeps a file if its size, mtime, mode and owner are same
+as those of the source, which the interrupted backup set only after copying
+the data, and if the source was not written after the backup started.
+Digests of kept files are taken from the checkpoint.
+"""
+
+from os import listdir
+from os.path import exists, join
+from pydumpfs.catalog import is_snapshot_name
+from pydumpfs.manifest import ManifestReader, get_manifest_path, \
+    get_metadata_dir
+import marshal
+import os
+
+MARK_NAME = "incomplete"
+CHECKPOINT_NAME = "checkpoint"
+MARK_VERSION = 1
+
+def get_mark_path(snapshot_dir):
+    return join(get_metadata_dir(snapshot_dir), MARK_NAME)
+
+def get_checkpoint_path(snapshot_dir):
+    return join(get_metadata_dir(snapshot_dir), CHECKPOINT_NAME)
+
+def is_incomplete(snapshot_dir):
+    return exists(get_mark_path(snapshot_dir))
+
+def mark_incomplete(snapshot_dir, src, key):
+    """Marks a snapshot of the sources by the rules of the key."""
+    file = open(get_mark_path(snapshot_dir), "wb")
+    try:
+        marshal.dump((MARK_VERSION, list(src), key), file)
+    finally:
+        file.close()
+
+def mark_complete(snapshot_dir):
+    paths = [get_checkpoint_path(snapshot_dir), get_mark_path(snapshot_dir)]
+    for path in paths:
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+def _read_mark(snapshot_dir):
+    try:
+        file = open(get_mark_path(snapshot_dir), "rb")
+    except IOError:
+        return None
+    try:
+        try:
+            data = marshal.load(file)
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        file.close()
+    if data[0] != MARK_VERSION:
+        return None
+    return list(data[1:])
+
+def find_interrupted(dest, latest, src, key):
+    """Returns the name of the newest snapshot newer than latest which a
+    backup of the sources by the rules of the key left incomplete, or None.
+    """
+    names = sorted([name for name in listdir(dest)
+        if is_snapshot_name(name) and ((latest is None) or (latest < name))])
+    for name in reversed(names):
+        mark = _read_mark(join(dest, name))
+        if mark is None:
+            continue
+        if mark == [list(src), key]:
+            return name
+        return None
+    return None
+
+def open_checkpoint(snapshot_dir):
+    """Moves the manifest of the interrupted backup aside, and returns a
+    ManifestReader of it, or None. A checkpoint left by a backup which was
+    interrupted before it made the manifest is used again."""
+    path = get_checkpoint_path(snapshot_dir)
+    manifest_path = get_manifest_path(snapshot_dir)
+    if exists(manifest_path):
+        os.rename(manifest_path, path)
+    try:
+        return ManifestReader(path)
+    except IOError:
+        return None
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
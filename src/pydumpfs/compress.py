@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -*-
+"""Files stored compressed in snapshots.
+
+A compressed file keeps its name, mode, owner and mtime, so it is linked to
+following snapshots while the source doesn't change, like other files. Its
+record in the manifest has the codec, and the size and the digest of the
+original content, which backups compare sources with. Readers of snapshots
+look up the codec to get the original content.
+
+A file stored with "gzip" can be read by gzip(1) too. Large files may be
+stored as lists of blocks, which pydumpfs.blocks has.
+"""
+
+from hashlib import sha256
+from os.path import splitext
+from pydumpfs.blocks import BLOCKS, BlockReader
+import bz2
+import errno
+import os
+import zlib
+
+BLOCK_SIZE = 1024 * 1024
+DEFAULT_CODEC = "gzip"
+DEFAULT_MIN_SIZE = 4096
+LEVEL = 6
+
+CODECS = {
+    "zlib": (
+        lambda: zlib.compressobj(LEVEL),
+        lambda: zlib.decompressobj()),
+    "gzip": (
+        lambda: zlib.compressobj(LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS),
+        lambda: zlib.decompressobj(16 + zlib.MAX_WBITS)),
+    "bz2": (
+        lambda: bz2.BZ2Compressor(),
+        lambda: bz2.BZ2Decompressor())}
+
+# Extensions of files which are compressed already.
+COMPRESSED_EXTENSIONS = [
+    ".7z", ".bz2", ".gz", ".jpeg", ".jpg", ".lz", ".lzma", ".mkv", ".mov",
+    ".mp3", ".mp4", ".ogg", ".png", ".rar", ".tgz", ".xz", ".zip", ".zst"]
+
+class Policy(object):
+    """Chooses files to compress.
+
+    Files of delta_min_size bytes or more are stored as lists of blocks.
+    Other files are compressed with codec unless it is None. Files smaller
+    than min_size are stored as they are. If extensions are given, only
+    files with them are compressed. Otherwise files with extensions of
+    compressed formats are left.
+    """
+
+    def __init__(self, codec=DEFAULT_CODEC, min_size=DEFAULT_MIN_SIZE,
+                 extensions=(), delta_min_size=None):
+        if (codec is not None) and (codec not in CODECS):
+            raise ValueError("Unknown codec: %(codec)r" % dict(codec=codec))
+        self.codec = codec
+        self.min_size = min_size
+        self.extensions = [ext.lower() for ext in extensions]
+        self.delta_min_size = delta_min_size
+
+    def choose(self, path, st):
+        """Returns the codec to store the file with, or None."""
+        if (self.delta_min_size is not None) \
+                and (self.delta_min_size <= st.st_size):
+            return BLOCKS
+        if (self.codec is None) or (st.st_size < self.min_size):
+            return None
+        ext = splitext(path)[1].lower()
+        if self.extensions:
+            if ext not in self.extensions:
+                return None
+        elif ext in COMPRESSED_EXTENSIONS:
+            return None
+        return self.codec
+
+    def get_key(self):
+        """Returns a string which differs when the policy stores files in
+        other ways."""
+        return "--compress=%(codec)s %(min_size)d %(extensions)s " \
+            "%(delta_min_size)s" % dict(
+                codec=self.codec, min_size=self.min_size,
+                extensions=",".join(self.extensions),
+                delta_min_size=self.delta_min_size)
+
+def _write(fd, data):
+    while data:
+        data = data[os.write(fd, data):]
+
+def compress(src_fd, dest_fd, codec, throttle=None):
+    """Writes the content of src_fd to dest_fd compressed. Returns the
+    digest of the content and bytes written. Bytes are taken from throttle
+    if it is given."""
+    h = sha256()
+    compressor = CODECS[codec][0]()
+    written = 0
+    while True:
+        data = os.read(src_fd, BLOCK_SIZE)
+        if not data:
+            break
+        h.update(data)
+        if throttle is not None:
+            throttle.read(len(data))
+        data = compressor.compress(data)
+        if throttle is not None:
+            throttle.write(len(data))
+        _write(dest_fd, data)
+        written += len(data)
+    data = compressor.flush()
+    _write(dest_fd, data)
+    return h.hexdigest(), written + len(data)
+
+class StoredFile(object):
+    """Reads the original content of a file in a snapshot."""
+
+    def __init__(self, path, codec=None):
+        self.codec = codec
+        self.file = None
+        self.blocks = None
+        self.decompressor = None
+        if codec == BLOCKS:
+            self.blocks = BlockReader(path)
+        else:
+            self.file = open(path, "rb")
+            if codec is not None:
+                self.decompressor = CODECS[codec][1]()
+        self.buf = ""
+
+    def _read_more(self):
+        # Returns None at the end.
+        if self.blocks is not None:
+            return self.blocks.read_block()
+        data = self.file.read(BLOCK_SIZE)
+        if not data:
+            return None
+        try:
+            return self.decompressor.decompress(data)
+        except (IOError, zlib.error):
+            raise IOError(errno.EIO, "Broken %(codec)s data" % dict(
+                codec=self.codec))
+
+    def read(self, size):
+        if self.codec is None:
+            return self.file.read(size)
+        while len(self.buf) < size:
+            data = self._read_more()
+            if data is None:
+                break
+            self.buf += data
+        data = self.buf[:size]
+        self.buf = self.buf[size:]
+        return data
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+def decompress(path, codec, dest_fd):
+    """Writes the original content of a file stored with codec to dest_fd.
+    Returns bytes written."""
+    file = StoredFile(path, codec)
+    try:
+        written = 0
+        while True:
+            data = file.read(BLOCK_SIZE)
+            if not data:
+                return written
+            _write(dest_fd, data)
+            written += len(data)
+    finally:
+        file.close()
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
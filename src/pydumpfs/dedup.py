@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+
+from hashlib import sha256
+from os import makedirs
+from os.path import exists, join, relpath
+from pydumpfs.manifest import get_metadata_dir
+from threading import Event, Lock
+import os
+import sqlite3
+
+DIGESTS_NAME = "digests"
+BLOCK_SIZE = 1024 * 1024
+
+def compute_digest(path, throttle=None):
+    h = sha256()
+    file = open(path, "rb")
+    try:
+        while True:
+            data = file.read(BLOCK_SIZE)
+            if not data:
+                break
+            if throttle is not None:
+                throttle.read(len(data))
+            h.update(data)
+    finally:
+        file.close()
+    return h.hexdigest()
+
+def make_key(digest, st, codec=None):
+    # A hard link shares an i-node, so files can share one only when their
+    # metadata is same too.
+    key = "%(digest)s %(size)d %(mode)o %(uid)d %(gid)d %(mtime)d" % dict(
+        digest=digest, size=st.st_size, mode=st.st_mode, uid=st.st_uid,
+        gid=st.st_gid, mtime=st.st_mtime)
+    if codec is None:
+        return key
+    return "%(key)s %(codec)s" % dict(key=key, codec=codec)
+
+def get_digests_path(dest):
+    return join(get_metadata_dir(dest), DIGESTS_NAME)
+
+class DigestIndex(object):
+    """Maps a content and metadata to a file in any snapshot under dest.
+
+    An entry points to the latest file linked or copied for it. Entries of
+    removed snapshots are moved to the same files in kept ones by
+    remove_snapshots(). lookup() checks that the file still exists and still
+    has the metadata.
+
+    lookup() reserves a key which it can't find. Other threads looking up the
+    key wait until the reserving thread calls release(), so that files with
+    same contents copied at once are linked too.
+    """
+
+    def __init__(self, dest):
+        self.dest = dest
+        dir_ = get_metadata_dir(dest)
+        if not exists(dir_):
+            makedirs(dir_)
+        self.lock = Lock()
+        self.pending = {}
+        self.conn = sqlite3.connect(
+            get_digests_path(dest), check_same_thread=False)
+        self.conn.text_factory = str
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS digests (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL)""")
+
+    def lookup(self, key, st, compressed=False):
+        while True:
+            self.lock.acquire()
+            try:
+                event = self.pending.get(key)
+                if event is None:
+                    path = self._lookup(key, st, compressed)
+                    if path is None:
+                        self.pending[key] = Event()
+                    return path
+            finally:
+                self.lock.release()
+            event.wait()
+
+    def release(self, key):
+        self.lock.acquire()
+        try:
+            self.pending.pop(key).set()
+        finally:
+            self.lock.release()
+
+    def _lookup(self, key, st, compressed):
+        row = self.conn.execute(
+            "SELECT path FROM digests WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+
+        path = join(self.dest, row[0])
+        try:
+            st2 = os.lstat(path)
+        except OSError:
+            return None
+        if st2.st_mode != st.st_mode:
+            return None
+        if st2.st_uid != st.st_uid:
+            return None
+        if st2.st_gid != st.st_gid:
+            return None
+        # A compressed file is smaller. The key has the original size.
+        if (not compressed) and (st2.st_size != st.st_size):
+            return None
+        if st2.st_mtime != st.st_mtime:
+            return None
+        return path
+
+    def add(self, key, path):
+        self.lock.acquire()
+        try:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO digests VALUES (?, ?)",
+                (key, relpath(path, self.dest)))
+        finally:
+            self.lock.release()
+
+    def remove_snapshots(self, names, kept):
+        """Points entries in the snapshots names, which are being removed, to
+        the same i-nodes in the latest of kept snapshots having them, like
+        files linked to following snapshots. Others are dropped."""
+        kept = sorted(kept, reverse=True)
+        for name in names:
+            rows = self.conn.execute("""SELECT key, path FROM digests
+WHERE (? < path) AND (path < ?)""", (name + "/", name + "0")).fetchall()
+            for key, path in rows:
+                self._move_entry(key, path, path[len(name):], kept)
+        self.conn.commit()
+
+    def _move_entry(self, key, path, relative, kept):
+        try:
+            ino = os.lstat(join(self.dest, path)).st_ino
+        except OSError:
+            ino = None
+        if ino is not None:
+            for name in kept:
+                new_path = name + relative
+                try:
+                    st = os.lstat(join(self.dest, new_path))
+                except OSError:
+                    continue
+                if st.st_ino == ino:
+                    self.conn.execute(
+                        "UPDATE digests SET path = ? WHERE key = ?",
+                        (new_path, key))
+                    return
+        self.conn.execute("DELETE FROM digests WHERE key = ?", (key,))
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Differences between two snapshots, or between a source and a snapshot.
+
+A file in two snapshots which shares an i-node is unchanged, so most files
+are told by lstat(2) alone. Other files are told by sizes, then by records
+in manifests, and only the rest by reading their contents.
+"""
+
+from collections import namedtuple
+from os import listdir, stat_float_times
+from os.path import join
+from pydumpfs import merge_join
+from pydumpfs.compress import StoredFile
+from pydumpfs.filters import parse_key, read_key
+from pydumpfs.manifest import METADATA_DIR, is_same_stat, open_manifest
+import errno
+import os
+import stat
+
+ADDED = "added"
+REMOVED = "removed"
+MODIFIED = "modified"
+METADATA = "metadata"
+
+BLOCK_SIZE = 1024 * 1024
+
+Change = namedtuple("Change", ["kind", "path"])
+
+_OLD = 0
+_NEW = 1
+
+def _lstat(path):
+    try:
+        return os.lstat(path)
+    except OSError, e:
+        if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+            raise
+        return None
+
+def _is_same_content(path1, path2, codec1=None, codec2=None):
+    file1 = StoredFile(path1, codec1)
+    try:
+        file2 = StoredFile(path2, codec2)
+        try:
+            while True:
+                data = file1.read(BLOCK_SIZE)
+                if data != file2.read(BLOCK_SIZE):
+                    return False
+                if not data:
+                    return True
+        finally:
+            file2.close()
+    finally:
+        file1.close()
+
+def _is_same_meta(st1, st2):
+    return (st1.st_mode == st2.st_mode) and (st1.st_uid == st2.st_uid) \
+        and (st1.st_gid == st2.st_gid) and (st1.st_mtime == st2.st_mtime)
+
+def _get_codec(record):
+    if record is None:
+        return None
+    return record.codec
+
+def _get_size(st, record):
+    # A compressed file has the original size in its record.
+    if _get_codec(record) is None:
+        return st.st_size
+    return record.size
+
+def _is_same_source(record1, record2):
+    # Tells if two backups read the same status of a source file, from mode
+    # to dev.
+    return record1[1:9] == record2[1:9]
+
+class Differ(object):
+    """Yields Changes from the old tree to the new one.
+
+    A path p is old_root + p in the old tree, and new_root + p in the new
+    one. Only directories, regular files and symbolic links are compared,
+    because snapshots have nothing else. When the new tree is a live source,
+    matcher drops what the backup didn't copy.
+    """
+
+    def __init__(self, old_root, new_root, old_manifest=None,
+                 new_manifest=None, matcher=None):
+        self.roots = [old_root, new_root]
+        self.old_manifest = old_manifest
+        self.new_manifest = new_manifest
+        self.matcher = matcher
+        self.root_len = None
+        self.root_dev = None
+        self.read_files = 0
+
+    def _is_skipped(self, side, path, st):
+        if stat.S_IFMT(st.st_mode) not in (
+                stat.S_IFDIR, stat.S_IFREG, stat.S_IFLNK):
+            return True
+        if (side == _OLD) or (self.matcher is None):
+            return False
+        return self.matcher.is_excluded(
+            path[self.root_len:], stat.S_ISDIR(st.st_mode))
+
+    def _list(self, side, path, st):
+        if (side == _NEW) and (self.matcher is not None) \
+                and self.matcher.one_file_system \
+                and (st.st_dev != self.root_dev):
+            # A mount point is kept as an empty directory.
+            return []
+        root = self.roots[side]
+        try:
+            names = sorted(listdir(root + path))
+        except OSError, e:
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return []
+        entries = []
+        for name in names:
+            if (path == "/") and (name == METADATA_DIR):
+                continue
+            child = join(path, name)
+            child_st = _lstat(root + child)
+            if (child_st is None) or self._is_skipped(side, child, child_st):
+                continue
+            entries.append((name, child_st))
+        return entries
+
+    def _walk(self, side, path, st):
+        # Yields paths under path including itself.
+        stack = [(path, st)]
+        while stack:
+            path, st = stack.pop()
+            yield path
+            if stat.S_ISDIR(st.st_mode):
+                stack.extend([
+                    (join(path, name), child_st)
+                    for name, child_st in reversed(self._list(side, path, st))])
+
+    def _lookup(self, manifest, path):
+        if manifest is None:
+            return None
+        return manifest.lookup(path)
+
+    def _compare_records(self, path, new_st, old_record, new_record):
+        """Returns True or False when manifests tell if contents are same,
+        or None."""
+        if old_record is None:
+            return None
+        # A file changed in the second when the old backup started may have
+        # the same status with other contents.
+        racy = self.old_manifest.is_racy(old_record)
+        if self.new_manifest is None:
+            # The new tree is the source which the old snapshot was made of.
+            if is_same_stat(old_record, new_st) and (not racy):
+                return True
+            return None
+        if new_record is None:
+            return None
+        if (old_record.digest is not None) and (new_record.digest is not None):
+            return old_record.digest == new_record.digest
+        if _is_same_source(old_record, new_record) and (not racy):
+            return True
+        return None
+
+    def _compare_files(self, path, old_st, new_st):
+        if (old_st.st_dev == new_st.st_dev) \
+                and (old_st.st_ino == new_st.st_ino):
+            # Hard links share data and status.
+            return None
+        old_record = self._lookup(self.old_manifest, path)
+        new_record = self._lookup(self.new_manifest, path)
+        if _get_size(old_st, old_record) != _get_size(new_st, new_record):
+            return MODIFIED
+        same = self._compare_records(path, new_st, old_record, new_record)
+        if same is None:
+            self.read_files += 1
+            same = _is_same_content(
+                self.roots[_OLD] + path, self.roots[_NEW] + path,
+                _get_codec(old_record), _get_codec(new_record))
+        if not same:
+            return MODIFIED
+        if _is_same_meta(old_st, new_st):
+            return None
+        return METADATA
+
+    def _compare(self, path, old_st, new_st):
+        if stat.S_ISDIR(old_st.st_mode):
+            if (old_st.st_mode == new_st.st_mode) \
+                    and (old_st.st_uid == new_st.st_uid) \
+                    and (old_st.st_gid == new_st.st_gid):
+                return None
+            return METADATA
+        if stat.S_ISLNK(old_st.st_mode):
+            old_target = os.readlink(self.roots[_OLD] + path)
+            if old_target != os.readlink(self.roots[_NEW] + path):
+                return MODIFIED
+            if (old_st.st_uid == new_st.st_uid) \
+                    and (old_st.st_gid == new_st.st_gid):
+                return None
+            return METADATA
+        return self._compare_files(path, old_st, new_st)
+
+    def _diff_entry(self, path, old_st, new_st):
+        if (old_st is not None) and (new_st is not None) and (
+                stat.S_IFMT(old_st.st_mode) == stat.S_IFMT(new_st.st_mode)):
+            kind = self._compare(path, old_st, new_st)
+            if kind is not None:
+                yield Change(kind, path)
+            return
+        # A file replaced by one of another type is removed and added.
+        if old_st is not None:
+            for child in self._walk(_OLD, path, old_st):
+                yield Change(REMOVED, child)
+        if new_st is not None:
+            for child in self._walk(_NEW, path, new_st):
+                yield Change(ADDED, child)
+
+    def diff(self, path="/"):
+        """Yields Changes under path in depth-first order."""
+        # Manifests and snapshots have times in seconds.
+        stat_float_times(False)
+        self.root_len = len(path.rstrip("/")) + 1
+        old_st = _lstat(self.roots[_OLD] + path)
+        new_st = _lstat(self.roots[_NEW] + path)
+        if new_st is not None:
+            self.root_dev = new_st.st_dev
+        stack = [(path, old_st, new_st)]
+        while stack:
+            path, old_st, new_st = stack.pop()
+            for change in self._diff_entry(path, old_st, new_st):
+                yield change
+            if (old_st is None) or (new_st is None) \
+                    or (not stat.S_ISDIR(old_st.st_mode)) \
+                    or (not stat.S_ISDIR(new_st.st_mode)):
+                continue
+            entries = merge_join(
+                self._list(_OLD, path, old_st), self._list(_NEW, path, new_st))
+            stack.extend(reversed([
+                (join(path, name), old_child, new_child)
+                for name, old_child, new_child in entries]))
+
+def _diff(differ, path):
+    try:
+        for change in differ.diff(path):
+            yield change
+    finally:
+        for manifest in [differ.old_manifest, differ.new_manifest]:
+            if manifest is not None:
+                manifest.close()
+
+def diff_snapshots(old_dir, new_dir, path="/"):
+    """Yields Changes under path from the snapshot old_dir to new_dir."""
+    differ = Differ(
+        old_dir, new_dir, open_manifest(old_dir), open_manifest(new_dir))
+    return _diff(differ, path)
+
+def diff_source(snapshot_dir, src):
+    """Yields Changes in the source src since the snapshot was made of it."""
+    matcher = parse_key(read_key(snapshot_dir))
+    differ = Differ(snapshot_dir, "", open_manifest(snapshot_dir), None,
+        matcher)
+    return _diff(differ, os.path.abspath(src))
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
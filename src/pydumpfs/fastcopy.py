@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+
+import ctypes
+import errno
+import os
+import sys
+
+FICLONE = 0x40049409
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+CHUNK_SIZE = 1024 * 1024 * 1024
+BLOCK_SIZE = 1024 * 1024
+
+# Errors telling that a method doesn't work for a pair of files. The data
+# copied so far is kept, because the methods advance the file offsets.
+UNSUPPORTED_ERRORS = (
+    errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTTY,
+    errno.EPERM)
+
+def _load_libc():
+    try:
+        return ctypes.CDLL(None, use_errno=True)
+    except OSError:
+        return None
+
+_libc = _load_libc()
+
+def _get_libc_func(name, restype, argtypes):
+    try:
+        func = getattr(_libc, name)
+    except AttributeError:
+        return None
+    func.restype = restype
+    func.argtypes = argtypes
+    return func
+
+_copy_file_range = _get_libc_func(
+    "copy_file_range", ctypes.c_ssize_t, [
+        ctypes.c_int, ctypes.c_void_p, ctypes.c_int, ctypes.c_void_p,
+        ctypes.c_size_t, ctypes.c_uint])
+if sys.platform.startswith("linux"):
+    # sendfile(2) of BSD can't write to a regular file.
+    _sendfile = _get_libc_func(
+        "sendfile", ctypes.c_ssize_t, [
+            ctypes.c_int, ctypes.c_int, ctypes.c_void_p, ctypes.c_size_t])
+else:
+    _sendfile = None
+
+def _call(func, *args):
+    while True:
+        n = func(*args)
+        if 0 <= n:
+            return n
+        e = ctypes.get_errno()
+        if e != errno.EINTR:
+            raise OSError(e, os.strerror(e))
+
+def _reflink(src_fd, dest_fd):
+    import fcntl
+    fcntl.ioctl(dest_fd, FICLONE, src_fd)
+
+def _tell(fd):
+    return os.lseek(fd, 0, os.SEEK_CUR)
+
+def _get_chunk_size(fd, end):
+    if end is None:
+        return CHUNK_SIZE
+    return min(CHUNK_SIZE, end - _tell(fd))
+
+# The following functions copy from the current offset until end, or until
+# the end of the file if end is None.
+
+def _copy_file_range_to(src_fd, dest_fd, end):
+    while True:
+        size = _get_chunk_size(src_fd, end)
+        if size <= 0:
+            return
+        if _call(_copy_file_range, src_fd, None, dest_fd, None, size, 0) == 0:
+            return
+
+def _sendfile_to(src_fd, dest_fd, end):
+    while True:
+        size = _get_chunk_size(src_fd, end)
+        if size <= 0:
+            return
+        if _call(_sendfile, dest_fd, src_fd, None, size) == 0:
+            return
+
+def _read_write_to(src_fd, dest_fd, end):
+    while True:
+        size = min(BLOCK_SIZE, _get_chunk_size(src_fd, end))
+        if size <= 0:
+            return
+        data = os.read(src_fd, size)
+        if not data:
+            return
+        while data:
+            data = data[os.write(dest_fd, data):]
+
+def is_sparse(st):
+    try:
+        return 512 * st.st_blocks < st.st_size
+    except AttributeError:
+        return False
+
+def get_data_extents(fd, size):
+    """Returns a list of (start, end) of data regions, or None if the file
+    system can't tell holes. This moves the offset of fd."""
+    extents = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                break
+            if e.errno == errno.EINVAL:
+                return None
+            raise
+        end = os.lseek(fd, start, SEEK_HOLE)
+        extents.append((start, end))
+        offset = end
+    return extents
+
+class FileCopier(object):
+    """Copies data of a file in the kernel if possible.
+
+    Methods are tried in the order of reflink, copy_file_range(2),
+    sendfile(2) and read(2)/write(2). A method which failed for a pair of
+    devices is not tried again for the pair. Holes of a sparse file are
+    kept by copying only its data regions.
+
+    If a throttle is given, data is copied in blocks, each of which is taken
+    from the throttle first.
+    """
+
+    def __init__(self, throttle=None):
+        self.throttle = throttle
+        self.reflink = sys.platform.startswith("linux")
+        self.methods = []
+        if _copy_file_range is not None:
+            self.methods.append(("copy_file_range", _copy_file_range_to))
+        if _sendfile is not None:
+            self.methods.append(("sendfile", _sendfile_to))
+        self.unsupported = set()
+
+    def _is_supported(self, name, devs):
+        return (name, devs) not in self.unsupported
+
+    def _try(self, name, devs, func, *args):
+        try:
+            func(*args)
+        except (IOError, OSError), e:
+            if e.errno not in UNSUPPORTED_ERRORS:
+                raise
+            self.unsupported.add((name, devs))
+            return False
+        return True
+
+    def _copy_to(self, devs, src_fd, dest_fd, end):
+        if self.throttle is not None:
+            self._copy_throttled(devs, src_fd, dest_fd, end)
+        return self._copy_unthrottled(devs, src_fd, dest_fd, end)
+
+    def _copy_throttled(self, devs, src_fd, dest_fd, end):
+        # Copies until the end, or the size if end is None. What a growing
+        # file appended after fstat(2) is left to _copy_unthrottled().
+        if end is None:
+            end = os.fstat(src_fd).st_size
+        while True:
+            offset = _tell(src_fd)
+            size = min(BLOCK_SIZE, end - offset)
+            if size <= 0:
+                return
+            self.throttle.read(size)
+            self.throttle.write(size)
+            self._copy_unthrottled(devs, src_fd, dest_fd, offset + size)
+            if _tell(src_fd) == offset:
+                return
+
+    def _copy_unthrottled(self, devs, src_fd, dest_fd, end):
+        for name, func in self.methods:
+            if not self._is_supported(name, devs):
+                continue
+            if self._try(name, devs, func, src_fd, dest_fd, end):
+                return name
+        _read_write_to(src_fd, dest_fd, end)
+        return "read/write"
+
+    def compare_and_copy(self, src_fd, prev_fd, dest_path):
+        """Returns True if src_fd has the same data as prev_fd. Otherwise
+        copies src_fd to dest_path, reading src_fd only once.
+        """
+        offset = 0
+        while True:
+            data = os.read(src_fd, BLOCK_SIZE)
+            prev_data = os.read(prev_fd, max(len(data), 1))
+            if self.throttle is not None:
+                self.throttle.read(len(data) + len(prev_data))
+            if data != prev_data:
+                break
+            if not data:
+                return True
+            offset += len(data)
+
+        dest_fd = os.open(dest_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            # The same leading part is in the page cache of prev_fd.
+            os.lseek(prev_fd, 0, os.SEEK_SET)
+            devs = (os.fstat(prev_fd).st_dev, os.fstat(dest_fd).st_dev)
+            self._copy_to(devs, prev_fd, dest_fd, offset)
+            if self.throttle is not None:
+                self.throttle.write(len(data))
+            while data:
+                data = data[os.write(dest_fd, data):]
+            devs = (os.fstat(src_fd).st_dev, devs[1])
+            self._copy_to(devs, src_fd, dest_fd, None)
+        finally:
+            os.close(dest_fd)
+        return False
+
+    def copy(self, src_fd, dest_fd):
+        src_st = os.fstat(src_fd)
+        devs = (src_st.st_dev, os.fstat(dest_fd).st_dev)
+        name = "reflink"
+        if self.reflink and self._is_supported(name, devs) \
+                and self._try(name, devs, _reflink, src_fd, dest_fd):
+            return name
+
+        if is_sparse(src_st):
+            extents = get_data_extents(src_fd, src_st.st_size)
+            if extents is not None:
+                name = "sparse"
+                for start, end in extents:
+                    os.lseek(src_fd, start, os.SEEK_SET)
+                    os.lseek(dest_fd, start, os.SEEK_SET)
+                    name = self._copy_to(devs, src_fd, dest_fd, end)
+                os.ftruncate(dest_fd, src_st.st_size)
+                return "%(name)s (sparse)" % dict(name=name)
+            os.lseek(src_fd, 0, os.SEEK_SET)
+
+        return self._copy_to(devs, src_fd, dest_fd, None)
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
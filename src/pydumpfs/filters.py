@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+"""Exclude rules in the syntax of gitignore.
+
+A rule matches a path relative to a source. A rule without a slash matches
+the name at any depth, and one with a slash matches from the source. A
+trailing slash matches only directories, "!" includes what the rule matches,
+and the last matching rule wins. An excluded directory is not read, so files
+in it can't be included again.
+"""
+
+from os.path import join
+from pydumpfs.manifest import get_metadata_dir
+import re
+
+FILTER_NAME = "filter"
+
+def parse_rules(lines):
+    rules = []
+    for line in lines:
+        line = line.rstrip("\n").rstrip()
+        if (not line) or line.startswith("#"):
+            continue
+        rules.append(line)
+    return rules
+
+def read_rules(path):
+    file = open(path)
+    try:
+        return parse_rules(file)
+    finally:
+        file.close()
+
+def _translate_class(pattern, i):
+    # Returns a regular expression of a bracket expression starting at i,
+    # and the index after it, or None if it is not closed.
+    j = i + 1
+    if (j < len(pattern)) and (pattern[j] == "!"):
+        j += 1
+    if (j < len(pattern)) and (pattern[j] == "]"):
+        j += 1
+    j = pattern.find("]", j)
+    if j < 0:
+        return None, i
+    body = pattern[i + 1:j].replace("\\", "\\\\")
+    if body.startswith("!"):
+        body = "^" + body[1:]
+    return "[%(body)s]" % dict(body=body), j + 1
+
+def _translate(pattern):
+    i = 0
+    n = len(pattern)
+    res = []
+    while i < n:
+        if pattern.startswith("**/", i):
+            res.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            res.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            res.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            res.append("[^/]")
+            i += 1
+        elif pattern[i] == "[":
+            regex, i = _translate_class(pattern, i)
+            if regex is None:
+                res.append(re.escape("["))
+                i += 1
+            else:
+                res.append(regex)
+        elif (pattern[i] == "\\") and (i + 1 < n):
+            res.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            res.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(res)
+
+def compile_rule(rule):
+    """Returns (regular expression, directory only, including)."""
+    including = rule.startswith("!")
+    if including:
+        rule = rule[1:]
+    elif rule.startswith("\\!") or rule.startswith("\\#"):
+        rule = rule[1:]
+    dir_only = rule.endswith("/")
+    rule = rule.rstrip("/")
+    if "/" in rule:
+        prefix = ""
+    else:
+        prefix = "(?:.*/)?"
+    regex = "%(prefix)s%(body)s$" % dict(
+        prefix=prefix, body=_translate(rule.lstrip("/")))
+    return re.compile(regex), dir_only, including
+
+class Matcher(object):
+    """Tells if a path is excluded by rules compiled once.
+
+    Most paths match no rule. They are told by one match of a regular
+    expression joining all rules.
+    """
+
+    def __init__(self, rules=(), one_file_system=False):
+        self.rules = list(rules)
+        self.one_file_system = one_file_system
+        self.compiled = [compile_rule(rule) for rule in self.rules]
+        self.any = None
+        if self.compiled:
+            self.any = re.compile("|".join([
+                "(?:%(regex)s)" % dict(regex=regex.pattern)
+                for regex, _, _ in self.compiled]))
+
+    def is_excluded(self, path, is_dir):
+        if (self.any is None) or (self.any.match(path) is None):
+            return False
+        for regex, dir_only, including in reversed(self.compiled):
+            if dir_only and (not is_dir):
+                continue
+            if regex.match(path) is not None:
+                return not including
+        return False
+
+    def get_key(self):
+        """Returns a string which differs when the matcher selects other
+        files."""
+        lines = list(self.rules)
+        if self.one_file_system:
+            lines.append("--one-file-system")
+        return "\n".join(lines)
+
+def parse_key(key):
+    """Returns a Matcher of which get_key() returns key."""
+    lines = []
+    if key:
+        lines = key.split("\n")
+    one_file_system = bool(lines) and (lines[-1] == "--one-file-system")
+    if one_file_system:
+        lines.pop()
+    return Matcher(lines, one_file_system)
+
+def get_filter_path(snapshot_dir):
+    return join(get_metadata_dir(snapshot_dir), FILTER_NAME)
+
+def write_key(snapshot_dir, key):
+    file = open(get_filter_path(snapshot_dir), "w")
+    try:
+        file.write(key)
+    finally:
+        file.close()
+
+def read_key(snapshot_dir):
+    """Returns the key of the matcher which made a snapshot. A snapshot
+    without the key was made without rules."""
+    try:
+        file = open(get_filter_path(snapshot_dir))
+    except IOError:
+        return ""
+    try:
+        return file.read()
+    finally:
+        file.close()
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
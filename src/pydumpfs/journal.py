@@ -0,0 +1,312 @@
+# -*- coding: utf-8 -*-
+"""Journal of directories changed between backups.
+
+A watcher process keeps directories in which something changed, using
+inotify(7). A backup asks it for the journal, re-examines only those
+directories, and links everything else from the previous snapshot.
+
+The journal is of no use, and a backup scans all, when the watcher is not
+running, when it started after the previous backup, or when the kernel
+dropped events after the previous backup.
+"""
+
+from os import makedirs
+from os.path import abspath, dirname, exists, join
+from pydumpfs.manifest import get_metadata_dir
+from select import select
+from time import sleep, time
+import ctypes
+import errno
+import marshal
+import os
+import struct
+import sys
+
+JOURNAL_NAME = "journal"
+FIFO_NAME = "journal.fifo"
+JOURNAL_VERSION = 1
+SYNC_TIMEOUT = 10
+BUFFER_SIZE = 65536
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE \
+    | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW \
+    | IN_EXCL_UNLINK
+EVENT_FORMAT = "iIII"
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+def _load_inotify():
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        funcs = [
+            libc.inotify_init1, libc.inotify_add_watch, libc.inotify_rm_watch]
+    except (AttributeError, OSError):
+        return None
+    funcs[1].argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    return funcs
+
+_inotify = _load_inotify()
+
+def _call(func, *args):
+    n = func(*args)
+    if n < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+    return n
+
+def get_journal_path(dest):
+    return join(get_metadata_dir(dest), JOURNAL_NAME)
+
+def get_fifo_path(dest):
+    return join(get_metadata_dir(dest), FIFO_NAME)
+
+def _is_under(path, root):
+    return (path == root) or path.startswith(root.rstrip("/") + "/")
+
+class Journal(object):
+
+    def __init__(self, roots, dirty):
+        self.roots = roots
+        self.dirty = dirty
+
+    def covers(self, path):
+        for root in self.roots:
+            if _is_under(path, root):
+                return True
+        return False
+
+    def is_dirty(self, dirpath):
+        """Tells if an entry in dirpath may have changed."""
+        return (dirpath in self.dirty) or (not self.covers(dirpath))
+
+def _load(path):
+    try:
+        file = open(path, "rb")
+    except IOError:
+        return None
+    try:
+        try:
+            data = marshal.load(file)
+        except (EOFError, ValueError, TypeError):
+            return None
+    finally:
+        file.close()
+    if data[0] != JOURNAL_VERSION:
+        return None
+    return data
+
+def read_journal(dest, since):
+    """Returns a Journal of changes since the time, or None if the watcher of
+    dest can't tell them."""
+    try:
+        fd = os.open(get_fifo_path(dest), os.O_WRONLY | os.O_NONBLOCK)
+    except OSError, e:
+        # ENXIO means that nobody is reading the FIFO.
+        if e.errno in (errno.ENOENT, errno.ENXIO):
+            return None
+        raise
+    request = time()
+    try:
+        os.write(fd, "s")
+    finally:
+        os.close(fd)
+
+    path = get_journal_path(dest)
+    while True:
+        data = _load(path)
+        if (data is not None) and (request <= data[2]):
+            break
+        if request + SYNC_TIMEOUT < time():
+            return None
+        sleep(0.01)
+
+    _, started, _, roots, dirty = data
+    if (started is None) or (since < started):
+        return None
+    # Any change after the previous backup read a directory is told by an
+    # event which came after the backup started.
+    dirty = set([path for path, t in dirty.items() if since <= t])
+    return Journal(roots, dirty)
+
+def _get_latest_start(dest):
+    from pydumpfs import glob_backups
+    from pydumpfs.manifest import open_manifest
+    backups = sorted(glob_backups(dest))
+    if not backups:
+        return None
+    manifest = open_manifest(backups[-1])
+    if manifest is None:
+        return None
+    try:
+        return manifest.start
+    finally:
+        manifest.close()
+
+class Watcher(object):
+    """Watches directories under roots, and writes the journal when a backup
+    asks for it through the FIFO."""
+
+    def __init__(self, dest, roots, out=sys.stderr):
+        if _inotify is None:
+            raise OSError(errno.ENOSYS, "inotify is not available")
+        self.dest = abspath(dest)
+        self.roots = [abspath(root) for root in roots]
+        self.out = out
+        self.fd = _call(_inotify[0], IN_NONBLOCK)
+        self.paths = {}
+        self.dirty = {}
+        self.started = None
+        self.complete = True
+        self.stopped = False
+
+    def _add_watch(self, path):
+        try:
+            wd = _call(_inotify[1], self.fd, path, WATCH_MASK)
+        except OSError, e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return
+            # Mostly ENOSPC of fs.inotify.max_user_watches.
+            print >> self.out, "error: Can't watch %(path)r (%(desc)s)." \
+                % dict(path=path, desc=e.strerror)
+            self.complete = False
+            return
+        self.paths[wd] = path
+
+    def add_tree(self, root):
+        for dirpath, dirnames, _ in os.walk(root):
+            self._add_watch(dirpath)
+            # A watch added after files were made can't tell the files.
+            self.dirty[dirpath] = time()
+            # Backups made under a root must not make events.
+            dirnames[:] = [
+                name for name in dirnames
+                if not _is_under(join(dirpath, name), self.dest)]
+
+    def remove_tree(self, root):
+        for wd, path in self.paths.items():
+            if _is_under(path, root):
+                try:
+                    _call(_inotify[2], self.fd, wd)
+                except OSError:
+                    pass
+                del self.paths[wd]
+
+    def start(self):
+        for root in self.roots:
+            self.add_tree(root)
+        self.dirty.clear()
+        self.started = time()
+
+    def _handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            # Changes are lost. The journal starts over.
+            self.dirty.clear()
+            self.started = time()
+            return
+        if mask & IN_IGNORED:
+            self.paths.pop(wd, None)
+            return
+        path = self.paths.get(wd)
+        if path is None:
+            return
+        if not name:
+            # Status of a directory is kept in the listing of its parent.
+            self.dirty[dirname(path)] = time()
+            return
+        self.dirty[path] = time()
+        if not (mask & IN_ISDIR):
+            return
+        child = join(path, name)
+        if mask & (IN_CREATE | IN_MOVED_TO):
+            self.add_tree(child)
+        elif mask & IN_MOVED_FROM:
+            self.remove_tree(child)
+
+    def read_events(self):
+        while True:
+            try:
+                data = os.read(self.fd, BUFFER_SIZE)
+            except OSError, e:
+                if e.errno == errno.EAGAIN:
+                    return
+                raise
+            offset = 0
+            while offset < len(data):
+                wd, mask, _, size = struct.unpack_from(
+                    EVENT_FORMAT, data, offset)
+                offset += EVENT_SIZE
+                name = data[offset:offset + size].rstrip("\0")
+                offset += size
+                self._handle(wd, mask, name)
+
+    def write(self, synced):
+        # Changes before the latest snapshot are in it already.
+        since = _get_latest_start(self.dest)
+        if since is not None:
+            for path, t in self.dirty.items():
+                if t < since:
+                    del self.dirty[path]
+        if self.complete:
+            started = self.started
+        else:
+            started = None
+        path = get_journal_path(self.dest)
+        tmp_path = path + ".tmp"
+        file = open(tmp_path, "wb")
+        try:
+            marshal.dump(
+                (JOURNAL_VERSION, started, synced, self.roots, self.dirty),
+                file)
+        finally:
+            file.close()
+        os.rename(tmp_path, path)
+
+    def _open_fifo(self):
+        dir_ = get_metadata_dir(self.dest)
+        if not exists(dir_):
+            makedirs(dir_)
+        path = get_fifo_path(self.dest)
+        if not exists(path):
+            os.mkfifo(path, 0600)
+        # Opening for writing too keeps the FIFO from reaching EOF.
+        return os.open(path, os.O_RDWR | os.O_NONBLOCK)
+
+    def serve(self, timeout=1):
+        """Serves until stop() is called."""
+        fifo = self._open_fifo()
+        try:
+            while not self.stopped:
+                readable, _, _ = select([self.fd, fifo], [], [], timeout)
+                if fifo not in readable:
+                    self.read_events()
+                    continue
+                os.read(fifo, BUFFER_SIZE)
+                # Events of changes before now are in the queue already.
+                synced = time()
+                self.read_events()
+                self.write(synced)
+        finally:
+            os.close(fifo)
+
+    def stop(self):
+        self.stopped = True
+
+    def close(self):
+        os.close(self.fd)
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
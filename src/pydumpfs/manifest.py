@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+
+from collections import namedtuple
+from os.path import basename, dirname, join
+from threading import Lock
+from time import time
+import marshal
+import os
+import zlib
+
+METADATA_DIR = ".pydumpfs"
+MANIFEST_NAME = "manifest"
+MANIFEST_VERSION = 1
+
+# codec is that of a file stored compressed, or None. nlink is the count of
+# links of the source. Records written before they were added don't have
+# them.
+Record = namedtuple("Record", [
+    "name", "mode", "uid", "gid", "size", "mtime", "ctime", "ino", "dev",
+    "digest", "target", "codec", "nlink"])
+
+def make_record(name, st, digest=None, target=None, codec=None):
+    return Record(
+        name, st.st_mode, st.st_uid, st.st_gid, st.st_size, st.st_mtime,
+        st.st_ctime, st.st_ino, st.st_dev, digest, target, codec,
+        st.st_nlink)
+
+def is_same_stat(record, st):
+    return (record.mode == st.st_mode) and (record.uid == st.st_uid) \
+        and (record.gid == st.st_gid) and (record.size == st.st_size) \
+        and (record.mtime == st.st_mtime) and (record.ctime == st.st_ctime) \
+        and (record.ino == st.st_ino) and (record.dev == st.st_dev)
+
+def get_metadata_dir(snapshot_dir):
+    return join(snapshot_dir, METADATA_DIR)
+
+def get_manifest_path(snapshot_dir):
+    return join(get_metadata_dir(snapshot_dir), MANIFEST_NAME)
+
+class ManifestWriter(object):
+    """Writes one block per directory.
+
+    The file starts with a marshalled (version, start time). A block is a
+    marshalled header (dirpath, size) followed by size bytes of compressed,
+    marshalled records. Readers can skip a block by its header.
+
+    Sources walked at once add their blocks from their own threads.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.lock = Lock()
+        marshal.dump((MANIFEST_VERSION, int(time())), self.file)
+
+    def add(self, dirpath, records):
+        payload = zlib.compress(marshal.dumps(
+            [tuple(record) for record in sorted(records)]))
+        self.lock.acquire()
+        try:
+            marshal.dump((dirpath, len(payload)), self.file)
+            self.file.write(payload)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.file.close()
+
+class ManifestReader(object):
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        try:
+            version, self.start = marshal.load(self.file)
+        except (EOFError, ValueError, TypeError):
+            version = None
+        if version != MANIFEST_VERSION:
+            self.file.close()
+            raise IOError("%(path)r is not a manifest." % dict(path=path))
+        self.offsets = self._read_offsets()
+        self.lock = Lock()
+        self.dirpath = None
+        self.records = []
+        self.names = {}
+
+    def _read_offsets(self):
+        # A manifest of an interrupted backup may end with a broken block.
+        # Blocks before it are still usable.
+        file_size = os.fstat(self.file.fileno()).st_size
+        offsets = {}
+        while True:
+            try:
+                dirpath, size = marshal.load(self.file)
+            except (EOFError, ValueError, TypeError):
+                break
+            offset = self.file.tell()
+            if file_size < offset + size:
+                break
+            offsets[dirpath] = (offset, size)
+            self.file.seek(size, os.SEEK_CUR)
+        return offsets
+
+    def has_dir(self, dirpath):
+        return dirpath in self.offsets
+
+    def list_dir(self, dirpath):
+        """Returns records in dirpath sorted by names."""
+        self.lock.acquire()
+        try:
+            return self._list_dir(dirpath)
+        finally:
+            self.lock.release()
+
+    def _list_dir(self, dirpath):
+        if dirpath != self.dirpath:
+            self.dirpath = dirpath
+            self.records = self._load(dirpath)
+            self.names = dict([(record.name, record) for record in self.records])
+        return self.records
+
+    def _load(self, dirpath):
+        try:
+            offset, size = self.offsets[dirpath]
+        except KeyError:
+            return []
+        self.file.seek(offset)
+        records = marshal.loads(zlib.decompress(self.file.read(size)))
+        missing = (None,) * (len(Record._fields) - len(records[0])) \
+            if records else ()
+        return [Record._make(record + missing) for record in records]
+
+    def is_racy(self, record):
+        # A file changed in the second when the backup started may change
+        # again without changing its timestamps.
+        return self.start <= max(record.mtime, record.ctime)
+
+    def lookup(self, path):
+        self.lock.acquire()
+        try:
+            self._list_dir(dirname(path))
+            return self.names.get(basename(path))
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.file.close()
+
+def open_manifest(snapshot_dir):
+    try:
+        return ManifestReader(get_manifest_path(snapshot_dir))
+    except IOError:
+        return None
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+
+from Queue import Queue
+from collections import deque
+from threading import Event, Thread
+import sys
+
+class _Task(object):
+
+    def __init__(self, func, args, callback):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.done = Event()
+        self.result = None
+        self.exc_info = None
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+class WorkerPool(object):
+    """Runs functions in threads.
+
+    Callbacks are called in the submitting thread in the order of submission,
+    so they can touch shared state without locks. With one job, functions run
+    in the submitting thread.
+    """
+
+    def __init__(self, jobs):
+        self.jobs = jobs
+        self.pending = deque()
+        self.queue = Queue()
+        self.threads = []
+        if jobs <= 1:
+            return
+        for _ in range(jobs):
+            thread = Thread(target=self._work)
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            task = self.queue.get()
+            if task is None:
+                return
+            task.run()
+
+    def _finish(self, task):
+        task.done.wait()
+        if task.exc_info is not None:
+            raise task.exc_info[0], task.exc_info[1], task.exc_info[2]
+        if task.callback is not None:
+            task.callback(task.result)
+
+    def submit(self, func, args=(), callback=None):
+        task = _Task(func, args, callback)
+        if self.jobs <= 1:
+            task.run()
+            self._finish(task)
+            return
+
+        self.pending.append(task)
+        self.queue.put(task)
+        # Bound tasks waiting for their callbacks.
+        limit = 4 * self.jobs
+        while (limit < len(self.pending)) or \
+                (self.pending and self.pending[0].done.isSet()):
+            self._finish(self.pending.popleft())
+
+    def join(self):
+        while self.pending:
+            self._finish(self.pending.popleft())
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+_ITEM = "item"
+_END = "end"
+_ERROR = "error"
+
+class Prefetcher(object):
+    """Runs an iterator in a thread ahead of its consumer.
+
+    At most size items wait in a queue, so that the producer works while the
+    consumer does, but doesn't get far ahead of it. An exception in the
+    iterator is raised in the consumer.
+    """
+
+    def __init__(self, iterable, size):
+        self.queue = Queue(size)
+        self.cancelled = False
+        self.done = False
+        self.thread = Thread(target=self._produce, args=(iter(iterable),))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _produce(self, iterator):
+        try:
+            for item in iterator:
+                if self.cancelled:
+                    break
+                self.queue.put((_ITEM, item))
+        except:
+            self.queue.put((_ERROR, sys.exc_info()))
+            return
+        self.queue.put((_END, None))
+
+    def __iter__(self):
+        while not self.done:
+            kind, value = self.queue.get()
+            if kind == _ITEM:
+                yield value
+                continue
+            self.done = True
+            if kind == _ERROR:
+                raise value[0], value[1], value[2]
+
+    def close(self):
+        # Items left are taken, so that the producer isn't blocked.
+        self.cancelled = True
+        while not self.done:
+            kind, _ = self.queue.get()
+            self.done = kind != _ITEM
+        self.thread.join()
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
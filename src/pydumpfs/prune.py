@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+
+from os import listdir, makedirs
+from os.path import exists, isdir, islink, join
+from pydumpfs.manifest import get_metadata_dir
+import ctypes
+import errno
+import os
+
+TRASH_NAME = "trash"
+LOCK_NAME = "trash.lock"
+MAX_SPLIT_DEPTH = 4
+AT_REMOVEDIR = 0x200
+FD_DIR = "/proc/self/fd"
+O_DIRECTORY = getattr(os, "O_DIRECTORY", 0)
+O_NOFOLLOW = getattr(os, "O_NOFOLLOW", 0)
+
+# The share of the throttle of a worker process.
+_worker_throttle = None
+
+def _load_at_funcs():
+    # Python 2 has no dir_fd. Directories are listed through FD_DIR.
+    if (not O_DIRECTORY) or (not exists(FD_DIR)):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        funcs = [libc.openat, libc.unlinkat]
+    except (AttributeError, OSError):
+        return None
+    funcs[0].argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    funcs[1].argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_int]
+    return funcs
+
+_at_funcs = _load_at_funcs()
+
+def _call(func, path, *args):
+    # path names the entry in the error.
+    while True:
+        n = func(*args)
+        if 0 <= n:
+            return n
+        e = ctypes.get_errno()
+        if e != errno.EINTR:
+            raise OSError(e, os.strerror(e), path)
+
+def _openat(dir_fd, name, path):
+    return _call(_at_funcs[0], path, dir_fd, name,
+        os.O_RDONLY | O_DIRECTORY | O_NOFOLLOW)
+
+def _unlinkat(dir_fd, name, flags, path):
+    _call(_at_funcs[1], path, dir_fd, name, flags)
+
+def get_trash_dir(dir_):
+    return join(get_metadata_dir(dir_), TRASH_NAME)
+
+def move_to_trash(dir_, name):
+    """Moves a snapshot out of sight at once. Removing it is done later by
+    empty_trash(), even if this process is killed before it."""
+    trash = get_trash_dir(dir_)
+    if not exists(trash):
+        makedirs(trash)
+    os.rename(join(dir_, name), join(trash, name))
+
+def _remove_contents_at(fd, path, throttle):
+    # Entries are looked up from the directory opened, so renaming its
+    # ancestors doesn't lead the removal elsewhere. path is for errors.
+    for name in listdir(join(FD_DIR, str(fd))):
+        child = join(path, name)
+        if throttle is not None:
+            throttle.op()
+        try:
+            _unlinkat(fd, name, 0, child)
+            continue
+        except OSError, e:
+            if e.errno not in (errno.EISDIR, errno.EPERM):
+                raise
+        child_fd = _openat(fd, name, child)
+        try:
+            _remove_contents_at(child_fd, child, throttle)
+        finally:
+            os.close(child_fd)
+        _unlinkat(fd, name, AT_REMOVEDIR, child)
+
+def _remove_contents(path, throttle):
+    # Used without openat(2). Paths are absolute, because the current
+    # directory is shared by threads.
+    for name in listdir(path):
+        child = join(path, name)
+        if throttle is not None:
+            throttle.op()
+        try:
+            os.unlink(child)
+            continue
+        except OSError, e:
+            if e.errno not in (errno.EISDIR, errno.EPERM):
+                raise
+        _remove_contents(child, throttle)
+        os.rmdir(child)
+
+def remove_tree(path, throttle=None):
+    """Removes path and all in it. Each file removed is taken from throttle
+    if it is given."""
+    if _at_funcs is None:
+        _remove_contents(path, throttle)
+    else:
+        fd = os.open(path, os.O_RDONLY | O_DIRECTORY | O_NOFOLLOW)
+        try:
+            _remove_contents_at(fd, path, throttle)
+        finally:
+            os.close(fd)
+    os.rmdir(path)
+
+def _set_worker_throttle(throttle):
+    global _worker_throttle
+    _worker_throttle = throttle
+
+def _remove_tree_in_worker(path):
+    # The error goes back to the parent with its errno and filename.
+    try:
+        remove_tree(path, _worker_throttle)
+    except OSError, e:
+        if e.errno != errno.ENOENT:
+            return e
+    return None
+
+def _split_tree(root, count):
+    """Returns directories under root which can be removed independently."""
+    dirs = [root]
+    for _ in range(MAX_SPLIT_DEPTH):
+        if count <= len(dirs):
+            break
+        children = []
+        for dir_ in dirs:
+            for name in listdir(dir_):
+                path = join(dir_, name)
+                if isdir(path) and (not islink(path)):
+                    children.append(path)
+        if not children:
+            break
+        dirs = children
+    return dirs
+
+def _get_free_bytes(path):
+    st = os.statvfs(path)
+    return st.f_bfree * st.f_frsize
+
+def _lock_trash(dir_):
+    import fcntl
+    fd = os.open(
+        join(get_metadata_dir(dir_), LOCK_NAME), os.O_WRONLY | os.O_CREAT, 0600)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        os.close(fd)
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return None
+    return fd
+
+def empty_trash(dir_, jobs=1, throttle=None):
+    """Removes snapshots in the trash with jobs processes. Returns bytes freed
+    on the file system, or None if another process is emptying the trash.
+    Workers share the rates of throttle if it is given.
+    """
+    trash = get_trash_dir(dir_)
+    if not exists(trash):
+        return 0
+    lock = _lock_trash(dir_)
+    if lock is None:
+        return None
+
+    try:
+        free = _get_free_bytes(dir_)
+        if 1 < jobs:
+            from multiprocessing import Pool
+            if throttle is None:
+                pool = Pool(jobs)
+            else:
+                pool = Pool(
+                    jobs, _set_worker_throttle, (throttle.share(jobs),))
+            try:
+                errors = pool.map(
+                    _remove_tree_in_worker, _split_tree(trash, 4 * jobs))
+            finally:
+                pool.close()
+                pool.join()
+            for error in errors:
+                if error is not None:
+                    raise error
+        # Removes the rest which the workers didn't take.
+        if exists(trash):
+            remove_tree(trash, throttle)
+        return max(0, _get_free_bytes(dir_) - free)
+    finally:
+        os.close(lock)
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
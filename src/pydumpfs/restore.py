@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+
+from os import listdir, makedirs
+from os.path import abspath, basename, dirname, isdir, islink, join, \
+    lexists
+from pydumpfs.catalog import find_snapshot, is_snapshot_name
+from pydumpfs.compress import decompress
+from pydumpfs.fastcopy import FileCopier
+from pydumpfs.manifest import METADATA_DIR, open_manifest
+from pydumpfs.pool import Prefetcher, WorkerPool
+from pydumpfs.stats import RunStats
+from time import time
+import errno
+import os
+import stat
+import sys
+
+# Directories listed ahead of copying.
+SCAN_AHEAD = 64
+
+class Restorer(object):
+    """Copies a tree in a snapshot to a target.
+
+    Files which were links to one i-node in the source are linked in the
+    target too, so their data is copied once. Files sharing an i-node only in
+    snapshots, like those linked to the previous snapshot or by dedup, are
+    copied apart. Workers copy files and set their statuses.
+    Directories get theirs in one pass at the end, deepest first, because
+    making entries changes mtime of their parents.
+
+    With skip_same, a file in the target which has the same type, size,
+    mtime, mode and owner as that in the snapshot is left as it is.
+
+    Files stored compressed are decompressed. Their codecs are looked up in
+    the manifest of the snapshot.
+    """
+
+    def __init__(self, verbose=False, jobs=1, skip_same=False):
+        self.verbose = verbose
+        self.jobs = jobs
+        self.skip_same = skip_same
+        self._copier = FileCopier()
+        self._manifest = None
+        self._root_len = 0
+        self.stats = RunStats()
+
+    def _print_debug(self, fmt, **kwargs):
+        if not self.verbose:
+            return
+        print fmt % kwargs
+
+    def _print_error(self, s):
+        self.stats.add("errors")
+        print >> sys.stderr, s
+
+    def restore(self, src, target):
+        """Restores src, a directory or a file in a snapshot, to target."""
+        src = abspath(src)
+        target = abspath(target)
+        self.stats = RunStats()
+        root = find_snapshot(src)
+        if root is not None:
+            self._manifest = open_manifest(root)
+            self._root_len = len(root)
+        try:
+            st = os.lstat(src)
+            if stat.S_ISDIR(st.st_mode):
+                dir_ = target
+            else:
+                dir_ = dirname(target)
+            if not isdir(dir_):
+                self._print_debug("makedirs: %(dir)s", dir=dir_)
+                makedirs(dir_)
+            if stat.S_ISDIR(st.st_mode):
+                self._restore_tree(src, target, st)
+            else:
+                self._restore_file(src, target, st, self._lookup(src))
+        finally:
+            if self._manifest is not None:
+                self._manifest.close()
+                self._manifest = None
+            self.stats.finish()
+
+    def _lookup(self, path):
+        if self._manifest is None:
+            return None
+        return self._manifest.lookup(path[self._root_len:])
+
+    def _scan_dir(self, path, root):
+        dirs = []
+        files = []
+        for name in sorted(listdir(path)):
+            if (path == root) and (name == METADATA_DIR) \
+                    and is_snapshot_name(basename(root)):
+                continue
+            child = join(path, name)
+            try:
+                st = os.lstat(child)
+            except OSError, e:
+                self._print_error("error: Can't get status of %(path)r "\
+                    "(%(desc)s)." % dict(path=child, desc=e.strerror))
+                continue
+            if stat.S_ISDIR(st.st_mode):
+                dirs.append((name, st))
+            else:
+                files.append((name, st))
+        self.stats.add("scanned_dirs")
+        self.stats.add("scanned_files", len(files))
+        return dirs, files
+
+    def _scan_tree(self, src):
+        # Runs in the scanner thread.
+        stack = [src]
+        while stack:
+            dirpath = stack.pop()
+            start = time()
+            try:
+                dirs, files = self._scan_dir(dirpath, src)
+            except OSError, e:
+                self._print_error("error: Can't read the directory %(path)r "\
+                    "(%(desc)s)." % dict(path=dirpath, desc=e.strerror))
+                dirs, files = [], []
+            self.stats.add_time("walk", start)
+            yield dirpath, dirs, files
+            stack.extend([join(dirpath, name) for name, _ in reversed(dirs)])
+
+    def _make_dir(self, path):
+        self._print_debug("mkdir: path=%(path)s", path=path)
+        try:
+            # Nobody can see into the directory until its mode is restored.
+            os.mkdir(path, 0700)
+        except OSError, e:
+            if (e.errno != errno.EEXIST) or (not isdir(path)) \
+                    or islink(path):
+                self._print_error("error: Can't make the directory %(path)r "\
+                    "(%(desc)s)." % dict(path=path, desc=e.strerror))
+                return False
+        return True
+
+    def _restore_tree(self, src, target, st):
+        dirs = [(target, st)]
+        failed = set()
+        inodes = {}
+        links = []
+        pool = WorkerPool(self.jobs)
+        scanner = Prefetcher(self._scan_tree(src), SCAN_AHEAD)
+        try:
+            for dirpath, subdirs, files in scanner:
+                if dirpath in failed:
+                    failed.update([join(dirpath, name) for name, _ in subdirs])
+                    continue
+                dest_dir = target + dirpath[len(src):]
+                for name, st in subdirs:
+                    path = join(dest_dir, name)
+                    if self._make_dir(path):
+                        dirs.append((path, st))
+                    else:
+                        failed.add(join(dirpath, name))
+                for name, st in files:
+                    dest = join(dest_dir, name)
+                    path = join(dirpath, name)
+                    record = self._lookup(path)
+                    # Links are grouped by the i-node of the source. Records
+                    # written before nlink was added have no links.
+                    if stat.S_ISREG(st.st_mode) and (record is not None) \
+                            and (1 < record.nlink):
+                        key = (record.dev, record.ino)
+                        first = inodes.get(key)
+                        if first is not None:
+                            links.append((first, dest))
+                            continue
+                        inodes[key] = dest
+                    pool.submit(self._restore_file, (path, dest, st, record))
+            pool.join()
+        finally:
+            scanner.close()
+            pool.close()
+
+        # Files which links point to are complete now.
+        for first, dest in links:
+            self._link(first, dest)
+        for path, st in reversed(dirs):
+            self._restore_meta_data(path, st)
+
+    def _is_same(self, src, dest, st, size):
+        try:
+            st2 = os.lstat(dest)
+        except OSError:
+            return False
+        if (st2.st_mode != st.st_mode) or (st2.st_uid != st.st_uid) \
+                or (st2.st_gid != st.st_gid) or (st2.st_size != size):
+            return False
+        if stat.S_ISLNK(st.st_mode):
+            return os.readlink(dest) == os.readlink(src)
+        return st2.st_mtime == st.st_mtime
+
+    def _remove(self, path):
+        try:
+            os.unlink(path)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def _copy(self, src, dest, st):
+        self._print_debug(
+            "copy: src=%(src)s, dest=%(dest)s", src=src, dest=dest)
+        start = time()
+        try:
+            src_fd = os.open(src, os.O_RDONLY)
+            try:
+                dest_fd = os.open(
+                    dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+                try:
+                    self._copier.copy(src_fd, dest_fd)
+                finally:
+                    os.close(dest_fd)
+            finally:
+                os.close(src_fd)
+        finally:
+            self.stats.add_time("copy", start)
+        self.stats.add("copied")
+        self.stats.add("bytes_read", st.st_size)
+        self.stats.add("bytes_written", st.st_size)
+
+    def _decompress(self, src, dest, st, codec):
+        self._print_debug(
+            "decompress: src=%(src)s, dest=%(dest)s, codec=%(codec)s",
+                src=src, dest=dest, codec=codec)
+        start = time()
+        try:
+            dest_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0600)
+            try:
+                written = decompress(src, codec, dest_fd)
+            finally:
+                os.close(dest_fd)
+        finally:
+            self.stats.add_time("copy", start)
+        self.stats.add("copied")
+        self.stats.add("bytes_read", st.st_size)
+        self.stats.add("bytes_written", written)
+
+    def _restore_file(self, src, dest, st, record=None):
+        if (record is None) or (not stat.S_ISREG(st.st_mode)):
+            codec = None
+        else:
+            codec = record.codec
+        if codec is None:
+            size = st.st_size
+        else:
+            size = record.size
+        try:
+            if self.skip_same and self._is_same(src, dest, st, size):
+                self.stats.add("skipped")
+                return
+            if stat.S_ISREG(st.st_mode):
+                # A file in the target may be linked to another one.
+                self._remove(dest)
+                if codec is None:
+                    self._copy(src, dest, st)
+                else:
+                    self._decompress(src, dest, st, codec)
+            elif stat.S_ISLNK(st.st_mode):
+                self._remove(dest)
+                self._print_debug(
+                    "symlink: src=%(src)s, dest=%(dest)s", src=src, dest=dest)
+                os.symlink(os.readlink(src), dest)
+                self.stats.add("symlinked")
+            else:
+                return
+            self._restore_meta_data(dest, st)
+        except (IOError, OSError), e:
+            self._print_error("error: Can't restore %(src)s to %(dest)s "\
+                "(%(desc)s)." % dict(src=src, dest=dest, desc=e.strerror))
+
+    def _link(self, first, dest):
+        self._print_debug(
+            "hard link: src=%(src)s, dest=%(dest)s", src=first, dest=dest)
+        try:
+            if self.skip_same and lexists(dest) \
+                    and (os.lstat(dest).st_ino == os.lstat(first).st_ino):
+                self.stats.add("skipped")
+                return
+            self._remove(dest)
+            os.link(first, dest)
+        except OSError, e:
+            self._print_error("error: Can't link %(src)s to %(dest)s "\
+                "(%(desc)s)." % dict(src=first, dest=dest, desc=e.strerror))
+            return
+        self.stats.add("linked")
+
+    def _restore_meta_data(self, path, st):
+        start = time()
+        try:
+            os.lchown(path, st.st_uid, st.st_gid)
+            if not stat.S_ISLNK(st.st_mode):
+                os.chmod(path, stat.S_IMODE(st.st_mode))
+                os.utime(path, (st.st_atime, st.st_mtime))
+        except OSError, e:
+            self._print_error("error: Can't change status of %(path)r "\
+                "(%(desc)s)." % dict(path=path, desc=e.strerror))
+        finally:
+            self.stats.add_time("metadata", start)
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
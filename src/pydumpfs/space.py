@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""Space which snapshots use alone and share by hard links and blocks.
+
+Snapshots are walked once, oldest first. An i-node with one link belongs to
+its snapshot alone. Others are kept in a table with the count of links seen
+and the set of snapshots which have them, as bits of a long. An i-node leaves
+the table when all of its links are seen, which happens when the walk passes
+the last snapshot having it, so the table holds about the files of one
+snapshot.
+
+When the table outgrows the memory budget, it is written to a temporary file
+sorted by i-node numbers, and the files are merged at the end.
+
+Blocks of the store belong to the snapshots which have lists of them. Each
+list is read once however many snapshots link it. Each i-node and block is
+counted once in total, and is freed when all snapshots having it are
+removed. Those with links outside snapshots, like in the trash, and blocks
+which no list has are never counted as freed.
+"""
+
+from binascii import hexlify
+from heapq import merge
+from os import listdir, makedirs
+from os.path import exists, isdir, join
+from pydumpfs.blocks import BLOCKS, get_store_dir, read_list
+from pydumpfs.catalog import is_snapshot_name
+from pydumpfs.checkpoint import get_checkpoint_path
+from pydumpfs.manifest import ManifestReader, get_manifest_path, \
+    get_metadata_dir
+from tempfile import TemporaryFile
+import os
+import stat
+import struct
+
+# Bytes of an entry in the table, including a share of a list sorted when
+# the table is written.
+BYTES_PER_INODE = 160
+DEFAULT_BUDGET = 512 * 1024 * 1024
+BLOCK_BYTES = 512
+
+# i-node, links, links seen, blocks, and length of the hex of snapshots.
+RUN_FORMAT = "<QIIQI"
+RUN_SIZE = struct.calcsize(RUN_FORMAT)
+
+def _pack(nlink, seen, blocks, snapshots):
+    # One long costs less than a tuple of four ints.
+    return seen | (nlink << 32) | (blocks << 64) | (snapshots << 128)
+
+def _unpack(value):
+    return ((value >> 32) & 0xffffffff, value & 0xffffffff,
+        (value >> 64) & 0xffffffffffffffff, value >> 128)
+
+def _read_run(file):
+    file.seek(0)
+    while True:
+        data = file.read(RUN_SIZE)
+        if len(data) < RUN_SIZE:
+            return
+        ino, nlink, seen, blocks, length = struct.unpack(RUN_FORMAT, data)
+        yield ino, nlink, seen, blocks, int(file.read(length), 16)
+
+class SpaceReport(object):
+    """Bytes on disk of snapshots. referenced counts each i-node and block
+    in a snapshot once, and unique counts those which only the snapshot has.
+    total counts each of them once in dest."""
+
+    def __init__(self, names):
+        self.names = names
+        self.referenced = [0] * len(names)
+        self.unique = [0] * len(names)
+        # Bytes by bits of snapshots having them.
+        self.snapshots = {}
+        self.external_snapshots = {}
+        self.external = 0
+        self.total = 0
+
+    def add(self, snapshots, size, external=False):
+        if external:
+            sizes = self.external_snapshots
+        else:
+            sizes = self.snapshots
+        sizes[snapshots] = sizes.get(snapshots, 0) + size
+
+    def finish(self):
+        """Sums bytes of each snapshot."""
+        self.external = sum(self.external_snapshots.itervalues())
+        self.total = sum(self.snapshots.itervalues()) + self.external
+        for sizes in [self.snapshots, self.external_snapshots]:
+            for snapshots, size in sizes.iteritems():
+                for i in range(len(self.names)):
+                    if snapshots & (1 << i):
+                        self.referenced[i] += size
+        for snapshots, size in self.snapshots.iteritems():
+            for i in range(len(self.names)):
+                if snapshots == 1 << i:
+                    self.unique[i] += size
+
+    def get_shared(self, i):
+        return self.referenced[i] - self.unique[i]
+
+    def freed(self, names):
+        """Returns bytes freed by removing the snapshots."""
+        removed = 0
+        for name in names:
+            removed |= 1 << self.names.index(name)
+        freed = 0
+        for snapshots, size in self.snapshots.iteritems():
+            if snapshots & ~removed == 0:
+                freed += size
+        return freed
+
+    def to_dict(self):
+        return dict(snapshots=[
+            dict(name=name, referenced=self.referenced[i],
+                unique=self.unique[i], shared=self.get_shared(i))
+            for i, name in enumerate(self.names)],
+            external=self.external, total=self.total)
+
+class SpaceCounter(object):
+
+    def __init__(self, dest, budget=DEFAULT_BUDGET):
+        self.dest = dest
+        self.capacity = max(1, budget // BYTES_PER_INODE)
+        self.table = {}
+        self.runs = []
+        # Bits of snapshots having each list of blocks by i-node.
+        self.lists = {}
+
+    def _add_link(self, report, i, st):
+        size = st.st_blocks * BLOCK_BYTES
+        if (not stat.S_ISREG(st.st_mode)) or (st.st_nlink == 1):
+            # Directories and symbolic links are never linked.
+            report.add(1 << i, size)
+            return
+
+        value = self.table.get(st.st_ino)
+        if value is None:
+            nlink, seen, snapshots = st.st_nlink, 0, 0
+        else:
+            nlink, seen, _, snapshots = _unpack(value)
+        # Files linked in a snapshot by dedup are counted once.
+        snapshots |= 1 << i
+        seen += 1
+        if nlink <= seen:
+            if value is not None:
+                del self.table[st.st_ino]
+            report.add(snapshots, size)
+            return
+        self.table[st.st_ino] = _pack(nlink, seen, st.st_blocks, snapshots)
+        if self.capacity <= len(self.table):
+            self._spill()
+
+    def _spill(self):
+        dir_ = get_metadata_dir(self.dest)
+        if not exists(dir_):
+            makedirs(dir_)
+        file = TemporaryFile(dir=dir_)
+        for ino in sorted(self.table.iterkeys()):
+            nlink, seen, blocks, snapshots = _unpack(self.table[ino])
+            data = "%x" % snapshots
+            file.write(struct.pack(
+                RUN_FORMAT, ino, nlink, seen, blocks, len(data)) + data)
+        self.table.clear()
+        self.runs.append(file)
+
+    def _merge_runs(self, report):
+        self._spill()
+        current = None
+        try:
+            for entry in merge(*[_read_run(file) for file in self.runs]):
+                if (current is not None) and (current[0] == entry[0]):
+                    current[2] += entry[2]
+                    current[4] |= entry[4]
+                    continue
+                if current is not None:
+                    self._add_inode(report, *current[1:])
+                current = list(entry)
+            if current is not None:
+                self._add_inode(report, *current[1:])
+        finally:
+            for file in self.runs:
+                file.close()
+            self.runs = []
+
+    def _add_inode(self, report, nlink, seen, blocks, snapshots):
+        report.add(snapshots, blocks * BLOCK_BYTES, seen < nlink)
+
+    def _walk(self, report, i, path):
+        stack = [path]
+        while stack:
+            dirpath = stack.pop()
+            for name in listdir(dirpath):
+                child = join(dirpath, name)
+                try:
+                    st = os.lstat(child)
+                except OSError:
+                    continue
+                self._add_link(report, i, st)
+                if stat.S_ISDIR(st.st_mode):
+                    stack.append(child)
+
+    def _find_lists(self, i, snapshot_dir):
+        for path in [
+                get_manifest_path(snapshot_dir),
+                get_checkpoint_path(snapshot_dir)]:
+            try:
+                manifest = ManifestReader(path)
+            except IOError:
+                continue
+            try:
+                for dirpath in manifest.offsets:
+                    for record in manifest.list_dir(dirpath):
+                        if (record.codec != BLOCKS) \
+                                or (not stat.S_ISREG(record.mode)):
+                            continue
+                        path = snapshot_dir + join(dirpath, record.name)
+                        try:
+                            st = os.lstat(path)
+                        except OSError:
+                            continue
+                        entry = self.lists.setdefault(st.st_ino, [path, 0])
+                        entry[1] |= 1 << i
+            finally:
+                manifest.close()
+
+    def _add_blocks(self, report):
+        blocks = {}
+        for path, snapshots in self.lists.itervalues():
+            try:
+                _, entries = read_list(path)
+            except (IOError, OSError):
+                continue
+            for digest, _ in entries:
+                name = hexlify(digest)
+                blocks[name] = blocks.get(name, 0) | snapshots
+        self.lists.clear()
+
+        dir_ = get_store_dir(self.dest)
+        if not exists(dir_):
+            return
+        for prefix in listdir(dir_):
+            prefix_dir = join(dir_, prefix)
+            if not isdir(prefix_dir):
+                continue
+            for name in listdir(prefix_dir):
+                try:
+                    st = os.lstat(join(prefix_dir, name))
+                except OSError:
+                    continue
+                snapshots = blocks.get(name, 0)
+                report.add(
+                    snapshots, st.st_blocks * BLOCK_BYTES, snapshots == 0)
+
+    def count(self):
+        """Walks snapshots in dest, and returns a SpaceReport."""
+        names = sorted([name for name in listdir(self.dest)
+            if is_snapshot_name(name)])
+        report = SpaceReport(names)
+        for i, name in enumerate(names):
+            path = join(self.dest, name)
+            self._add_link(report, i, os.lstat(path))
+            self._walk(report, i, path)
+            self._find_lists(i, path)
+        if self.runs:
+            self._merge_runs(report)
+        else:
+            for value in self.table.itervalues():
+                self._add_inode(report, *_unpack(value))
+            self.table.clear()
+        self._add_blocks(report)
+        report.finish()
+        return report
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+
+from threading import Lock
+from time import time
+import json
+
+COUNTERS = [
+    "scanned_dirs", "scanned_files", "clean_dirs", "linked", "copied",
+    "compressed", "stored_blocks", "symlinked", "skipped", "resumed",
+    "bytes_read", "bytes_written", "errors", "pruned", "freed_bytes"]
+PHASES = ["walk", "compare", "copy", "metadata", "prune", "throttle"]
+
+class RunStats(object):
+    """Counters and seconds spent in each phase of a run.
+
+    Bytes are counted from sizes of files, not from what the kernel did. A
+    compared file counts as read twice, once for each side. Seconds of a
+    phase are summed over workers, so they can be longer than the wall time.
+    Seconds slept by a throttle are in "throttle", and in the phase which
+    took it too.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.counters = dict([(name, 0) for name in COUNTERS])
+        self.times = dict([(name, 0.0) for name in PHASES])
+        self.start = time()
+        self.wall = None
+
+    def add(self, name, n=1):
+        self.lock.acquire()
+        try:
+            self.counters[name] += n
+        finally:
+            self.lock.release()
+
+    def add_time(self, phase, start):
+        """Adds seconds from start until now to the phase."""
+        elapsed = time() - start
+        self.lock.acquire()
+        try:
+            self.times[phase] += elapsed
+        finally:
+            self.lock.release()
+
+    def finish(self):
+        self.wall = time() - self.start
+
+    def to_dict(self):
+        d = dict(self.counters)
+        d["times"] = dict(self.times)
+        d["wall"] = self.wall
+        return d
+
+    def write_json(self, path):
+        file = open(path, "w")
+        try:
+            json.dump(self.to_dict(), file, indent=2, sort_keys=True)
+            print >> file
+        finally:
+            file.close()
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4
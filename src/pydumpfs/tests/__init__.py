@@ -2,17 +2,43 @@
 # -*- coding: utf-8 -*-
 
 from datetime import datetime, timedelta
-from os import chmod, lchown, listdir, lstat, makedirs, mkfifo, readlink, remove, stat, walk
-from os.path import abspath, dirname, exists, isdir, isfile, islink, join, lexists, samefile
+from gzip import GzipFile
+from hashlib import sha256
+from os import chmod, lchown, listdir, lstat, makedirs, mkfifo, readlink, remove, rename, stat, utime, walk
+from os.path import abspath, basename, dirname, exists, isdir, isfile, islink, join, lexists, samefile
 from shutil import rmtree
 from stat import S_IRUSR, S_IRWXG, S_IRWXO, S_IRWXU, S_ISLNK, S_ISREG
+from StringIO import StringIO
 from tempfile import mkdtemp
+from threading import Thread
+from time import sleep
+import errno
+import json
+import os
+import sys
 from unittest import TestCase, main
 
 from sys import path
 path.insert(0, "src")
 
-from pydumpfs import Pydumpfs, PydumpfsError, make_backup_name, remove_backups
+from pydumpfs import Pydumpfs, PydumpfsError, glob_backups, make_backup_name, \
+    merge_join, remove_backups
+from pydumpfs.benchmarks import TreeSpec, run, run_chunker
+from pydumpfs.blocks import collect_garbage, get_store_dir
+from pydumpfs.catalog import BATCH_SIZE, Catalog, get_catalog_path
+from pydumpfs.checkpoint import is_incomplete
+from pydumpfs.diff import diff_snapshots, diff_source
+from pydumpfs.fastcopy import FileCopier
+from pydumpfs.filters import Matcher, parse_key, parse_rules
+from pydumpfs.journal import Watcher
+from pydumpfs.manifest import get_manifest_path, is_same_stat, open_manifest
+from pydumpfs.pool import Prefetcher
+from pydumpfs import prune
+from pydumpfs.prune import AT_REMOVEDIR, empty_trash, get_trash_dir
+from pydumpfs.restore import Restorer
+from pydumpfs.space import BYTES_PER_INODE, SpaceCounter
+from pydumpfs.stats import PHASES, RunStats
+from pydumpfs.throttle import Throttle
 
 class TestRemove(TestCase):
 
@@ -41,6 +67,411 @@ class TestRemove(TestCase):
         path = self.run_testee(92)
         self.failIf(not exists(path))
 
+    def make_tree(self, path):
+        for i in range(8):
+            dir_ = join(path, "foo%(i)d" % dict(i=i), "bar")
+            makedirs(dir_)
+            for name in ["baz", "quux"]:
+                file = open(join(dir_, name), "w")
+                try:
+                    print >> file, name
+                finally:
+                    file.close()
+
+    def test_parallel(self):
+        path = self.make_backup_dir(93)
+        self.make_tree(path)
+        remove_backups(self.temp_dir, 93, 4)
+        self.failIf(exists(path))
+        self.failIf(exists(get_trash_dir(self.temp_dir)))
+
+    def test_parallel_error(self):
+        path = self.make_backup_dir(93)
+        self.make_tree(path)
+        self.assert_(remove_backups(self.temp_dir, 93, empty=False) == 0)
+        busy = join(
+            get_trash_dir(self.temp_dir), basename(path), "foo3", "bar")
+        # Workers are forked, so they have the broken rmdir() too.
+        rmdir = os.rmdir
+        def fail(dir_):
+            if dir_ == busy:
+                raise OSError(errno.EBUSY, os.strerror(errno.EBUSY), dir_)
+            rmdir(dir_)
+        os.rmdir = fail
+        unlinkat = prune._unlinkat
+        def fail_at(dir_fd, name, flags, path):
+            if (flags == AT_REMOVEDIR) and (path == busy):
+                raise OSError(errno.EBUSY, os.strerror(errno.EBUSY), path)
+            unlinkat(dir_fd, name, flags, path)
+        prune._unlinkat = fail_at
+        try:
+            try:
+                empty_trash(self.temp_dir, 4)
+            except OSError, e:
+                self.assert_(e.errno == errno.EBUSY)
+                self.assert_(e.filename == busy)
+            else:
+                self.fail("No error was raised.")
+        finally:
+            os.rmdir = rmdir
+            prune._unlinkat = unlinkat
+
+    def test_empty_later(self):
+        path = self.make_backup_dir(93)
+        self.make_tree(path)
+        self.assert_(remove_backups(self.temp_dir, 93, empty=False) == 0)
+        self.failIf(exists(path))
+        self.assert_(listdir(get_trash_dir(self.temp_dir)))
+
+        self.assert_(empty_trash(self.temp_dir) is not None)
+        self.failIf(exists(get_trash_dir(self.temp_dir)))
+
+    def test_stats(self):
+        self.make_backup_dir(93)
+        self.make_backup_dir(92)
+        stats = RunStats()
+        remove_backups(self.temp_dir, 93, stats=stats)
+        self.assert_(stats.counters["pruned"] == 1)
+
+    def test_catalog(self):
+        self.make_backup_dir(93)
+        path = self.make_backup_dir(92)
+        remove_backups(self.temp_dir, 93)
+        self.assert_(glob_backups(self.temp_dir) == [path])
+
+    def test_glob_without_catalog(self):
+        self.assert_(glob_backups(self.temp_dir) == [])
+        path1 = self.make_backup_dir(2)
+        path2 = self.make_backup_dir(1)
+        self.assert_(glob_backups(self.temp_dir) == [path1, path2])
+        self.failIf(exists(get_catalog_path(self.temp_dir)))
+
+    def test_prune_during_backup(self):
+        path = self.make_backup_dir(93)
+        catalog = Catalog(self.temp_dir)
+        try:
+            catalog.begin(make_backup_name(datetime.now()))
+            for i in range(BATCH_SIZE + 1):
+                catalog.add("/foo%(i)d" % dict(i=i), i, 0, 0, None)
+            # The backup holds no lock of the catalog between batches.
+            remove_backups(self.temp_dir, 93)
+            self.failIf(exists(path))
+        finally:
+            catalog.close()
+
+class TestJournal(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp(prefix="pydumpfs_journal")
+        self.src_dir = join(self.temp_dir, "src")
+        self.dest_dir = join(self.temp_dir, "dest")
+        for path in ["foo/bar", "baz/quux/hoge"]:
+            makedirs(join(self.src_dir, dirname(path)))
+            self.write(join(self.src_dir, path), path)
+        makedirs(self.dest_dir)
+        self.watcher = None
+
+    def tearDown(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.thread.join()
+            self.watcher.close()
+        rmtree(self.temp_dir)
+
+    def write(self, path, data):
+        file = open(path, "a")
+        try:
+            print >> file, data
+        finally:
+            file.close()
+
+    def start_watcher(self):
+        self.watcher = Watcher(self.dest_dir, [self.src_dir])
+        self.watcher.start()
+        self.thread = Thread(target=self.watcher.serve, args=(0.1,))
+        self.thread.start()
+        # A journal tells changes after the second when the watcher started.
+        sleep(1)
+
+    def backup(self):
+        obj = Pydumpfs()
+        return obj.do(self.dest_dir, self.src_dir), obj.stats
+
+    def test_dirty_dir(self):
+        self.start_watcher()
+        backup_dir1, _ = self.backup()
+        path = join(self.src_dir, "baz/quux/hoge")
+        self.write(path, "piyo")
+        backup_dir2, stats = self.backup()
+
+        self.assert_(stats.counters["scanned_dirs"] == 1)
+        self.assert_(stats.counters["clean_dirs"] == 3)
+        foo_path = join(self.src_dir, "foo/bar")
+        self.assert_(samefile(backup_dir1 + foo_path, backup_dir2 + foo_path))
+        self.failIf(samefile(backup_dir1 + path, backup_dir2 + path))
+        file = open(backup_dir2 + path)
+        try:
+            self.assert_(file.read() == "baz/quux/hoge\npiyo\n")
+        finally:
+            file.close()
+
+    def test_new_dir(self):
+        self.start_watcher()
+        self.backup()
+        path = join(self.src_dir, "foo/piyo/fuga")
+        makedirs(dirname(path))
+        self.write(path, "fuga")
+        backup_dir, stats = self.backup()
+        self.assert_(stats.counters["scanned_dirs"] == 2)
+        self.assert_(isfile(backup_dir + path))
+
+    def test_watcher_after_backup(self):
+        self.backup()
+        self.start_watcher()
+        _, stats = self.backup()
+        self.assert_(stats.counters["clean_dirs"] == 0)
+
+    def test_no_watcher(self):
+        self.backup()
+        _, stats = self.backup()
+        self.assert_(stats.counters["clean_dirs"] == 0)
+
+class TestBenchmark(TestCase):
+
+    def test_run_chunker(self):
+        report = run_chunker(4 * 1024 * 1024, 65536)
+        self.assert_(0 < report["bytes_per_second"])
+        # Chunks are bounded by a quarter and four times of the size.
+        self.assert_(4 <= report["chunks"] <= 256)
+
+    def test_run(self):
+        spec = TreeSpec(
+            files=20, depth=1, width=2, huge_files=1, huge_size=1024 * 1024,
+            symlinks=2, sparse_files=1, sparse_size=1024 * 1024, churn=0.5)
+        report = run(spec, settle=0)
+        self.assert_(report["snapshots"] == 2)
+        for name in ["full", "incremental", "prune"]:
+            phase = report["phases"][name]
+            for key in ["wall", "io", "syscalls", "max_rss_kb",
+                    "syscalls_counted"]:
+                self.assert_(key in phase,
+                    "%(key)r is not in the %(name)s phase."
+                        % dict(key=key, name=name))
+        # listdir() imported by name and the builtin open() are seen too.
+        syscalls = report["phases"]["incremental"]["syscalls"]
+        self.assert_(0 < syscalls.get("listdir", 0))
+        self.assert_(0 < syscalls.get("open", 0))
+
+        # Calls of workers removing snapshots are added up. Workers remove
+        # their subtrees, and the parent removes few files itself.
+        report2 = run(spec, options=dict(jobs=4), settle=0)
+        syscalls = report["phases"]["prune"]["syscalls"]
+        syscalls2 = report2["phases"]["prune"]["syscalls"]
+        self.assert_(0 < syscalls.get("unlinkat", 0))
+        self.assert_(syscalls["unlinkat"] < 2 * syscalls2.get("unlinkat", 0))
+
+class TestMatcher(TestCase):
+
+    def assert_excluded(self, rules, path, is_dir=False):
+        self.assert_(Matcher(rules).is_excluded(path, is_dir),
+            "%(rules)r don't exclude %(path)r." % dict(rules=rules, path=path))
+
+    def assert_included(self, rules, path, is_dir=False):
+        self.failIf(Matcher(rules).is_excluded(path, is_dir),
+            "%(rules)r exclude %(path)r." % dict(rules=rules, path=path))
+
+    def test_name(self):
+        self.assert_excluded(["*.o"], "foo.o")
+        self.assert_excluded(["*.o"], "foo/bar.o")
+        self.assert_included(["*.o"], "foo.c")
+
+    def test_anchored(self):
+        self.assert_excluded(["/foo"], "foo")
+        self.assert_included(["/foo"], "bar/foo")
+        self.assert_excluded(["foo/bar"], "foo/bar")
+        self.assert_included(["foo/bar"], "baz/foo/bar")
+        self.assert_included(["foo/*"], "foo/bar/baz")
+
+    def test_double_asterisk(self):
+        self.assert_excluded(["**/foo"], "foo")
+        self.assert_excluded(["**/foo"], "bar/baz/foo")
+        self.assert_excluded(["foo/**/bar"], "foo/bar")
+        self.assert_excluded(["foo/**/bar"], "foo/baz/quux/bar")
+        self.assert_excluded(["foo/**"], "foo/bar/baz")
+
+    def test_dir_only(self):
+        self.assert_excluded(["foo/"], "bar/foo", True)
+        self.assert_included(["foo/"], "bar/foo", False)
+
+    def test_include(self):
+        rules = ["*.o", "!keep.o"]
+        self.assert_excluded(rules, "foo.o")
+        self.assert_included(rules, "keep.o")
+        self.assert_excluded(rules + ["keep.o"], "keep.o")
+
+    def test_bracket(self):
+        self.assert_excluded(["foo[0-9]"], "foo1")
+        self.assert_included(["foo[!0-9]"], "foo1")
+        self.assert_excluded(["foo[!0-9]"], "fooa")
+        self.assert_excluded(["foo["], "foo[")
+
+    def test_parse_rules(self):
+        lines = ["# comment\n", "\n", "*.o  \n", "\\#foo\n"]
+        self.assert_(parse_rules(lines) == ["*.o", "\\#foo"])
+        self.assert_excluded(parse_rules(lines), "#foo")
+
+    def test_parse_key(self):
+        for rules, one_file_system in [([], False), (["*.o", "!a"], True)]:
+            key = Matcher(rules, one_file_system).get_key()
+            matcher = parse_key(key)
+            self.assert_(matcher.rules == rules)
+            self.assert_(matcher.one_file_system == one_file_system)
+
+class TestPrefetcher(TestCase):
+
+    def test_order(self):
+        prefetcher = Prefetcher(range(100), 4)
+        try:
+            self.assert_(list(prefetcher) == range(100))
+        finally:
+            prefetcher.close()
+
+    def test_error(self):
+        def generate():
+            yield 42
+            raise ValueError("foo")
+        prefetcher = Prefetcher(generate(), 4)
+        try:
+            items = []
+            try:
+                for item in prefetcher:
+                    items.append(item)
+            except ValueError:
+                pass
+            else:
+                self.fail("ValueError is not raised.")
+            self.assert_(items == [42])
+        finally:
+            prefetcher.close()
+
+    def test_close_early(self):
+        produced = []
+        def generate():
+            for i in range(100):
+                produced.append(i)
+                yield i
+        prefetcher = Prefetcher(generate(), 4)
+        for item in prefetcher:
+            break
+        prefetcher.close()
+        self.assert_(len(produced) < 100)
+
+class TestMergeJoin(TestCase):
+
+    def test_merge_join(self):
+        left = [("bar", 1), ("baz", 2), ("quux", 3)]
+        right = [("baz", 4), ("foo", 5)]
+        joined = list(merge_join(left, right))
+        self.assert_(joined == [
+            ("bar", 1, None), ("baz", 2, 4), ("foo", None, 5),
+            ("quux", 3, None)], repr(joined))
+
+class TestFileCopier(TestCase):
+
+    def setUp(self):
+        self.temp_dir = mkdtemp(prefix="pydumpfs_copy")
+
+    def tearDown(self):
+        rmtree(self.temp_dir)
+
+    def make_file(self, sparse):
+        path = join(self.temp_dir, "foo")
+        file = open(path, "wb")
+        try:
+            if sparse:
+                file.seek(16 * 1024 * 1024)
+            file.write("foo" * 1000000)
+            if sparse:
+                file.truncate(64 * 1024 * 1024)
+        finally:
+            file.close()
+        return path
+
+    def copy_by(self, methods, sparse=False):
+        src_path = self.make_file(sparse)
+        dest_path = join(self.temp_dir, "bar")
+
+        copier = FileCopier()
+        copier.reflink = False
+        copier.methods = methods
+        src = open(src_path, "rb")
+        try:
+            dest = open(dest_path, "wb")
+            try:
+                method = copier.copy(src.fileno(), dest.fileno())
+            finally:
+                dest.close()
+        finally:
+            src.close()
+
+        import filecmp
+        self.assert_(filecmp.cmp(src_path, dest_path, False))
+        src_st = stat(src_path)
+        dest_st = stat(dest_path)
+        self.assert_(dest_st.st_blocks <= src_st.st_blocks,
+            "%(path)r has more blocks than %(src)r."
+                % dict(path=dest_path, src=src_path))
+        return method
+
+    def test_each_method(self):
+        for method in FileCopier().methods:
+            self.copy_by([method])
+
+    def test_read_write(self):
+        self.assert_(self.copy_by([]) == "read/write")
+
+    def compare_and_copy(self, src_data, prev_data):
+        paths = []
+        for name, data in [("foo", src_data), ("bar", prev_data)]:
+            path = join(self.temp_dir, name)
+            file = open(path, "wb")
+            try:
+                file.write(data)
+            finally:
+                file.close()
+            paths.append(path)
+        dest_path = join(self.temp_dir, "baz")
+
+        src = open(paths[0], "rb")
+        try:
+            prev = open(paths[1], "rb")
+            try:
+                same = FileCopier().compare_and_copy(
+                    src.fileno(), prev.fileno(), dest_path)
+            finally:
+                prev.close()
+        finally:
+            src.close()
+
+        if same:
+            self.failIf(exists(dest_path))
+        else:
+            import filecmp
+            self.assert_(filecmp.cmp(paths[0], dest_path, False))
+        return same
+
+    def test_compare_and_copy(self):
+        data = "foo" * 1000000
+        self.assert_(self.compare_and_copy(data, data))
+        self.failIf(self.compare_and_copy(data[:-1] + "x", data))
+        self.failIf(self.compare_and_copy(data + "x", data))
+        self.failIf(self.compare_and_copy(data, data + "x"))
+
+    def test_sparse(self):
+        for method in FileCopier().methods:
+            self.copy_by([method], True)
+        self.copy_by([], True)
+
 class TestPydumpfs(TestCase):
 
     def setUp(self):
@@ -194,6 +625,712 @@ class TestPydumpfs(TestCase):
         path2 = backup_dir2 + file_path
         self.failIf(samefile(path1, path2))
 
+    def _backup_rewritten_file(self, checksum, manifest=True):
+        name = "checksum"
+        src_dir = self._get_source_directory(name)
+        file_path = join(src_dir, "foo")
+
+        obj = Pydumpfs(checksum=checksum, **self._get_pydumpfs_options())
+        backup_dir1 = obj.do(self.dest_dir, src_dir)
+        if not manifest:
+            remove(get_manifest_path(backup_dir1))
+
+        st = stat(file_path)
+        self._write_sample_file(file_path, "bar")
+        utime(file_path, (st.st_atime, st.st_mtime))
+        try:
+            backup_dir2 = obj.do(self.dest_dir, src_dir)
+        finally:
+            self._make_sample_file(file_path)
+            utime(file_path, (st.st_atime, st.st_mtime))
+
+        return samefile(backup_dir1 + file_path, backup_dir2 + file_path)
+
+    def test_same_stat_file(self):
+        self.assert_(self._backup_rewritten_file(False, False))
+
+    def test_checksum(self):
+        self.failIf(self._backup_rewritten_file(True, False))
+
+    def test_changed_ctime(self):
+        self.failIf(self._backup_rewritten_file(False))
+
+    def test_manifest(self):
+        name = "checksum"
+        src_dir = self._get_source_directory(name)
+        file_path = join(src_dir, "foo")
+
+        obj = Pydumpfs(**self._get_pydumpfs_options())
+        backup_dir = obj.do(self.dest_dir, src_dir)
+
+        manifest = open_manifest(backup_dir)
+        try:
+            record = manifest.lookup(file_path)
+        finally:
+            manifest.close()
+        st = lstat(file_path)
+        self.assert_(is_same_stat(record, st))
+        self.assert_(record.name == "foo")
+
+    def test_link_without_previous_tree(self):
+        name = "hard_link"
+        src_dir = self._get_source_directory(name)
+        file_path = join(src_dir, "foo")
+
+        obj = Pydumpfs(**self._get_pydumpfs_options())
+        backup_dir1 = obj.do(self.dest_dir, src_dir)
+        remove(backup_dir1 + file_path)
+        backup_dir2 = obj.do(self.dest_dir, src_dir)
+
+        self._compare_file(backup_dir2 + file_path, file_path)
+
+    def test_dedup(self):
+        name = "dedup"
+        src_dir = self._get_source_directory(name)
+        foo_path = join(src_dir, "foo")
+        bar_path = join(src_dir, "bar")
+        st = stat(foo_path)
+        utime(bar_path, (st.st_atime, st.st_mtime))
+
+        obj = Pydumpfs(dedup=True, **self._get_pydumpfs_options())
+        backup_dir = obj.do(self.dest_dir, src_dir)
+
+        self.assert_(samefile(backup_dir + foo_path, backup_dir + bar_path))
+        self._compare_dir_recursively(backup_dir, src_dir)
+
+    def test_dedup_vanished_file(self):
+        src_dir = mkdtemp(prefix="pydumpfs_vanished")
+        try:
+            path = join(src_dir, "foo")
+            self._make_sample_file(path)
+            self._make_sample_file(join(src_dir, "bar"))
+            obj = Pydumpfs(dedup=True, **self._get_pydumpfs_options())
+            scan_dir = obj._scan_dir
+            def remove_after_scan(dirpath):
+                result = scan_dir(dirpath)
+                if exists(path):
+                    remove(path)
+                return result
+            obj._scan_dir = remove_after_scan
+            backup_dir = obj.do(self.dest_dir, src_dir)
+            self.assert_(obj.stats.counters["errors"] == 1)
+            self.failIf(lexists(backup_dir + path))
+            self.assert_(isfile(join(backup_dir + src_dir, "bar")))
+        finally:
+            rmtree(src_dir)
+
+    def test_dedup_after_prune(self):
+        src_dir = mkdtemp(prefix="pydumpfs_dedup_after_prune")
+        try:
+            foo_path = join(src_dir, "foo")
+            bar_path = join(src_dir, "bar")
+            self._make_sample_file(foo_path)
+            obj = Pydumpfs(dedup=True, **self._get_pydumpfs_options())
+            obj.decide_backup_dir = lambda dest: join(
+                dest, make_backup_name(datetime.now() - timedelta(100)))
+            backup_dir1 = obj.do(self.dest_dir, src_dir)
+            del obj.decide_backup_dir
+            # foo is linked to the first snapshot, which is pruned.
+            obj.do(self.dest_dir, src_dir)
+            remove_backups(self.dest_dir, 93)
+            self.failIf(exists(backup_dir1))
+
+            self._make_sample_file(bar_path)
+            st = stat(foo_path)
+            utime(bar_path, (st.st_atime, st.st_mtime))
+            backup_dir3 = obj.do(self.dest_dir, src_dir)
+            self.assert_(
+                samefile(backup_dir3 + foo_path, backup_dir3 + bar_path))
+        finally:
+            rmtree(src_dir)
+
+    def test_dedup_moved_file(self):
+        name = "dedup_moved_file"
+        src_dir = self._get_source_directory(name)
+        foo_path = join(src_dir, "foo")
+        bar_path = join(src_dir, "bar")
+
+        obj = Pydumpfs(dedup=True, **self._get_pydumpfs_options())
+        backup_dir1 = obj.do(self.dest_dir, src_dir)
+        rename(foo_path, bar_path)
+        try:
+            backup_dir2 = obj.do(self.dest_dir, src_dir)
+        finally:
+            rename(bar_path, foo_path)
+
+        self.assert_(samefile(backup_dir1 + foo_path, backup_dir2 + bar_path))
+
+    def _count_stat(self, obj, src_dir):
+        import os
+        counts = {}
+        def wrap(func):
+            def counter(path):
+                if path.startswith(src_dir + "/"):
+                    counts[path] = counts.get(path, 0) + 1
+                return func(path)
+            return counter
+
+        orig_lstat = os.lstat
+        orig_stat = os.stat
+        os.lstat = wrap(orig_lstat)
+        os.stat = wrap(orig_stat)
+        try:
+            obj.do(self.dest_dir, src_dir)
+        finally:
+            os.lstat = orig_lstat
+            os.stat = orig_stat
+        return counts
+
+    def test_stat_count(self):
+        name = "stat_count"
+        src_dir = self._get_source_directory(name)
+        entries = []
+        for dirpath, dirnames, filenames in walk(src_dir):
+            for name in dirnames + filenames:
+                entries.append(join(dirpath, name))
+
+        obj = Pydumpfs(**self._get_pydumpfs_options())
+        for _ in range(2):
+            counts = self._count_stat(obj, src_dir)
+            self.assert_(sorted(counts.keys()) == sorted(entries))
+            self.assert_(sum(counts.values()) == len(entries),
+                "%(counts)r has more than one call per entry."
+                    % dict(counts=counts))
+
+    def test_stats(self):
+        src_dir = self._get_source_directory("stat_count")
+        size = lstat(join(src_dir, "foo")).st_size \
+            + lstat(join(src_dir, "bar", "baz")).st_size
+
+        obj = Pydumpfs(**self._get_pydumpfs_options())
+        obj.do(self.dest_dir, src_dir)
+        counters = obj.stats.counters
+        self.assert_(counters["scanned_dirs"] == 2)
+        self.assert_(counters["scanned_files"] == 3)
+        self.assert_(counters["copied"] == 2)
+        self.assert_(counters["linked"] == 0)
+        self.assert_(counters["symlinked"] == 1)
+        self.assert_(counters["bytes_written"] == size)
+        self.assert_(counters["errors"] == 0)
+
+        obj.do(self.dest_dir, src_dir)
+        counters = obj.stats.counters
+        self.assert_(counters["copied"] == 0)
+        self.assert_(counters["linked"] == 2)
+        self.assert_(counters["bytes_written"] == 0)
+
+        path = join(self.dest_dir, "stats.json")
+        obj.stats.write_json(path)
+        file = open(path)
+        try:
+            data = json.load(file)
+        finally:
+            file.close()
+        self.assert_(data["linked"] == 2)
+        self.assert_(sorted(data["times"].keys()) == sorted(PHASES))
+        self.assert_(0 <= data["wall"])
+
+    def test_exclude(self):
+        src_dir = self._get_source_directory("exclude")
+        rules = ["*.o", "!sub/keep.o", "cache/", "/sub/build"]
+        obj = Pydumpfs(rules=rules, **self._get_pydumpfs_options())
+        for _ in range(2):
+            backup_dir = obj.do(self.dest_dir, src_dir)
+            for path in ["foo", "sub/keep.o"]:
+                self.assert_(exists(backup_dir + join(src_dir, path)))
+            for path in ["bar.o", "cache", "sub/cache", "sub/build"]:
+                self.failIf(lexists(backup_dir + join(src_dir, path)))
+            self.assert_(obj.stats.counters["scanned_dirs"] == 2)
+
+    def test_exclude_meta_data(self):
+        src_dir = self._get_source_directory("exclude")
+        rules = ["cache/", "/sub/build"]
+        obj = Pydumpfs(rules=rules, **self._get_pydumpfs_options())
+        restored = []
+        restore_meta_data = obj._restore_meta_data
+        def record(dest, src, st):
+            restored.append(src)
+            return restore_meta_data(dest, src, st)
+        obj._restore_meta_data = record
+        backup_dir = obj.do(self.dest_dir, src_dir)
+        # Excluded subtrees are not looked at after the walk either.
+        for path in ["cache", "sub/cache", "sub/build"]:
+            path = join(src_dir, path)
+            self.failIf([p for p in restored
+                if (p == path) or p.startswith(path + "/")])
+        for path in ["", "sub"]:
+            path = join(src_dir, path).rstrip("/")
+            self.assert_(path in restored)
+            self._compare_stat(backup_dir + path, path)
+
+    def test_parallel_sources(self):
+        src_dirs = [
+            self._get_source_directory(name)
+            for name in ["copy_file", "stat_count", "exclude"]]
+        obj = Pydumpfs(parallel_sources=True, **self._get_pydumpfs_options())
+        self.assert_(obj._group_by_device(src_dirs) == [src_dirs])
+        # Pretends that the sources are on different devices.
+        obj._group_by_device = lambda src: [[path] for path in src]
+        for _ in range(2):
+            backup_dir = obj.do(self.dest_dir, *src_dirs)
+            for src_dir in src_dirs:
+                self._compare_dir_recursively(backup_dir, src_dir)
+
+    def test_catalog(self):
+        src_dir = mkdtemp(prefix="pydumpfs_catalog")
+        try:
+            foo_path = join(src_dir, "foo")
+            bar_path = join(src_dir, "bar", "baz")
+            makedirs(dirname(bar_path))
+            self._make_sample_file(foo_path)
+            self._make_sample_file(bar_path)
+            obj = Pydumpfs(**self._get_pydumpfs_options())
+            backup_dir1 = obj.do(self.dest_dir, src_dir)
+            backup_dir2 = obj.do(self.dest_dir, src_dir)
+            self._write_sample_file(foo_path, "quux")
+            rmtree(dirname(bar_path))
+            backup_dir3 = obj.do(self.dest_dir, src_dir)
+        finally:
+            rmtree(src_dir)
+
+        names = [basename(path)
+            for path in [backup_dir1, backup_dir2, backup_dir3]]
+        self.assert_(glob_backups(self.dest_dir) == [
+            join(self.dest_dir, name) for name in names])
+        catalog = Catalog(self.dest_dir)
+        try:
+            self.assert_(catalog.latest() == names[2])
+            history = catalog.history(foo_path)
+            self.assert_([(v.first, v.last) for v in history] == [
+                (names[0], names[1]), (names[2], names[2])])
+            self.assert_(history[0].ino == lstat(backup_dir2 + foo_path).st_ino)
+            history = catalog.history(bar_path)
+            self.assert_([(v.first, v.last) for v in history] == [
+                (names[0], names[1])])
+            ino = lstat(backup_dir2 + bar_path).st_ino
+            self.assert_(catalog.first_with_inode(ino) == names[0])
+            # Digests are computed from the files, which were copied without
+            # them.
+            digest = sha256(open(backup_dir2 + bar_path).read()).hexdigest()
+            self.assert_(catalog.first_with_digest(digest) == names[0])
+            digest = sha256("quux\n").hexdigest()
+            self.assert_(catalog.first_with_digest(digest) == names[2])
+            self.assert_(catalog.first_with_digest(sha256().hexdigest()) \
+                is None)
+        finally:
+            catalog.close()
+
+    def test_diff(self):
+        src_dir = mkdtemp(prefix="pydumpfs_diff")
+        try:
+            for path in ["foo", "bar/baz", "qux", "same"]:
+                path = join(src_dir, path)
+                if not isdir(dirname(path)):
+                    makedirs(dirname(path))
+                self._make_sample_file(path)
+            obj = Pydumpfs(**self._get_pydumpfs_options())
+            backup_dir1 = obj.do(self.dest_dir, src_dir)
+            self._write_sample_file(join(src_dir, "foo"), "quux")
+            chmod(join(src_dir, "qux"), 0600)
+            rmtree(join(src_dir, "bar"))
+            self._make_sample_file(join(src_dir, "new"))
+            backup_dir2 = obj.do(self.dest_dir, src_dir)
+
+            changes = [
+                (change.kind, change.path[len(src_dir):])
+                for change in diff_snapshots(backup_dir1, backup_dir2)
+                if change.path.startswith(src_dir + "/")]
+            self.assert_(changes == [
+                ("removed", "/bar"), ("removed", "/bar/baz"),
+                ("modified", "/foo"), ("added", "/new"),
+                ("metadata", "/qux")], changes)
+
+            self.failIf(list(diff_source(backup_dir2, src_dir)))
+            remove(join(src_dir, "new"))
+            changes = list(diff_source(backup_dir2, src_dir))
+            self.assert_(changes == [("removed", join(src_dir, "new"))])
+        finally:
+            rmtree(src_dir)
+
+    def test_space(self):
+        src_dir = mkdtemp(prefix="pydumpfs_space")
+        try:
+            for name in ["foo", "bar"]:
+                self._write_sample_file(join(src_dir, name), name * 4096)
+            obj = Pydumpfs(**self._get_pydumpfs_options())
+            backup_dir1 = obj.do(self.dest_dir, src_dir)
+            self._write_sample_file(join(src_dir, "foo"), "baz" * 4096)
+            backup_dir2 = obj.do(self.dest_dir, src_dir)
+        finally:
+            rmtree(src_dir)
+
+        names = [basename(backup_dir1), basename(backup_dir2)]
+        report = SpaceCounter(self.dest_dir).count()
+        self.assert_(report.names == names)
+        foo_size = lstat(backup_dir1 + join(src_dir, "foo")).st_blocks * 512
+        bar_size = lstat(backup_dir1 + join(src_dir, "bar")).st_blocks * 512
+        self.assert_(foo_size <= report.unique[0])
+        self.assert_(report.get_shared(0) == bar_size)
+        self.assert_(report.get_shared(1) == bar_size)
+        self.assert_(report.freed(names[:1]) == report.unique[0])
+        self.assert_(report.freed(names) \
+            == report.unique[0] + report.unique[1] + bar_size)
+        self.assert_(report.external == 0)
+
+        # Writing the table out for each i-node gives the same report.
+        report2 = SpaceCounter(self.dest_dir, BYTES_PER_INODE).count()
+        self.assert_(report2.to_dict() == report.to_dict())
+
+    def test_space_blocks(self):
+        src_dir = mkdtemp(prefix="pydumpfs_space_blocks")
+        try:
+            path = join(src_dir, "foo")
+            self._write_random_file(path, 65536, "foo")
+            obj = Pydumpfs(
+                chunk_size=1024, delta_min_size=1024,
+                **self._get_pydumpfs_options())
+            backup_dirs = [obj.do(self.dest_dir, src_dir)]
+            # The second snapshot has no list, and the third one has another
+            # list of the same blocks.
+            rename(path, self.dest_dir + ".foo")
+            try:
+                backup_dirs.append(obj.do(self.dest_dir, src_dir))
+            finally:
+                rename(self.dest_dir + ".foo", path)
+            backup_dirs.append(obj.do(self.dest_dir, src_dir))
+        finally:
+            rmtree(src_dir)
+
+        names = [basename(backup_dir) for backup_dir in backup_dirs]
+        report = SpaceCounter(self.dest_dir).count()
+        dir_ = get_store_dir(self.dest_dir)
+        store_size = sum([lstat(join(dir_, prefix, name)).st_blocks * 512
+            for prefix in listdir(dir_) if isdir(join(dir_, prefix))
+            for name in listdir(join(dir_, prefix))])
+        self.assert_(0 < store_size)
+        self.assert_(store_size <= report.referenced[0])
+        self.assert_(report.referenced[1] < store_size)
+        self.assert_(store_size <= report.referenced[2])
+        self.assert_(report.freed(names[:1]) < store_size)
+        self.assert_(store_size <= report.freed([names[0], names[2]]))
+        self.assert_(report.freed(names) == report.total)
+        self.assert_(report.total < sum(report.referenced))
+        self.assert_(report.external == 0)
+
+        report2 = SpaceCounter(self.dest_dir, BYTES_PER_INODE).count()
+        self.assert_(report2.to_dict() == report.to_dict())
+
+    def test_resume(self):
+        src_dir = mkdtemp(prefix="pydumpfs_resume")
+        try:
+            for path in ["foo", "bar/baz", "bar/qux", "quux"]:
+                path = join(src_dir, path)
+                if not isdir(dirname(path)):
+                    makedirs(dirname(path))
+                self._make_sample_file(path)
+                # Files changed when the backup started are copied again.
+                st = stat(path)
+                utime(path, (st.st_atime - 10, st.st_mtime - 10))
+            obj = Pydumpfs(**self._get_pydumpfs_options())
+            copy = obj._copy
+            def interrupt(dest, src, st):
+                if src == join(src_dir, "quux"):
+                    raise RuntimeError("interrupted")
+                return copy(dest, src, st)
+            obj._copy = interrupt
+            self.assertRaises(RuntimeError, obj.do, self.dest_dir, src_dir)
+            self.failIf(glob_backups(self.dest_dir))
+            names = [name for name in listdir(self.dest_dir)
+                if name != ".pydumpfs"]
+            self.assert_(len(names) == 1)
+            self.assert_(is_incomplete(join(self.dest_dir, names[0])))
+
+            del obj._copy
+            self._write_sample_file(join(src_dir, "bar", "baz"), "quux")
+            remove(join(src_dir, "bar", "qux"))
+            # A file which the source doesn't have any more is removed, and
+            # the message is printed in its turn.
+            stale_path = join(self.dest_dir, names[0]) + join(src_dir, "stale")
+            self._make_sample_file(stale_path)
+            flushed = []
+            flush = obj._flush
+            def record(messages):
+                flushed.extend([s for _, s in messages])
+                flush(messages)
+            obj._flush = record
+            obj.verbose = True
+            stdout = sys.stdout
+            sys.stdout = StringIO()
+            try:
+                backup_dir = obj.do(self.dest_dir, src_dir)
+            finally:
+                sys.stdout = stdout
+            self.assert_(backup_dir == join(self.dest_dir, names[0]))
+            self.failIf(lexists(stale_path))
+            self.assert_(
+                "remove: path=%(path)s" % dict(path=stale_path) in flushed)
+            self._compare_dir_recursively(backup_dir, src_dir)
+            self.assert_(0 < obj.stats.counters["resumed"])
+            self.failIf(is_incomplete(backup_dir))
+            self.assert_(glob_backups(self.dest_dir) == [backup_dir])
+            catalog = Catalog(self.dest_dir)
+            try:
+                history = catalog.history(join(src_dir, "foo"))
+            finally:
+                catalog.close()
+            self.assert_([(v.first, v.last) for v in history] == [
+                (names[0], names[0])])
+        finally:
+            rmtree(src_dir)
+
+    def test_failed_copy(self):
+        src_dir = mkdtemp(prefix="pydumpfs_failed")
+        try:
+            path = join(src_dir, "foo")
+            self._write_random_file(path, 3000000, "foo")
+            def fail(src_fd, dest_fd):
+                os.write(dest_fd, "x" * 1000)
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+            obj = Pydumpfs(**self._get_pydumpfs_options())
+            obj._copier.copy = fail
+            backup_dir1 = obj.do(self.dest_dir, src_dir)
+            self.assert_(obj.stats.counters["errors"] == 1)
+            # The partial file is neither kept nor recorded.
+            self.failIf(lexists(backup_dir1 + path))
+            manifest = open_manifest(backup_dir1)
+            try:
+                self.failIf(manifest.lookup(path))
+            finally:
+                manifest.close()
+
+            del obj._copier.copy
+            backup_dir2 = obj.do(self.dest_dir, src_dir)
+            self._compare_file(backup_dir2 + path, path)
+
+            # Contents compared while copying fail in the same way.
+            obj = Pydumpfs(checksum=True, **self._get_pydumpfs_options())
+            def fail_compare(src_fd, prev_fd, dest):
+                fd = os.open(dest, os.O_WRONLY | os.O_CREAT, 0600)
+                os.close(fd)
+                raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC))
+            obj._copier.compare_and_copy = fail_compare
+            backup_dir3 = obj.do(self.dest_dir, src_dir)
+            self.assert_(obj.stats.counters["errors"] == 1)
+            self.failIf(lexists(backup_dir3 + path))
+        finally:
+            rmtree(src_dir)
+
+    def test_compress(self):
+        src_dir = mkdtemp(prefix="pydumpfs_compress")
+        try:
+            for name in ["log", "photo.jpg"]:
+                self._write_sample_file(join(src_dir, name), name * 4096)
+            self._make_sample_file(join(src_dir, "small"))
+            log_path = join(src_dir, "log")
+            obj = Pydumpfs(compress="gzip", **self._get_pydumpfs_options())
+            backup_dir1 = obj.do(self.dest_dir, src_dir)
+            self.assert_(obj.stats.counters["compressed"] == 1)
+            backup_dir2 = obj.do(self.dest_dir, src_dir)
+
+            stored_path = backup_dir2 + log_path
+            self.assert_(samefile(backup_dir1 + log_path, stored_path))
+            self.assert_(lstat(stored_path).st_size < stat(log_path).st_size)
+            file = GzipFile(stored_path)
+            try:
+                self.assert_(file.read() == open(log_path).read())
+            finally:
+                file.close()
+            for name in ["photo.jpg", "small"]:
+                path = join(src_dir, name)
+                self.assert_(lstat(backup_dir2 + path).st_size \
+                    == stat(path).st_size)
+            manifest = open_manifest(backup_dir2)
+            try:
+                self.assert_(manifest.lookup(log_path).codec == "gzip")
+                self.assert_(
+                    manifest.lookup(join(src_dir, "small")).codec is None)
+            finally:
+                manifest.close()
+
+            target, _ = self._restore(backup_dir2)
+            self._compare_dir_recursively(target, src_dir)
+            self.failIf(list(diff_source(backup_dir2, src_dir)))
+            self._write_sample_file(log_path, "foo" * 4096)
+            changes = list(diff_source(backup_dir2, src_dir))
+            self.assert_(changes == [("modified", log_path)])
+        finally:
+            rmtree(src_dir)
+
+    def _count_blocks(self):
+        dir_ = get_store_dir(self.dest_dir)
+        return sum([len(listdir(join(dir_, name))) for name in listdir(dir_)
+            if isdir(join(dir_, name))])
+
+    def test_delta(self):
+        src_dir = mkdtemp(prefix="pydumpfs_delta")
+        try:
+            path = join(src_dir, "image")
+            file = open(path, "wb")
+            try:
+                for c in "abcd":
+                    file.write(c * 4096)
+            finally:
+                file.close()
+            obj = Pydumpfs(delta_min_size=8192, block_size=4096,
+                **self._get_pydumpfs_options())
+            backup_dir1 = obj.do(self.dest_dir, src_dir)
+            self.assert_(obj.stats.counters["stored_blocks"] == 4)
+            file = open(path, "r+b")
+            try:
+                file.seek(4096)
+                file.write("e" * 4096)
+            finally:
+                file.close()
+            backup_dir2 = obj.do(self.dest_dir, src_dir)
+            self.assert_(obj.stats.counters["stored_blocks"] == 1)
+            self.assert_(lstat(backup_dir2 + path).st_size < 4096)
+            backup_dir3 = obj.do(self.dest_dir, src_dir)
+            self.assert_(obj.stats.counters["stored_blocks"] == 0)
+            self.assert_(samefile(backup_dir2 + path, backup_dir3 + path))
+
+            changes = [tuple(change)
+                for change in diff_snapshots(backup_dir1, backup_dir2)
+                if change.path.startswith(src_dir + "/")]
+            self.assert_(changes == [("modified", path)])
+            target, _ = self._restore(backup_dir3)
+            self._compare_dir_recursively(target, src_dir)
+
+            # The block which only the first snapshot listed goes.
+            rmtree(backup_dir1)
+            self.assert_(0 < collect_garbage(self.dest_dir))
+            self.assert_(self._count_blocks() == 4)
+            remove_backups(self.dest_dir, 0)
+            self.assert_(self._count_blocks() == 0)
+        finally:
+            rmtree(src_dir)
+
+    def _write_random_file(self, path, size, seed):
+        file = open(path, "wb")
+        try:
+            data = seed
+            while 0 < size:
+                data = sha256(data).digest()
+                file.write(data[:size])
+                size -= len(data)
+        finally:
+            file.close()
+
+    def test_chunks(self):
+        src_dir = mkdtemp(prefix="pydumpfs_chunks")
+        try:
+            path = join(src_dir, "foo")
+            self._write_random_file(path, 65536, "foo")
+            obj = Pydumpfs(
+                chunk_size=1024, delta_min_size=1024,
+                **self._get_pydumpfs_options())
+            backup_dir1 = obj.do(self.dest_dir, src_dir)
+            chunks = obj.stats.counters["stored_blocks"]
+            self.assert_(16 < chunks)
+
+            # Inserted data changes only chunks around it.
+            data = open(path, "rb").read()
+            file = open(path, "wb")
+            try:
+                file.write(data[:30000] + "bar" + data[30000:])
+            finally:
+                file.close()
+            # A copy with appended data shares all chunks but the last one.
+            copy_path = join(src_dir, "baz")
+            file = open(copy_path, "wb")
+            try:
+                file.write(data + "quux")
+            finally:
+                file.close()
+            backup_dir2 = obj.do(self.dest_dir, src_dir)
+            self.assert_(obj.stats.counters["stored_blocks"] <= 4)
+            target, _ = self._restore(backup_dir2)
+            self._compare_dir_recursively(target, src_dir)
+            self._compare_file(target + path, path)
+            self._compare_file(target + copy_path, copy_path)
+
+            remove_backups(self.dest_dir, 0)
+            self.assert_(self._count_blocks() == 0)
+        finally:
+            rmtree(src_dir)
+
+    def test_throttle(self):
+        src_dir = mkdtemp(prefix="pydumpfs_throttle")
+        try:
+            path = join(src_dir, "foo")
+            self._write_random_file(path, 1536 * 1024, "foo")
+            throttle = Throttle(read_rate=1024 * 1024, ops_rate=1000)
+            obj = Pydumpfs(throttle=throttle, **self._get_pydumpfs_options())
+            backup_dir = obj.do(self.dest_dir, src_dir)
+            # The first MiB is taken from the burst.
+            self.assert_(0.4 < obj.stats.times["throttle"])
+            self._compare_file(backup_dir + path, path)
+
+            stats = RunStats()
+            remove_backups(self.dest_dir, 0, stats=stats, throttle=throttle)
+            self.failIf(exists(backup_dir))
+        finally:
+            rmtree(src_dir)
+
+    def _restore(self, backup_dir, **kwargs):
+        target = join(self.dest_dir, "restored")
+        options = self._get_pydumpfs_options()
+        options.update(kwargs)
+        restorer = Restorer(**options)
+        restorer.restore(backup_dir, target)
+        self.assert_(restorer.stats.counters["errors"] == 0)
+        return target, restorer.stats
+
+    def test_restore(self):
+        src_dir = self._get_source_directory("dedup")
+        st = stat(join(src_dir, "foo"))
+        utime(join(src_dir, "bar"), (st.st_atime, st.st_mtime))
+        obj = Pydumpfs(dedup=True, **self._get_pydumpfs_options())
+        backup_dir = obj.do(self.dest_dir, src_dir)
+
+        target, stats = self._restore(backup_dir)
+        self._compare_dir_recursively(target, src_dir)
+        self.failIf(exists(join(target, ".pydumpfs")))
+        # Files which dedup linked were apart in the source.
+        foo_path = join(src_dir, "foo")
+        bar_path = join(src_dir, "bar")
+        self.assert_(samefile(backup_dir + foo_path, backup_dir + bar_path))
+        self.failIf(samefile(target + foo_path, target + bar_path))
+        self._compare_file(target + foo_path, target + bar_path)
+        self.assert_(stats.counters["copied"] == 2)
+        self.assert_(stats.counters["linked"] == 0)
+
+        target, stats = self._restore(backup_dir, skip_same=True)
+        self._compare_dir_recursively(target, src_dir)
+        self.assert_(stats.counters["copied"] == 0)
+        self.assert_(stats.counters["skipped"] == 2)
+
+    def test_restore_hard_link(self):
+        src_dir = mkdtemp(prefix="pydumpfs_restore_hard_link")
+        try:
+            foo_path = join(src_dir, "foo")
+            bar_path = join(src_dir, "bar")
+            baz_path = join(src_dir, "baz")
+            self._write_sample_file(foo_path, "foo")
+            os.link(foo_path, bar_path)
+            self._write_sample_file(baz_path, "baz")
+            obj = Pydumpfs(**self._get_pydumpfs_options())
+            obj.do(self.dest_dir, src_dir)
+            # The second snapshot links all files to the first one.
+            backup_dir = obj.do(self.dest_dir, src_dir)
+        finally:
+            rmtree(src_dir)
+
+        target, stats = self._restore(backup_dir)
+        self.assert_(samefile(target + foo_path, target + bar_path))
+        self.assert_(lstat(target + baz_path).st_nlink == 1)
+        self.assert_(stats.counters["copied"] == 2)
+        self.assert_(stats.counters["linked"] == 1)
+
     def test_copy_symlink_dir_twice(self):
         self._do_test_twice("copy_symlink_dir_twice")
 
@@ -241,12 +1378,13 @@ class TestPydumpfs(TestCase):
             remove(foo_path)
 
         obj = Pydumpfs(**self._get_pydumpfs_options())
-        makedirs(self.dest_dir + src_dir)
-        obj._copy_recursively(self.dest_dir, src_dir)
+        obj.do(self.dest_dir, src_dir)
 
+        # The new file and its directory get the status of the source in
+        # the next backup.
         self._make_sample_file(foo_path)
-
-        obj._change_meta_data(self.dest_dir, src_dir)
+        backup_dir = obj.do(self.dest_dir, src_dir)
+        self._compare_dir_recursively(backup_dir, src_dir)
 
     def test_fifo(self):
         name = "fifo"
@@ -289,13 +1427,16 @@ class TestPydumpfs(TestCase):
     def _get_source_directory(self, name):
         return abspath(join(dirname(__file__), name))
 
-    def _make_sample_file(self, path):
+    def _write_sample_file(self, path, content):
         file = open(path, "w")
         try:
-            print >> file, "foo"
+            print >> file, content
         finally:
             file.close()
 
+    def _make_sample_file(self, path):
+        self._write_sample_file(path, "foo")
+
     def _compare_file(self, path1, path2):
         import filecmp
         self.assert_(filecmp.cmp(path1, path2),
@@ -404,6 +1545,33 @@ class TestPydumpfs(TestCase):
         #return dict(verbose=True)
         return {}
 
+class TestParallelPydumpfs(TestPydumpfs):
+
+    def _get_pydumpfs_options(self):
+        return dict(jobs=4)
+
+    def _capture_output(self, name, jobs):
+        src_dir = self._get_source_directory(name)
+        dest_dir = join(self.dest_dir, str(jobs))
+        makedirs(dest_dir)
+        obj = Pydumpfs(verbose=True, jobs=jobs)
+        out = StringIO()
+        stdout = sys.stdout
+        sys.stdout = out
+        try:
+            backup_dir = obj.do(dest_dir, src_dir)
+        finally:
+            sys.stdout = stdout
+        return out.getvalue().replace(backup_dir, "")
+
+    def test_output_order(self):
+        name = "dedup"
+        output1 = self._capture_output(name, 1)
+        output2 = self._capture_output(name, 4)
+        self.assert_(output1 == output2,
+            "%(output1)r and %(output2)r are not same."
+                % dict(output1=output1, output2=output2))
+
 if __name__ == "__main__":
     main()
 
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""Limits of I/O which a run puts on disks.
+
+Bytes read, bytes written and operations are taken from token buckets. A
+taker may overdraw a bucket, and then sleeps until the bucket is refilled,
+so takers at once share the rate. An operation is a listed directory, a
+made file, link or block, metadata set on a file, or a removed file.
+
+In the adaptive mode, the await time of devices of sources, which is the
+average milliseconds of I/O completed, is sampled from /proc/diskstats. A
+taker sleeps longer while it is above the target, and shorter after it drops
+below. Devices which /proc/diskstats doesn't have, like those of network or
+stacked file systems, are not watched.
+"""
+
+from os.path import exists
+from threading import Lock
+from time import sleep, time
+import ctypes
+import errno
+import os
+import platform
+
+DISKSTATS_PATH = "/proc/diskstats"
+DEFAULT_TARGET_AWAIT = 20.0
+SAMPLE_INTERVAL = 0.5
+MIN_DELAY = 0.001
+MAX_DELAY = 1.0
+
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_SET = {
+    "x86_64": 251, "i386": 289, "i686": 289, "aarch64": 30, "armv7l": 314,
+    "ppc64": 273, "ppc64le": 273}
+
+def set_idle_priority():
+    """Puts this process in the idle I/O class of Linux, in which it gets the
+    disk only when no other process uses it."""
+    number = IOPRIO_SET.get(platform.machine())
+    if number is None:
+        raise OSError(errno.ENOSYS, "ioprio_set(2) is unknown.")
+    libc = ctypes.CDLL(None, use_errno=True)
+    if libc.syscall(number, IOPRIO_WHO_PROCESS, 0,
+            IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) < 0:
+        e = ctypes.get_errno()
+        raise OSError(e, os.strerror(e))
+
+class TokenBucket(object):
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            burst = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = time()
+        self.lock = Lock()
+
+    def take(self, n):
+        """Returns seconds to sleep for n tokens."""
+        self.lock.acquire()
+        try:
+            now = time()
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            if 0 <= self.tokens:
+                return 0
+            return -self.tokens / self.rate
+        finally:
+            self.lock.release()
+
+def _read_diskstats():
+    # Returns {(major, minor): (I/O completed, milliseconds spent)}.
+    stats = {}
+    file = open(DISKSTATS_PATH)
+    try:
+        for line in file:
+            fields = line.split()
+            if len(fields) < 11:
+                continue
+            major, minor = int(fields[0]), int(fields[1])
+            ios = int(fields[3]) + int(fields[7])
+            ticks = int(fields[6]) + int(fields[10])
+            stats[(major, minor)] = (ios, ticks)
+    finally:
+        file.close()
+    return stats
+
+class LatencyMonitor(object):
+    """Decides a delay of each taker from await times of devices."""
+
+    def __init__(self, target=DEFAULT_TARGET_AWAIT):
+        self.target = target
+        self.devices = set()
+        self.lock = Lock()
+        self.last = None
+        self.last_time = 0
+        self.delay = 0
+
+    def watch(self, path):
+        st = os.stat(path)
+        self.devices.add((os.major(st.st_dev), os.minor(st.st_dev)))
+
+    def _sample(self):
+        stats = _read_diskstats()
+        ios = ticks = 0
+        for device in self.devices:
+            if device in stats:
+                ios += stats[device][0]
+                ticks += stats[device][1]
+        return ios, ticks
+
+    def _update(self, now):
+        sample = self._sample()
+        last = self.last
+        self.last = sample
+        self.last_time = now
+        if last is None:
+            return
+        ios = sample[0] - last[0]
+        if ios <= 0:
+            self.delay /= 2
+        elif self.target < float(sample[1] - last[1]) / ios:
+            self.delay = min(MAX_DELAY, max(MIN_DELAY, 2 * self.delay))
+            return
+        else:
+            self.delay /= 2
+        if self.delay < MIN_DELAY:
+            self.delay = 0
+
+    def get_delay(self):
+        self.lock.acquire()
+        try:
+            now = time()
+            if (SAMPLE_INTERVAL <= now - self.last_time) \
+                    and exists(DISKSTATS_PATH):
+                self._update(now)
+            return self.delay
+        finally:
+            self.lock.release()
+
+class Throttle(object):
+    """Limits bytes read and written and operations per second. A rate of
+    None is not limited. Seconds slept are added to the phase "throttle" of
+    stats if it is set."""
+
+    def __init__(self, read_rate=None, write_rate=None, ops_rate=None,
+                 adaptive=False, target_await=DEFAULT_TARGET_AWAIT):
+        self.rates = (read_rate, write_rate, ops_rate)
+        self.buckets = [
+            None if rate is None else TokenBucket(rate)
+            for rate in self.rates]
+        self.adaptive = adaptive
+        self.target_await = target_await
+        if adaptive:
+            self.monitor = LatencyMonitor(target_await)
+        else:
+            self.monitor = None
+        self.stats = None
+
+    def watch(self, path):
+        """Backs off when the device of path is slow in the adaptive mode."""
+        if self.monitor is not None:
+            self.monitor.watch(path)
+
+    def share(self, n):
+        """Returns a throttle for each of n processes sharing this one."""
+        rates = [None if rate is None else float(rate) / n
+            for rate in self.rates]
+        throttle = Throttle(*rates, adaptive=self.adaptive,
+            target_await=self.target_await)
+        if self.monitor is not None:
+            throttle.monitor.devices = set(self.monitor.devices)
+        return throttle
+
+    def _take(self, index, n):
+        bucket = self.buckets[index]
+        if bucket is None:
+            delay = 0
+        else:
+            delay = bucket.take(n)
+        if self.monitor is not None:
+            delay += self.monitor.get_delay()
+        if delay <= 0:
+            return
+        start = time()
+        sleep(delay)
+        if self.stats is not None:
+            self.stats.add_time("throttle", start)
+
+    def read(self, n):
+        self._take(0, n)
+
+    def write(self, n):
+        self._take(1, n)
+
+    def op(self, n=1):
+        self._take(2, n)
+
+# vim: tabstop=4 shiftwidth=4 expandtab softtabstop=4